@@ -5,6 +5,7 @@
 
 import base64
 import functools
+import json
 import os
 from importlib.metadata import version
 
@@ -34,6 +35,10 @@ def as_dict(default):
     return compose(lambda x: {i.split(":")[0].strip(): i.split(":")[1].strip() for i in x.split(";")}, default)
 
 
+def as_json(default):
+    return compose(json.loads, default)
+
+
 def b64decode(default):
     return compose(base64.b64decode, default)
 
@@ -68,13 +73,24 @@ secrets = {
         ("ENV", required),
         # tooltool_api specific secrets, for more details look at src/tooltool_api/api.py
         ("UPLOAD_EXPIRES_IN", as_int(default(60))),
+        # files of at least this many bytes are uploaded in parts, by clients which support it (0 disables multipart uploads)
+        ("MULTIPART_UPLOAD_THRESHOLD", as_int(default(0))),
+        ("MULTIPART_UPLOAD_PART_SIZE", as_int(default(64 * 1024 * 1024))),
+        # all the parts of a file must start uploading within this time, so it is longer than UPLOAD_EXPIRES_IN
+        ("MULTIPART_UPLOAD_EXPIRES_IN", as_int(default(3600))),
         ("DOWLOAD_EXPIRES_IN", as_int(default(60))),
         ("ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD", as_bool(default(True))),
         ("S3_REGIONS_ACCESS_KEY_ID", required if S3_REGIONS else default(None)),
         ("S3_REGIONS_SECRET_ACCESS_KEY", required if S3_REGIONS else default(None)),
+        # connections kept open to each AWS service and region, shared by all threads (0 uses the botocore default of 10)
+        ("AWS_MAX_POOL_CONNECTIONS", as_int(default(0))),
         ("CLOUDFRONT_KEY_ID", required if CLOUDFRONT_URL else default(None)),
         # taskcluster instance url
         ("TASKCLUSTER_ROOT_URL", default("https://firefox-ci-tc.services.mozilla.com")),
+        # JSON object of clientId to accessToken, for clients whose requests can be verified without asking taskcluster
+        ("TASKCLUSTER_LOCAL_CREDENTIALS", as_json(default("{}"))),
+        # how long the scopes taskcluster returns for a client are trusted, in seconds
+        ("TASKCLUSTER_SCOPES_TTL", as_int(default(60))),
         # Database connection string, for more details look at src/tooltool_api/lib/db.py
         ("DATABASE_URL", required),
         # Log errors to sentry, for more details look at src/tooltool_api/lib/log.py
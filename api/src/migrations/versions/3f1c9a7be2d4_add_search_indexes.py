@@ -0,0 +1,102 @@
+"""Add indexes for substring search of filenames, authors and messages
+
+Revision ID: 3f1c9a7be2d4
+Revises: 697dbab45f3f
+Create Date: 2026-10-17 11:30:12.417209
+
+Searches are `LIKE '%q%'` queries, which no b-tree index can serve.  On
+PostgreSQL, pg_trgm GIN indexes can; SQLite has no such index, so the searched
+columns are copied to FTS5 tables using the trigram tokenizer, kept up to date
+by triggers, and searched through those tables instead (see
+tooltool_api.models).  Batch-mode migrations recreate SQLite tables, which
+drops their triggers: migrations altering the batches or batch files tables
+need to create the triggers again.
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3f1c9a7be2d4"
+down_revision = "697dbab45f3f"
+branch_labels = None
+depends_on = None
+
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE releng_tooltool_batches_search USING fts5(author, message, tokenize='trigram')",
+    "INSERT INTO releng_tooltool_batches_search (rowid, author, message) SELECT id, author, message FROM releng_tooltool_batches",
+    """CREATE TRIGGER releng_tooltool_batches_search_insert AFTER INSERT ON releng_tooltool_batches BEGIN
+        INSERT INTO releng_tooltool_batches_search (rowid, author, message) VALUES (new.id, new.author, new.message);
+    END""",
+    """CREATE TRIGGER releng_tooltool_batches_search_update AFTER UPDATE ON releng_tooltool_batches BEGIN
+        UPDATE releng_tooltool_batches_search SET rowid = new.id, author = new.author, message = new.message WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER releng_tooltool_batches_search_delete AFTER DELETE ON releng_tooltool_batches BEGIN
+        DELETE FROM releng_tooltool_batches_search WHERE rowid = old.id;
+    END""",
+    # batch files have no integer key to use as the rowid, so they are copied along
+    "CREATE VIRTUAL TABLE releng_tooltool_batch_files_search USING fts5(filename, file_id UNINDEXED, batch_id UNINDEXED, tokenize='trigram')",
+    "INSERT INTO releng_tooltool_batch_files_search (filename, file_id, batch_id) SELECT filename, file_id, batch_id FROM releng_tooltool_batch_files",
+    """CREATE TRIGGER releng_tooltool_batch_files_search_insert AFTER INSERT ON releng_tooltool_batch_files BEGIN
+        INSERT INTO releng_tooltool_batch_files_search (filename, file_id, batch_id) VALUES (new.filename, new.file_id, new.batch_id);
+    END""",
+    """CREATE TRIGGER releng_tooltool_batch_files_search_update AFTER UPDATE ON releng_tooltool_batch_files BEGIN
+        UPDATE releng_tooltool_batch_files_search SET filename = new.filename, file_id = new.file_id, batch_id = new.batch_id
+        WHERE file_id = old.file_id AND batch_id = old.batch_id;
+    END""",
+    """CREATE TRIGGER releng_tooltool_batch_files_search_delete AFTER DELETE ON releng_tooltool_batch_files BEGIN
+        DELETE FROM releng_tooltool_batch_files_search WHERE file_id = old.file_id AND batch_id = old.batch_id;
+    END""",
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER releng_tooltool_batch_files_search_delete",
+    "DROP TRIGGER releng_tooltool_batch_files_search_update",
+    "DROP TRIGGER releng_tooltool_batch_files_search_insert",
+    "DROP TABLE releng_tooltool_batch_files_search",
+    "DROP TRIGGER releng_tooltool_batches_search_delete",
+    "DROP TRIGGER releng_tooltool_batches_search_update",
+    "DROP TRIGGER releng_tooltool_batches_search_insert",
+    "DROP TABLE releng_tooltool_batches_search",
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.create_index(
+            "ix_releng_tooltool_batches_author_trgm", "releng_tooltool_batches", ["author"], postgresql_using="gin", postgresql_ops={"author": "gin_trgm_ops"}
+        )
+        op.create_index(
+            "ix_releng_tooltool_batches_message_trgm",
+            "releng_tooltool_batches",
+            ["message"],
+            postgresql_using="gin",
+            postgresql_ops={"message": "gin_trgm_ops"},
+        )
+        op.create_index(
+            "ix_releng_tooltool_batch_files_filename_trgm",
+            "releng_tooltool_batch_files",
+            ["filename"],
+            postgresql_using="gin",
+            postgresql_ops={"filename": "gin_trgm_ops"},
+        )
+        # the unique index on sha512 uses the database's collation, so it cannot serve prefix searches
+        op.create_index("ix_releng_tooltool_files_sha512_pattern", "releng_tooltool_files", ["sha512"], postgresql_ops={"sha512": "varchar_pattern_ops"})
+    elif dialect == "sqlite":
+        for statement in SQLITE_UPGRADE:
+            op.execute(sa.text(statement))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.drop_index("ix_releng_tooltool_files_sha512_pattern", table_name="releng_tooltool_files")
+        op.drop_index("ix_releng_tooltool_batch_files_filename_trgm", table_name="releng_tooltool_batch_files")
+        op.drop_index("ix_releng_tooltool_batches_message_trgm", table_name="releng_tooltool_batches")
+        op.drop_index("ix_releng_tooltool_batches_author_trgm", table_name="releng_tooltool_batches")
+    elif dialect == "sqlite":
+        for statement in SQLITE_DOWNGRADE:
+            op.execute(sa.text(statement))
@@ -0,0 +1,30 @@
+"""Add releng_tooltool_pending_upload.put_expires
+
+Revision ID: b52e0d7a91c3
+Revises: 3f1c9a7be2d4
+Create Date: 2026-10-17 12:05:41.302117
+
+The expiry of the last PUT URL handed out for a file, which a completed
+multipart upload keeps waiting for.  Existing pending uploads may have a PUT
+URL until they expire.
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b52e0d7a91c3"
+down_revision = "3f1c9a7be2d4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("releng_tooltool_pending_upload", sa.Column("put_expires", sa.DateTime(), nullable=True))
+    op.execute(sa.text("UPDATE releng_tooltool_pending_upload SET put_expires = expires"))
+
+
+def downgrade():
+    with op.batch_alter_table("releng_tooltool_pending_upload", schema=None) as batch_op:
+        batch_op.drop_column("put_expires")
@@ -35,6 +35,13 @@ def custom_handle_default_exceptions(e: Exception) -> typing.Tuple[flask.Respons
     return flask.jsonify(dict(error=error)), code
 
 
+def add_server_timing(response: flask.Response) -> flask.Response:
+    """Report the time the request spent getting AWS clients, in milliseconds."""
+    if "aws_connect_time" in flask.g:
+        response.headers.add("Server-Timing", f"aws-connect;dur={flask.g.aws_connect_time * 1000:.3f}")
+    return response
+
+
 def create_app(config: typing.Optional[dict] = None) -> flask.Flask:
     app = tooltool_api.lib.flask.create_app(
         project_name=tooltool_api.config.PROJECT_NAME,
@@ -43,7 +50,10 @@ def create_app(config: typing.Optional[dict] = None) -> flask.Flask:
         static_folder=os.path.join(os.path.dirname(__file__), "static"),
     )
     app.api.register(os.path.join(os.path.dirname(__file__), "api.yml"))
-    app.aws = tooltool_api.aws.AWS(app.config["S3_REGIONS_ACCESS_KEY_ID"], app.config["S3_REGIONS_SECRET_ACCESS_KEY"])
+    app.aws = tooltool_api.aws.AWS(
+        app.config["S3_REGIONS_ACCESS_KEY_ID"], app.config["S3_REGIONS_SECRET_ACCESS_KEY"], app.config.get("AWS_MAX_POOL_CONNECTIONS")
+    )
+    app.after_request(add_server_timing)
 
     for code, exception in werkzeug.exceptions.default_exceptions.items():
         app.register_error_handler(exception, custom_handle_default_exceptions)
@@ -7,9 +7,12 @@ import datetime
 import random
 import typing
 
+import botocore.exceptions
 import flask
 import flask_login
 import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
 import werkzeug
 import werkzeug.exceptions
 
@@ -30,21 +33,51 @@ def _get_region_and_bucket(region: typing.Optional[str], regions: typing.Dict[st
     return random.choice(list(regions.items()))
 
 
+# S3 limits on multipart uploads
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+
+
+def _create_multipart_upload(s3, bucket: str, digest: str, size: int, part_size: int, expires_in: int) -> dict:
+    client = s3.meta.client
+    key = tooltool_api.utils.keyname(digest)
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, ContentType="application/octet-stream")["UploadId"]
+    part_size = max(part_size, MULTIPART_MIN_PART_SIZE, -(-size // MULTIPART_MAX_PARTS))
+    part_urls = [
+        client.generate_presigned_url(
+            ClientMethod="upload_part",
+            ExpiresIn=expires_in,
+            Params={"Bucket": bucket, "Key": key, "UploadId": upload_id, "PartNumber": part_number},
+        )
+        for part_number in range(1, max(1, -(-size // part_size)) + 1)
+    ]
+    return dict(upload_id=upload_id, part_size=part_size, part_urls=part_urls)
+
+
 def _batch_query_options():
     return sa.orm.selectinload(tooltool_api.models.Batch._files).joinedload(tooltool_api.models.BatchFile.file)
 
 
-def search_batches(q: str) -> dict:
-    return dict(
-        result=[
-            row.to_dict()
-            for row in tooltool_api.models.Batch.query.options(_batch_query_options())
-            .filter(sa.or_(tooltool_api.models.Batch.author.contains(q), tooltool_api.models.Batch.message.contains(q)))
-            .all()
-        ]
+def _dialect() -> str:
+    return flask.g.db.session.get_bind().dialect.name
+
+
+def _search_batches_condition(q: str):
+    # Substring searches are served by trigram indexes on PostgreSQL, and by
+    # FTS5 tables on SQLite; see the 3f1c9a7be2d4 migration.
+    Batch = tooltool_api.models.Batch
+    if _dialect() != "sqlite":
+        return sa.or_(Batch.author.contains(q), Batch.message.contains(q))
+    search = tooltool_api.models.batches_search
+    return Batch.id.in_(
+        sa.union_all(sa.select(search.c.rowid).where(search.c.author.contains(q)), sa.select(search.c.rowid).where(search.c.message.contains(q)))
     )
 
 
+def search_batches(q: str) -> dict:
+    return dict(result=[row.to_dict() for row in tooltool_api.models.Batch.query.options(_batch_query_options()).filter(_search_batches_condition(q)).all()])
+
+
 def get_batch(id: int) -> dict:
     row = tooltool_api.models.Batch.query.options(_batch_query_options()).filter(tooltool_api.models.Batch.id == id).first()
     if not row:
@@ -52,6 +85,37 @@ def get_batch(id: int) -> dict:
     return row.to_dict()
 
 
+def _upsert_pending_uploads(session, rows: typing.List[dict]) -> None:
+    """Insert or update the PendingUpload rows for a batch.
+
+    The rows need to reflect the updated expiration time, even if there's an
+    existing pending upload that expires earlier.  Rows for multipart uploads
+    have no `put_expires`, and keep that of the existing pending upload.
+    PostgreSQL and SQLite can do that in a single statement; on other
+    databases, `merge` does a SELECT and then either UPDATEs or INSERTs each
+    row."""
+    if not rows:
+        return
+    table = tooltool_api.models.PendingUpload.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        insert = sa.dialects.postgresql.insert(table)
+    elif dialect == "sqlite":
+        insert = sa.dialects.sqlite.insert(table)
+    else:
+        for row in rows:
+            # merge leaves the attributes which are not set alone
+            session.merge(tooltool_api.models.PendingUpload(**{key: value for key, value in row.items() if value is not None}))
+        return
+    stmt = insert.values(rows)
+    put_expires = sa.func.coalesce(stmt.excluded.put_expires, table.c.put_expires)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[table.c.file_id], set_=dict(region=stmt.excluded.region, expires=stmt.excluded.expires, put_expires=put_expires)
+        )
+    )
+
+
 def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
     if not body["message"]:
         raise werkzeug.exceptions.BadRequest("message must be non-empty")
@@ -70,6 +134,16 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
     if type(UPLOAD_EXPIRES_IN) is not int:
         raise werkzeug.exceptions.InternalServerError("UPLOAD_EXPIRES_IN should be of type int.")
 
+    # Large files are uploaded in parts, if the client asks for it.  The object
+    # only appears once the server completes the multipart upload, after which
+    # it cannot be altered, but all the parts must start uploading before
+    # their URLs expire.  Clients ask with a header, as a query argument would
+    # change the resource signed for Hawk.
+    multipart = flask.request.headers.get("X-Tooltool-Multipart", "").lower() == "true"
+    MULTIPART_UPLOAD_THRESHOLD = flask.current_app.config.get("MULTIPART_UPLOAD_THRESHOLD") or 0
+    MULTIPART_UPLOAD_PART_SIZE = flask.current_app.config.get("MULTIPART_UPLOAD_PART_SIZE") or MULTIPART_MIN_PART_SIZE
+    MULTIPART_UPLOAD_EXPIRES_IN = flask.current_app.config.get("MULTIPART_UPLOAD_EXPIRES_IN") or UPLOAD_EXPIRES_IN
+
     S3_REGIONS = flask.current_app.config["S3_REGIONS"]  # type: typing.Dict[str, str]
     if type(S3_REGIONS) is not dict:
         raise werkzeug.exceptions.InternalServerError("S3_REGIONS should be of type dict.")
@@ -90,17 +164,32 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
 
     s3 = flask.current_app.aws.connect_to("s3", region)
 
-    for filename, info in body["files"].items():
-
-        logger2 = logger.bind(tooltool_sha512=info["digest"], tooltool_operation="upload", tooltool_batch_id=batch.id)
-
+    for info in body["files"].values():
         if info["algorithm"] != "sha512":
             raise werkzeug.exceptions.BadRequest("`sha512` is the only allowed digest algorithm")
 
         if not tooltool_api.utils.is_valid_sha512(info["digest"]):
             raise werkzeug.exceptions.BadRequest("Invalid sha512 digest")
+
+    # Look up every file of the batch at once, along with its instances,
+    # rather than issuing a few queries per file.
+    digests = set(info["digest"] for info in body["files"].values())
+    files = {
+        file.sha512: file
+        for file in tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512.in_(digests)).options(
+            sa.orm.selectinload(tooltool_api.models.File.instances)
+        )
+    }
+    new_files = []
+    pending_uploads = {}
+    to_sign = []
+
+    for filename, info in body["files"].items():
+
+        logger2 = logger.bind(tooltool_sha512=info["digest"], tooltool_operation="upload", tooltool_batch_id=batch.id)
+
         digest = info["digest"]
-        file = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512 == digest).first()
+        file = files.get(digest)
         if file and file.visibility != info["visibility"]:
             raise werkzeug.exceptions.BadRequest("Cannot change already existing file's visibility level.")
 
@@ -109,33 +198,37 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
                 raise werkzeug.exceptions.BadRequest(f"Size mismatch for {filename}")
         else:
             if not file:
-                file = tooltool_api.models.File(sha512=digest, visibility=info["visibility"], size=info["size"])
-                session.add(file)
-
-            logger2.info(f'Generating signed S3 PUT URL to {info["digest"][:10]} for {flask_login.current_user}; expiring in {UPLOAD_EXPIRES_IN}s')
-
-            info["put_url"] = s3.meta.client.generate_presigned_url(
-                ClientMethod="put_object",
-                ExpiresIn=UPLOAD_EXPIRES_IN,
-                Params={
-                    "Bucket": bucket,
-                    "Key": tooltool_api.utils.keyname(info["digest"]),
-                    "ContentType": "application/octet-stream",
-                },
-            )
-
-            # The PendingUpload row needs to reflect the updated expiration
-            # time, even if there's an existing pending upload that expires
-            # earlier.  The `merge` method does a SELECT and then either
-            # UPDATEs or INSERTs the row.  However, merge needs the file_id,
-            # rather than just a reference to the file object; and for that, we
-            # need to flush the inserted file.
-            session.flush()
-            expires = tooltool_api.utils.now() + datetime.timedelta(seconds=UPLOAD_EXPIRES_IN)
-            pu = tooltool_api.models.PendingUpload(file_id=file.id, region=region, expires=expires)
-            session.merge(pu)
-
-        session.add(tooltool_api.models.BatchFile(filename=filename, file=file, batch=batch))
+                # not added to the session: new files are inserted together below
+                file = files[digest] = tooltool_api.models.File(sha512=digest, visibility=info["visibility"], size=info["size"])
+                new_files.append(file)
+
+            if multipart and MULTIPART_UPLOAD_THRESHOLD and info["size"] >= MULTIPART_UPLOAD_THRESHOLD:
+                expires_in = MULTIPART_UPLOAD_EXPIRES_IN
+                logger2.info(f'Starting S3 multipart upload to {info["digest"][:10]} for {flask_login.current_user}; expiring in {expires_in}s')
+                info["multipart"] = _create_multipart_upload(s3, bucket, digest, info["size"], MULTIPART_UPLOAD_PART_SIZE, expires_in)
+            else:
+                expires_in = UPLOAD_EXPIRES_IN
+                logger2.info(f'Generating signed S3 PUT URL to {info["digest"][:10]} for {flask_login.current_user}; expiring in {expires_in}s')
+                to_sign.append(info)
+
+            expires = tooltool_api.utils.now() + datetime.timedelta(seconds=expires_in)
+            pending_uploads[digest] = dict(expires=expires, put_expires=None if "multipart" in info else expires)
+
+    # All the PUT URLs are signed together, now that we know which files need one.
+    keys = [tooltool_api.utils.keyname(info["digest"]) for info in to_sign]
+    for info, put_url in zip(
+        to_sign, flask.current_app.aws.generate_presigned_s3_put_urls(region, bucket, keys, UPLOAD_EXPIRES_IN, "application/octet-stream")
+    ):
+        info["put_url"] = put_url
+
+    # Insert the new files in one statement, which returns them with their ids.
+    # Flushing them from the session would take one INSERT per file on
+    # databases which cannot match the ids of a multi-row INSERT to the rows.
+    if new_files:
+        rows = [dict(sha512=file.sha512, visibility=file.visibility, size=file.size) for file in new_files]
+        files.update((file.sha512, file) for file in session.scalars(sa.insert(tooltool_api.models.File).returning(tooltool_api.models.File), rows))
+    session.add_all(tooltool_api.models.BatchFile(filename=filename, file=files[info["digest"]], batch=batch) for filename, info in body["files"].items())
+    _upsert_pending_uploads(session, [dict(file_id=files[digest].id, region=region, **pending) for digest, pending in pending_uploads.items()])
 
     session.add(batch)
     session.commit()
@@ -144,6 +237,84 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
     return dict(result=body)
 
 
+def complete_multipart_upload(digest: str, body: dict) -> dict:
+    if not tooltool_api.utils.is_valid_sha512(digest):
+        raise werkzeug.exceptions.BadRequest("Invalid sha512 digest")
+
+    file = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512 == digest).first()
+    if not file:
+        raise werkzeug.exceptions.NotFound
+
+    permission = f"{tooltool_api.config.SCOPE_PREFIX}/upload/{file.visibility}"
+    if not flask_login.current_user.has_permissions(permission):
+        raise werkzeug.exceptions.Forbidden(f"no permission to upload {file.visibility} files")
+
+    # once an upload has been verified, nothing may replace it
+    if not file.pending_uploads:
+        raise werkzeug.exceptions.Conflict("No upload of this file is pending")
+    pending_upload = file.pending_uploads[0]
+    if pending_upload.region in [i.region for i in file.instances]:
+        raise werkzeug.exceptions.Conflict("This file has already been uploaded")
+
+    S3_REGIONS = flask.current_app.config["S3_REGIONS"]  # type: typing.Dict[str, str]
+    if type(S3_REGIONS) is not dict:
+        raise werkzeug.exceptions.InternalServerError("S3_REGIONS should be of type dict.")
+    bucket = S3_REGIONS.get(pending_upload.region)
+    if bucket is None:
+        raise werkzeug.exceptions.InternalServerError(f"No bucket for region `{pending_upload.region}` defined.")
+
+    parts = sorted(body["parts"], key=lambda part: part["part_number"])
+    s3 = flask.current_app.aws.connect_to("s3", pending_upload.region)
+    logger.info(f"Completing S3 multipart upload of {digest[:10]} in {len(parts)} parts for {flask_login.current_user}")
+    try:
+        s3.meta.client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=tooltool_api.utils.keyname(digest),
+            UploadId=body["upload_id"],
+            MultipartUpload={"Parts": [{"PartNumber": part["part_number"], "ETag": part["etag"]} for part in parts]},
+        )
+    except botocore.exceptions.ClientError as e:
+        raise werkzeug.exceptions.BadRequest(f"Could not complete multipart upload: {e}")
+
+    # The part URLs stop working once S3 has completed the upload, so the file
+    # can be checked as soon as the PUT URLs handed out for it have expired.
+    now = tooltool_api.utils.now()
+    put_expires = pending_upload.put_expires and pending_upload.put_expires.replace(tzinfo=datetime.timezone.utc)
+    pending_upload.expires = max(now, put_expires or now)
+    flask.g.db.session.commit()
+
+    return file.to_dict()
+
+
+def _retry_after(files: typing.Iterable[tooltool_api.models.File]) -> int:
+    # if any pending upload is still valid, then we can't check its file
+    # yet; return how long to wait until all of them have expired
+    now = tooltool_api.utils.now()
+    retry_after = 0
+    for file in files:
+        for pending_upload in file.pending_uploads:
+            until = pending_upload.expires.replace(tzinfo=datetime.timezone.utc) - now
+            if until > datetime.timedelta(0):
+                # add 1 second to avoid rounding / skew errors
+                retry_after = max(retry_after, 1 + int(until.total_seconds()))
+    return retry_after
+
+
+def _publish_check_file_pending_uploads(digests: typing.List[str]) -> None:
+    if flask.current_app.config.get("DISABLE_PULSE"):
+        return
+    exchange = f'exchange/{flask.current_app.config["PULSE_USER"]}/{tooltool_api.config.PROJECT_NAME}'
+    logger.info(f"Sending digests `{digests}` to queue `{exchange}` for route `{tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS}`.")
+    try:
+        flask.current_app.pulse.publish_many(exchange, tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS, [dict(digest=digest) for digest in digests])
+    except Exception as e:
+        import traceback
+
+        msg = "Can't send notification to pulse."
+        trace = traceback.format_exc()
+        logger.error(f"{msg}\nException:{e}\nTraceback: {trace}")
+
+
 def upload_complete(digest: str) -> typing.Union[werkzeug.Response, typing.Tuple[str, int]]:
 
     if not tooltool_api.utils.is_valid_sha512(digest):
@@ -152,34 +323,52 @@ def upload_complete(digest: str) -> typing.Union[werkzeug.Response, typing.Tuple
     # if the pending upload is still valid, then we can't check this file
     # yet, so return 409 Conflict.  If there is no PU, or it's expired,
     # then we can proceed.
-    file = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512 == digest).first()
-    if file:
-        for pending_upload in file.pending_uploads:
-            until = pending_upload.expires.replace(tzinfo=datetime.timezone.utc) - tooltool_api.utils.now()
-            if until > datetime.timedelta(0):
-                # add 1 second to avoid rounding / skew errors
-                headers = {"X-Retry-After": str(1 + int(until.total_seconds()))}
-                return werkzeug.Response(status=409, headers=headers)
+    files = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512 == digest).all()
+    retry_after = _retry_after(files)
+    if retry_after:
+        return werkzeug.Response(status=409, headers={"X-Retry-After": str(retry_after)})
+
+    _publish_check_file_pending_uploads([digest])
 
-    if not flask.current_app.config.get("DISABLE_PULSE"):
-        exchange = f'exchange/{flask.current_app.config["PULSE_USER"]}/{tooltool_api.config.PROJECT_NAME}'
-        logger.info(f"Sending digest `{digest}` to queue `{exchange}` for route `{tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS}`.")
-        try:
-            flask.current_app.pulse.publish(exchange, tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS, dict(digest=digest))
-        except Exception as e:
-            import traceback
+    return "{}", 202
+
+
+def upload_complete_batch(body: dict) -> typing.Union[werkzeug.Response, typing.Tuple[str, int]]:
+    digests = list(dict.fromkeys(body["digests"]))
+    for digest in digests:
+        if not tooltool_api.utils.is_valid_sha512(digest):
+            raise werkzeug.exceptions.BadRequest(f"Invalid sha512 digest `{digest}`")
 
-            msg = "Can't send notification to pulse."
-            trace = traceback.format_exc()
-            logger.error(f"{msg}\nException:{e}\nTraceback: {trace}")
+    # as for a single file, but the whole set waits for the last of its
+    # pending uploads to expire, so that clients sleep once per batch
+    files = []
+    if digests:
+        query = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512.in_(digests))
+        files = query.options(sa.orm.selectinload(tooltool_api.models.File.pending_uploads)).all()
+    retry_after = _retry_after(files)
+    if retry_after:
+        return werkzeug.Response(status=409, headers={"X-Retry-After": str(retry_after)})
+
+    if digests:
+        _publish_check_file_pending_uploads(digests)
 
     return "{}", 202
 
 
 def search_files(q: str) -> dict:
     session = flask.g.db.session
-    query = session.query(tooltool_api.models.File).join(tooltool_api.models.BatchFile)
-    query = query.filter(sa.or_(tooltool_api.models.BatchFile.filename.contains(q), tooltool_api.models.File.sha512.startswith(q)))
+    File = tooltool_api.models.File
+    BatchFile = tooltool_api.models.BatchFile
+    # The batch files matching either way are looked up separately, so that
+    # each lookup can use its index, then joined to their files.
+    if _dialect() == "sqlite":
+        search = tooltool_api.models.batch_files_search
+        by_filename = sa.select(search.c.file_id, search.c.batch_id).where(search.c.filename.contains(q))
+    else:
+        by_filename = sa.select(BatchFile.file_id, BatchFile.batch_id).where(BatchFile.filename.contains(q))
+    by_digest = sa.select(BatchFile.file_id, BatchFile.batch_id).join(File).where(File.sha512.startswith(q))
+    matching = sa.union(by_filename, by_digest).subquery()
+    query = session.query(File).join(BatchFile).join(matching, sa.and_(BatchFile.file_id == matching.c.file_id, BatchFile.batch_id == matching.c.batch_id))
     return dict(result=[row.to_dict() for row in query.all()])
 
 
@@ -240,9 +429,7 @@ def patch_file(digest: str, body: dict) -> dict:
     return file.to_dict(include_instances=True)
 
 
-def download_file(digest: str) -> werkzeug.Response:
-    logger2 = logger.bind(tooltool_sha512=digest, tooltool_operation="download_file")
-
+def _download_config() -> typing.Tuple[int, bool]:
     dowload_expires_in = flask.current_app.config["DOWLOAD_EXPIRES_IN"]
     if type(dowload_expires_in) is not int:
         raise werkzeug.exceptions.InternalServerError("DOWLOAD_EXPIRES_IN should be of type int.")
@@ -251,20 +438,18 @@ def download_file(digest: str) -> werkzeug.Response:
     if type(allow_anonymous_public_download) is not bool:
         raise werkzeug.exceptions.InternalServerError("ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD should be of type bool.")
 
-    # see where the file is.
-    file_row = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512 == digest).first()
-    if not file_row or not file_row.instances:
-        raise werkzeug.exceptions.NotFound
+    return dowload_expires_in, allow_anonymous_public_download
 
-    # check visibility
-    if file_row.visibility != "public" or not allow_anonymous_public_download:
-        permission = f"{tooltool_api.config.SCOPE_PREFIX}/download/{file_row.visibility}"
-        if not flask_login.current_user.has_permissions(permission):
-            raise werkzeug.exceptions.Forbidden
 
-    if not tooltool_api.utils.is_valid_sha512(digest):
-        raise werkzeug.exceptions.BadRequest("Invalid sha512 digest")
+def _can_download(file_row: tooltool_api.models.File, allow_anonymous_public_download: bool) -> bool:
+    if file_row.visibility == "public" and allow_anonymous_public_download:
+        return True
+    permission = f"{tooltool_api.config.SCOPE_PREFIX}/download/{file_row.visibility}"
+    return flask_login.current_user.has_permissions(permission)
+
 
+def _download_url(file_row: tooltool_api.models.File, dowload_expires_in: int, logger2) -> str:
+    digest = file_row.sha512
     cloudfront_url = flask.current_app.config.get("CLOUDFRONT_URL")
     key = tooltool_api.utils.keyname(digest)
 
@@ -274,8 +459,7 @@ def download_file(digest: str) -> werkzeug.Response:
         keypair_id = flask.current_app.config["CLOUDFRONT_KEY_ID"]
         private_key_string = flask.current_app.config["CLOUDFRONT_PRIVATE_KEY"]
 
-        signed_url = flask.current_app.aws.generate_presigned_cloudfront_url(url, expire_time, keypair_id, private_key_string)
-        return flask.redirect(signed_url)
+        return flask.current_app.aws.generate_presigned_cloudfront_url(url, expire_time, keypair_id, private_key_string)
     else:
         s3_regions = flask.current_app.config["S3_REGIONS"]  # type: typing.Dict[str, str]
         if type(s3_regions) is not dict:
@@ -295,6 +479,55 @@ def download_file(digest: str) -> werkzeug.Response:
 
         s3 = flask.current_app.aws.connect_to("s3", selected_region)
         logger2.info(f"Generating signed S3 GET URL for {digest[:10]}, expiring in {dowload_expires_in}s")
-        signed_url = s3.meta.client.generate_presigned_url(ClientMethod="get_object", ExpiresIn=dowload_expires_in, Params={"Bucket": bucket, "Key": key})
+        return s3.meta.client.generate_presigned_url(ClientMethod="get_object", ExpiresIn=dowload_expires_in, Params={"Bucket": bucket, "Key": key})
+
+
+def download_file(digest: str) -> werkzeug.Response:
+    logger2 = logger.bind(tooltool_sha512=digest, tooltool_operation="download_file")
+
+    dowload_expires_in, allow_anonymous_public_download = _download_config()
+
+    # see where the file is.
+    file_row = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512 == digest).first()
+    if not file_row or not file_row.instances:
+        raise werkzeug.exceptions.NotFound
+
+    # check visibility
+    if not _can_download(file_row, allow_anonymous_public_download):
+        raise werkzeug.exceptions.Forbidden
+
+    if not tooltool_api.utils.is_valid_sha512(digest):
+        raise werkzeug.exceptions.BadRequest("Invalid sha512 digest")
+
+    return flask.redirect(_download_url(file_row, dowload_expires_in, logger2))
+
+
+def resolve_files(body: dict) -> dict:
+    """Sign a download URL for each of the digests at once, as `download_file`
+    would redirect to.  Digests of files which are missing, have no
+    instances or cannot be downloaded by the current user are left out, and
+    can be requested one at a time for the error."""
+    logger2 = logger.bind(tooltool_operation="resolve_files")
+
+    digests = list(dict.fromkeys(body["digests"]))
+    for digest in digests:
+        if not tooltool_api.utils.is_valid_sha512(digest):
+            raise werkzeug.exceptions.BadRequest(f"Invalid sha512 digest `{digest}`")
+
+    dowload_expires_in, allow_anonymous_public_download = _download_config()
+
+    files = []
+    if digests:
+        query = tooltool_api.models.File.query.filter(tooltool_api.models.File.sha512.in_(digests))
+        files = query.options(sa.orm.selectinload(tooltool_api.models.File.instances)).all()
+
+    result = {}
+    for file_row in files:
+        if not file_row.instances or not _can_download(file_row, allow_anonymous_public_download):
+            continue
+        info = file_row.to_dict(include_instances=True)
+        info["get_url"] = _download_url(file_row, dowload_expires_in, logger2)
+        result[file_row.sha512] = info
 
-        return flask.redirect(signed_url)
+    logger2.info(f"Resolved {len(result)} of {len(digests)} files for {flask_login.current_user}")
+    return dict(result=result)
@@ -3,40 +3,148 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
+import hmac
+import threading
+import time
+import urllib.parse
+
 import boto3
+import botocore.config
+import flask
 from botocore.signers import CloudFrontSigner
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 
 import tooltool_api.lib.log
+import tooltool_api.utils
 
 logger = tooltool_api.lib.log.get_logger(__name__)
 
 
 class AWS(object):
-    def __init__(self, access_key_id, secret_access_key):
+    def __init__(self, access_key_id, secret_access_key, max_pool_connections=None):
         self.access_key_id = access_key_id
         self.secret_access_key = secret_access_key
+        self._config = botocore.config.Config(max_pool_connections=max_pool_connections) if max_pool_connections else None
         self._sessions = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cloudfront_signers = {}
+        self._s3_signing_keys = {}
+
+    def _client(self, service_name, region_name):
+        # Building a client loads the service model, which takes far longer
+        # than using it, so there is one per service and region.  Clients
+        # are thread-safe and share a pool of connections.
+        key = (service_name, region_name)
+        with self._lock:
+            if key not in self._clients:
+                start = time.perf_counter()
+                if region_name in self._sessions:
+                    session = self._sessions[region_name]
+                else:
+                    session = boto3.Session(aws_access_key_id=self.access_key_id, aws_secret_access_key=self.secret_access_key, region_name=region_name)
+                    self._sessions[region_name] = session
+                resource = session.resource(service_name, config=self._config)
+                self._clients[key] = (type(resource), resource.meta.client)
+                logger.info(f"Built {service_name} client for {region_name} in {time.perf_counter() - start:.3f}s")
+            return self._clients[key]
 
     def connect_to(self, service_name, region_name):
-        key = region_name
-        if key in self._sessions:
-            session = self._sessions[key]
-        else:
-            session = boto3.Session(aws_access_key_id=self.access_key_id, aws_secret_access_key=self.secret_access_key, region_name=region_name)
-            self._sessions[key] = session
-        return session.resource(service_name)
+        start = time.perf_counter()
+        # Resources are not thread-safe, so each thread has its own, on the
+        # shared client.
+        resources = self._local.__dict__.setdefault("resources", {})
+        key = (service_name, region_name)
+        if key not in resources:
+            resource_class, client = self._client(service_name, region_name)
+            resources[key] = resource_class(client=client)
+
+        # the time spent here is reported with the response, see tooltool_api.create_app
+        if flask.has_request_context():
+            flask.g.aws_connect_time = flask.g.get("aws_connect_time", 0) + time.perf_counter() - start
+        return resources[key]
+
+    def _cloudfront_signer(self, keypair_id, private_key_string):
+        # Parsing the private key costs far more than signing with it, so
+        # each keypair's signer is built once, and again only if its key is
+        # rotated.
+        cached = self._cloudfront_signers.get(keypair_id)
+        if cached is not None and cached[0] == private_key_string:
+            return cached[1]
 
-    def generate_presigned_cloudfront_url(self, url, expire_time, keypair_id, private_key_string):
         # From https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#generate-a-signed-url-for-amazon-cloudfront
+        private_key = serialization.load_pem_private_key(private_key_string, password=None, backend=default_backend())
+
         def rsa_signer(message):
-            private_key = serialization.load_pem_private_key(private_key_string, password=None, backend=default_backend())
             return private_key.sign(message, padding.PKCS1v15(), hashes.SHA1())
 
+        logger.info(f"Loaded CloudFront private key for keypair {keypair_id}")
         cloudfront_signer = CloudFrontSigner(keypair_id, rsa_signer)
+        self._cloudfront_signers[keypair_id] = (private_key_string, cloudfront_signer)
+        return cloudfront_signer
+
+    def generate_presigned_cloudfront_url(self, url, expire_time, keypair_id, private_key_string):
+        cloudfront_signer = self._cloudfront_signer(keypair_id, private_key_string)
 
         # Create a signed url that will be valid until the specfic expiry date
         # provided using a canned policy.
         return cloudfront_signer.generate_presigned_url(url, date_less_than=expire_time)
+
+    def _s3_signing_key(self, secret_access_key, region_name, date):
+        # The SigV4 signing key only depends on the secret, the region and
+        # the date, so it is derived once a day per region rather than four
+        # HMACs per URL.
+        cached = self._s3_signing_keys.get(region_name)
+        if cached is not None and cached[:2] == (secret_access_key, date):
+            return cached[2]
+        key = ("AWS4" + secret_access_key).encode("utf-8")
+        for part in (date, region_name, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+        self._s3_signing_keys[region_name] = (secret_access_key, date, key)
+        return key
+
+    def generate_presigned_s3_put_urls(self, region_name, bucket, keys, expires_in, content_type):
+        """Presign PUT URLs for many objects of a bucket, as botocore would with
+        SigV4 query authentication.  Everything but the object's path is the
+        same for all the URLs, so each one only costs a hash and an HMAC."""
+        if not keys:
+            return []
+        _, client = self._client("s3", region_name)
+        credentials = self._sessions[region_name].get_credentials().get_frozen_credentials()
+
+        # botocore resolves where the bucket's objects live (virtual hosted
+        # or path style, custom endpoints); ask it once, for the first key.
+        template = urllib.parse.urlsplit(
+            client.generate_presigned_url(ClientMethod="put_object", ExpiresIn=expires_in, Params={"Bucket": bucket, "Key": keys[0]})
+        )
+        path_prefix = template.path[: -len(urllib.parse.quote(keys[0], safe="/~"))]
+
+        now = tooltool_api.utils.now()
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{amz_date[:8]}/{region_name}/s3/aws4_request"
+        params = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{credentials.access_key}/{scope}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(expires_in),
+            "X-Amz-SignedHeaders": "content-type;host",
+        }
+        if credentials.token:
+            params["X-Amz-Security-Token"] = credentials.token
+        query = "&".join(f"{name}={urllib.parse.quote(value, safe='-_.~')}" for name, value in sorted(params.items()))
+        canonical_suffix = f"\n{query}\ncontent-type:{content_type}\nhost:{template.netloc}\n\ncontent-type;host\nUNSIGNED-PAYLOAD"
+        string_to_sign_prefix = f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+        signing_key = self._s3_signing_key(credentials.secret_key, region_name, amz_date[:8])
+
+        urls = []
+        for key in keys:
+            path = path_prefix + urllib.parse.quote(key, safe="/~")
+            canonical_request = f"PUT\n{path}{canonical_suffix}"
+            string_to_sign = string_to_sign_prefix + hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+            signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+            urls.append(f"{template.scheme}://{template.netloc}{path}?{query}&X-Amz-Signature={signature}")
+        return urls
@@ -3,15 +3,20 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
 import functools
+import hashlib
+import hmac
 import json
+import re
+import threading
+import time
 import typing
 
 import flask
 import flask_login
 import flask_oidc
 import taskcluster
-import taskcluster.utils
 
 import tooltool_api.lib.db
 import tooltool_api.lib.dockerflow
@@ -80,6 +85,51 @@ class AnonymousUser(BaseUser):
         return "anonymous:"
 
 
+class ScopeSet(object):
+    """A set of Taskcluster scopes, compiled so that checking whether they
+    satisfy a scope doesn't scan all of them: exact scopes are kept in a
+    set, and the prefixes of star-scopes in a trie.  Results are memoized.
+    """
+
+    # marks the end of a star-scope's prefix in the trie
+    STAR = None
+
+    def __init__(self, scopes):
+        self._exact = set()
+        self._trie = {}
+        self._memo = {}
+        for scope in scopes:
+            if scope.endswith("*"):
+                node = self._trie
+                for char in scope[:-1]:
+                    node = node.setdefault(char, {})
+                node[self.STAR] = True
+            else:
+                self._exact.add(scope)
+
+    def _star_match(self, scope):
+        node = self._trie
+        for char in scope:
+            if self.STAR in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return self.STAR in node
+
+    def satisfies(self, scope):
+        """Same as taskcluster.utils.scopeMatch(scopes, [[scope]])."""
+        try:
+            return self._memo[scope]
+        except KeyError:
+            result = self._memo[scope] = scope in self._exact or self._star_match(scope)
+            return result
+
+    def match(self, required_scope_sets):
+        """Same as taskcluster.utils.scopeMatch(scopes, required_scope_sets)."""
+        return any(all(self.satisfies(scope) for scope in scope_set) for scope_set in required_scope_sets)
+
+
 class TaskclusterUser(BaseUser):
 
     type = "taskcluster"
@@ -121,7 +171,11 @@ class TaskclusterUser(BaseUser):
         if not isinstance(permissions[0], (tuple, list)):
             permissions = [permissions]
 
-        return taskcluster.utils.scopeMatch(self.get_permissions(), permissions)
+        return self.scope_set.match(permissions)
+
+    @functools.cached_property
+    def scope_set(self):
+        return ScopeSet(self.get_permissions())
 
 
 class Auth(object):
@@ -224,6 +278,124 @@ def initial_data():
     return dict(user=user, perms=PERMISSIONS)
 
 
+HAWK_ATTRIBUTE_RE = re.compile(r'(\w+)="([^"\\]*)"')
+
+
+class HawkVerifier(object):
+    """Verify Taskcluster Hawk headers, locally where possible.
+
+    The scopes Taskcluster returns for a clientId are cached for `scopes_ttl`
+    seconds.  While they are, requests from clients whose accessToken is in
+    `credentials` are verified here: the MAC is checked, the timestamp must
+    be within `skew` seconds of now, and a nonce can only be used once.
+    Anything else, including headers with `ext` (certificates or authorized
+    scopes), goes to Taskcluster's authenticateHawk.
+    """
+
+    def __init__(self, root_url, credentials=None, scopes_ttl=60, skew=15 * 60):
+        self.root_url = root_url
+        self.credentials = credentials or {}
+        self.scopes_ttl = scopes_ttl
+        self.skew = skew
+        self._lock = threading.Lock()
+        self._scopes = {}  # clientId -> (expires, authenticateHawk response)
+        self._nonces = {}  # (clientId, ts, nonce) -> expires
+        self._nonces_pruned = 0.0
+
+    def _seen(self, client_id, ts, nonce, now):
+        """Record the nonce, and return True if it was used before."""
+        key = (client_id, ts, nonce)
+        with self._lock:
+            if now - self._nonces_pruned > self.skew:
+                self._nonces = {k: expires for k, expires in self._nonces.items() if expires > now}
+                self._nonces_pruned = now
+            if key in self._nonces:
+                return True
+            # past this time, the timestamp is too old for the nonce to matter
+            self._nonces[key] = int(ts) + self.skew
+            return False
+
+    def _cached_scopes(self, client_id, now):
+        with self._lock:
+            cached = self._scopes.get(client_id)
+        if cached is None or cached[0] <= now:
+            return None
+        return cached[1]
+
+    def _verify_locally(self, attributes, payload, now):
+        """Return the cached response for a valid header, NO_AUTH for an
+        invalid one, or None when the header can't be verified here."""
+        client_id = attributes["id"]
+        if client_id not in self.credentials or "ext" in attributes:
+            return None
+        resp = self._cached_scopes(client_id, now)
+        if resp is None:
+            return None
+
+        if abs(now - int(attributes["ts"])) > self.skew:
+            logger.warning(f"Hawk timestamp of {client_id} is too far from now")
+            return NO_AUTH
+        normalized = "\n".join(
+            [
+                "hawk.1.header",
+                attributes["ts"],
+                attributes["nonce"],
+                payload["method"].upper(),
+                payload["resource"],
+                payload["host"].lower(),
+                str(payload["port"]),
+                attributes.get("hash", ""),
+                "",
+                "",
+            ]
+        )
+        mac = hmac.new(self.credentials[client_id].encode("utf-8"), normalized.encode("utf-8"), hashlib.sha256).digest()
+        if not hmac.compare_digest(base64.b64encode(mac).decode("ascii"), attributes["mac"]):
+            logger.warning(f"Invalid Hawk MAC for {client_id}")
+            return NO_AUTH
+        return resp
+
+    def _verify_remotely(self, payload):
+        auth = taskcluster.Auth(dict(rootUrl=self.root_url))
+        resp = auth.authenticateHawk(payload)
+        if not resp.get("status") == "auth-success":
+            raise Exception("Taskcluster rejected the authentication")
+        return resp
+
+    def verify(self, payload):
+        """Return the authenticateHawk response for a valid header, or
+        NO_AUTH."""
+        now = time.time()
+        attributes = dict(HAWK_ATTRIBUTE_RE.findall(payload["authorization"]))
+        if not all(k in attributes for k in ("id", "ts", "nonce", "mac")) or not attributes["ts"].isdigit():
+            logger.warning("Malformed Hawk header")
+            return NO_AUTH
+
+        resp = self._verify_locally(attributes, payload, now)
+        if resp is NO_AUTH:
+            return NO_AUTH
+        if resp is not None:
+            if self._seen(attributes["id"], attributes["ts"], attributes["nonce"], now):
+                logger.warning(f"Replayed Hawk nonce for {attributes['id']}")
+                return NO_AUTH
+            return resp
+
+        try:
+            resp = self._verify_remotely(payload)
+        except Exception as e:
+            logger.warning(f"TC auth error: {e}")
+            logger.warning(f"TC auth details: {payload}")
+            return NO_AUTH
+        if "ext" not in attributes:
+            with self._lock:
+                self._scopes[resp["clientId"]] = (now + self.scopes_ttl, resp)
+        # Taskcluster doesn't keep track of nonces, but the header can't be
+        # replayed once it would be verified here
+        if attributes["id"] in self.credentials:
+            self._seen(attributes["id"], attributes["ts"], attributes["nonce"], now)
+        return resp
+
+
 def parse_header_taskcluster(request):
     auth_header = request.headers.get("Authorization")
     if not auth_header:
@@ -245,16 +417,12 @@ def parse_header_taskcluster(request):
 
     # Build taskcluster payload
     payload = {"resource": request.path, "method": method, "host": host, "port": int(port), "authorization": auth_header}
+    if request.query_string:
+        payload["resource"] += "?" + request.query_string.decode("utf-8")
 
     # Auth with taskcluster
-    auth = taskcluster.Auth(dict(rootUrl=flask.current_app.config["TASKCLUSTER_ROOT_URL"]))
-    try:
-        resp = auth.authenticateHawk(payload)
-        if not resp.get("status") == "auth-success":
-            raise Exception("Taskcluster rejected the authentication")
-    except Exception as e:
-        logger.warning(f"TC auth error: {e}")
-        logger.warning(f"TC auth details: {payload}")
+    resp = flask.current_app.extensions["hawk_verifier"].verify(payload)
+    if resp is NO_AUTH:
         return NO_AUTH
 
     return TaskclusterUser(resp)
@@ -285,6 +453,11 @@ def init_app(app):
         raise Exception("When using `auth` extention you need to specify SECRET_KEY.")
 
     auth.init_app(app)
+    app.extensions["hawk_verifier"] = HawkVerifier(
+        app.config.get("TASKCLUSTER_ROOT_URL"),
+        credentials=app.config.get("TASKCLUSTER_LOCAL_CREDENTIALS"),
+        scopes_ttl=app.config.get("TASKCLUSTER_SCOPES_TTL", 60),
+    )
 
     app.add_url_rule("/__permissions__", view_func=get_permissions)
 
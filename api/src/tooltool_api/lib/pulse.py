@@ -131,18 +131,22 @@ class Pulse(object):
                 connection.close()
 
     def publish(self, exchange_name, routing_key, payload):
+        self.publish_many(exchange_name, routing_key, [payload])
+
+    def publish_many(self, exchange_name, routing_key, payloads):
+        """Publish a message for each payload, over a single connection."""
         with self.connection as connection:
             if not connection.connected:
                 connection.connect()
 
             exchange = kombu.Exchange(exchange_name, type="topic")
-            message = {
-                "payload": payload,
-                "_meta": {"exchange": exchange_name, "routing_key": routing_key, "serializer": "json", "sent": datetime.datetime.utcnow().isoformat()},
-            }
-
             producer = connection.Producer(exchange=exchange, routing_key=routing_key, serializer="json")
-            producer.publish(message)
+            for payload in payloads:
+                message = {
+                    "payload": payload,
+                    "_meta": {"exchange": exchange_name, "routing_key": routing_key, "serializer": "json", "sent": datetime.datetime.utcnow().isoformat()},
+                }
+                producer.publish(message)
             connection.close()
 
 
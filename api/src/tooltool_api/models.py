@@ -22,6 +22,10 @@ class File(tooltool_api.lib.db.db.Model):
     sha512 = sa.Column(sa.String(128), unique=True, nullable=False)
     visibility = sa.Column(sa.Enum("public", "internal", name="visibility"), nullable=False)
 
+    __table_args__ = (
+        sa.Index("ix_releng_tooltool_files_sha512_pattern", "sha512", postgresql_ops={"sha512": "varchar_pattern_ops"}).ddl_if(dialect="postgresql"),
+    )
+
     instances = sa.orm.relationship("FileInstance", backref="file")
     _batches = sa.orm.relationship("BatchFile", back_populates="file")
 
@@ -48,6 +52,15 @@ class Batch(tooltool_api.lib.db.db.Model):
     author = sa.Column(sa.Text, nullable=False)
     message = sa.Column(sa.Text, nullable=False)
 
+    __table_args__ = (
+        sa.Index("ix_releng_tooltool_batches_author_trgm", "author", postgresql_using="gin", postgresql_ops={"author": "gin_trgm_ops"}).ddl_if(
+            dialect="postgresql"
+        ),
+        sa.Index("ix_releng_tooltool_batches_message_trgm", "message", postgresql_using="gin", postgresql_ops={"message": "gin_trgm_ops"}).ddl_if(
+            dialect="postgresql"
+        ),
+    )
+
     _files = sa.orm.relationship("BatchFile", back_populates="batch")
 
     # note that changes to this dictionary will not be reflected to the DB;
@@ -86,6 +99,12 @@ class BatchFile(tooltool_api.lib.db.db.Model):
     batch = sa.orm.relationship("Batch", back_populates="_files")
     filename = sa.Column(sa.Text, nullable=False)
 
+    __table_args__ = (
+        sa.Index("ix_releng_tooltool_batch_files_filename_trgm", "filename", postgresql_using="gin", postgresql_ops={"filename": "gin_trgm_ops"}).ddl_if(
+            dialect="postgresql"
+        ),
+    )
+
 
 class PendingUpload(tooltool_api.lib.db.db.Model):
     """Files for which upload URLs have been generated, but which haven't yet
@@ -98,6 +117,53 @@ class PendingUpload(tooltool_api.lib.db.db.Model):
 
     file_id = sa.Column(sa.Integer, sa.ForeignKey("releng_tooltool_files.id"), nullable=False, primary_key=True)
     expires = sa.Column(sa.DateTime, index=True, nullable=False)
+    # when the last PUT URL handed out for the file expires, if any; the part
+    # URLs of a multipart upload may expire later, or stop working earlier
+    put_expires = sa.Column(sa.DateTime, nullable=True)
     region = sa.Column(sa.Enum(*ALLOWED_REGIONS, name="region"), nullable=False)
 
     file = sa.orm.relationship("File", backref="pending_uploads")
+
+
+# SQLite has no index for substring searches, so there they go through these
+# FTS5 tables, which are kept up to date with triggers.  The batches' rowids
+# are their ids.  The 3f1c9a7be2d4 migration creates them in existing
+# databases; these statements are for databases created with `create_all`.
+batches_search = sa.table("releng_tooltool_batches_search", sa.column("rowid"), sa.column("author"), sa.column("message"))
+batch_files_search = sa.table("releng_tooltool_batch_files_search", sa.column("filename"), sa.column("file_id"), sa.column("batch_id"))
+
+_SQLITE_SEARCH_DDL = {
+    Batch.__table__: [
+        "CREATE VIRTUAL TABLE releng_tooltool_batches_search USING fts5(author, message, tokenize='trigram')",
+        """CREATE TRIGGER releng_tooltool_batches_search_insert AFTER INSERT ON releng_tooltool_batches BEGIN
+            INSERT INTO releng_tooltool_batches_search (rowid, author, message) VALUES (new.id, new.author, new.message);
+        END""",
+        """CREATE TRIGGER releng_tooltool_batches_search_update AFTER UPDATE ON releng_tooltool_batches BEGIN
+            UPDATE releng_tooltool_batches_search SET rowid = new.id, author = new.author, message = new.message WHERE rowid = old.id;
+        END""",
+        """CREATE TRIGGER releng_tooltool_batches_search_delete AFTER DELETE ON releng_tooltool_batches BEGIN
+            DELETE FROM releng_tooltool_batches_search WHERE rowid = old.id;
+        END""",
+    ],
+    BatchFile.__table__: [
+        "CREATE VIRTUAL TABLE releng_tooltool_batch_files_search USING fts5(filename, file_id UNINDEXED, batch_id UNINDEXED, tokenize='trigram')",
+        """CREATE TRIGGER releng_tooltool_batch_files_search_insert AFTER INSERT ON releng_tooltool_batch_files BEGIN
+            INSERT INTO releng_tooltool_batch_files_search (filename, file_id, batch_id) VALUES (new.filename, new.file_id, new.batch_id);
+        END""",
+        """CREATE TRIGGER releng_tooltool_batch_files_search_update AFTER UPDATE ON releng_tooltool_batch_files BEGIN
+            UPDATE releng_tooltool_batch_files_search SET filename = new.filename, file_id = new.file_id, batch_id = new.batch_id
+            WHERE file_id = old.file_id AND batch_id = old.batch_id;
+        END""",
+        """CREATE TRIGGER releng_tooltool_batch_files_search_delete AFTER DELETE ON releng_tooltool_batch_files BEGIN
+            DELETE FROM releng_tooltool_batch_files_search WHERE file_id = old.file_id AND batch_id = old.batch_id;
+        END""",
+    ],
+}
+
+for table, search in ((Batch.__table__, batches_search), (BatchFile.__table__, batch_files_search)):
+    # PostgreSQL's trigram indexes, declared above, need the extension
+    sa.event.listen(table, "before_create", sa.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+    for statement in _SQLITE_SEARCH_DDL[table]:
+        sa.event.listen(table, "after_create", sa.DDL(statement).execute_if(dialect="sqlite"))
+    # the triggers are dropped along with the table
+    sa.event.listen(table, "before_drop", sa.DDL(f"DROP TABLE IF EXISTS {search.name}").execute_if(dialect="sqlite"))
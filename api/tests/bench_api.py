@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Microbenchmarks for the tooltool API, under the Flask test client.
+
+Run as `python tests/bench_api.py [options]` from the api directory, with
+src on PYTHONPATH; this is not part of the test suite."""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import random
+import threading
+import time
+
+import logbook
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import tooltool_api.lib.auth
+
+
+def make_app(extra_config):
+    import tooltool_api
+
+    config = {
+        "APP_TESTING": True,
+        "SECRET_KEY": os.urandom(24),
+        "APP_TEMPLATES_FOLDER": "",
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "TASKCLUSTER_AUTH": True,
+        "TASKCLUSTER_ROOT_URL": "http://taskcluster.mock",
+        "S3_REGIONS_ACCESS_KEY_ID": "mock access key id",
+        "S3_REGIONS_SECRET_ACCESS_KEY": "mock secret access key",
+        "UPLOAD_EXPIRES_IN": 60,
+        "DOWLOAD_EXPIRES_IN": 60,
+        "S3_REGIONS": {"us-east-1": "bucket"},
+        "DISABLE_PULSE": True,
+        "ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD": True,
+    }
+    config.update(extra_config)
+    app = tooltool_api.create_app(config=config)
+    with app.app_context():
+        app.db.create_all()
+    # creating the app sets up logging to stderr, which would dominate
+    logbook.NullHandler().push_application()
+    return app
+
+
+def add_files(app, count):
+    import tooltool_api.models
+
+    digests = []
+    with app.app_context():
+        session = app.db.session
+        for i in range(count):
+            digest = hashlib.sha512(str(i).encode("utf-8")).hexdigest()
+            file = tooltool_api.models.File(sha512=digest, visibility="public", size=i)
+            session.add(file)
+            session.flush()
+            session.add(tooltool_api.models.FileInstance(file_id=file.id, region="us-east-1"))
+            digests.append(digest)
+        session.commit()
+    return digests
+
+
+def cloudfront_config():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption())
+    return {"CLOUDFRONT_URL": "cdn.example.com", "CLOUDFRONT_KEY_ID": "KEYPAIR", "CLOUDFRONT_PRIVATE_KEY": pem}
+
+
+def download(app, digests, forget_signers=False, forget_clients=False):
+    def run():
+        with app.test_client() as client:
+            for digest in digests:
+                if forget_signers:
+                    # what every request cost before signers were cached
+                    app.aws._cloudfront_signers.clear()
+                if forget_clients:
+                    # what every request cost before clients were cached
+                    app.aws._clients.clear()
+                    app.aws._local.__dict__.clear()
+                resp = client.get(f"/sha512/{digest}")
+                assert resp.status_code == 302, resp.status_code
+
+    return run
+
+
+class AuthHandler(http.server.BaseHTTPRequestHandler):
+    """A stand-in for the taskcluster auth service's authenticateHawk, which
+    accepts every header after `latency` seconds."""
+
+    latency = 0.0
+
+    def log_request(self, code=None, size=None):
+        pass
+
+    def do_POST(self):
+        assert self.path == "/api/auth/v1/authenticate-hawk", self.path
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        client_id = dict(tooltool_api.lib.auth.HAWK_ATTRIBUTE_RE.findall(payload["authorization"]))["id"]
+        time.sleep(self.latency)
+        body = json.dumps({"status": "auth-success", "clientId": client_id, "scheme": "hawk", "scopes": ["project:releng:services/tooltool/*"]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_auth_service(latency):
+    AuthHandler.latency = latency
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), AuthHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}"
+
+
+def hawk_header(client_id, access_token, method, resource, host="localhost", port=80):
+    ts = str(int(time.time()))
+    nonce = str(random.getrandbits(64))
+    normalized = "\n".join(["hawk.1.header", ts, nonce, method.upper(), resource, host, str(port), "", "", ""])
+    mac = base64.b64encode(hmac.new(access_token.encode("utf-8"), normalized.encode("utf-8"), hashlib.sha256).digest()).decode("ascii")
+    return f'Hawk mac="{mac}", id="{client_id}", ts="{ts}", nonce="{nonce}"'
+
+
+def authenticated(app, count):
+    def run():
+        with app.test_client() as client:
+            for _ in range(count):
+                header = hawk_header("project/releng/bench", "sekrit", "get", "/__permissions__")
+                resp = client.get("/__permissions__", headers=[("Authorization", header)])
+                assert json.loads(resp.data)["user_id"] == "project/releng/bench", resp.data
+
+    return run
+
+
+def upload(app, batch_size, count):
+    def run():
+        with app.test_client() as client:
+            for _ in range(count):
+                files = {}
+                for i in range(batch_size):
+                    digest = hashlib.sha512(os.urandom(16)).hexdigest()
+                    files[f"{i}.bin"] = {"size": i, "digest": digest, "algorithm": "sha512", "visibility": "public"}
+                header = hawk_header("project/releng/bench", "sekrit", "post", "/upload")
+                resp = client.post("/upload", json={"message": "bench", "files": files}, headers=[("Authorization", header)])
+                assert resp.status_code == 200, resp.data
+
+    return run
+
+
+def check_permissions(scopes, permissions, compiled):
+    import taskcluster.utils
+
+    def run():
+        if compiled:
+            # a user object per request, as when serving requests
+            user = tooltool_api.lib.auth.TaskclusterUser({"clientId": "project/releng/bench", "scopes": scopes})
+            for permission in permissions:
+                user.has_permissions(permission)
+        else:
+            for permission in permissions:
+                taskcluster.utils.scopeMatch(scopes, [[permission]])
+
+    return run
+
+
+def bench(name, count, func, repeat, unit="requests/s", scale=1.0, latency=False):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    value = best / count * 1000.0 if latency else count / best / scale
+    print("%-40s %10.1f %s  (%.3fs)" % (name, value, unit, best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500, help="number of requests per run")
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of this many runs")
+    parser.add_argument("--scopes", type=int, default=2000, help="number of scopes, of each kind, the benchmarked client has")
+    parser.add_argument("--batch-sizes", default="1,10,100,500", help="comma-separated numbers of files per upload batch")
+    parser.add_argument("--auth-latency", type=float, default=20.0, help="round trip to the stand-in auth service, in ms")
+    options = parser.parse_args()
+
+    app = make_app(cloudfront_config())
+    digests = add_files(app, options.requests)
+    print(f"signing {options.requests} CloudFront download URLs")
+    bench("GET /sha512/<digest>, key parsed per request", len(digests), download(app, digests, forget_signers=True), options.repeat)
+    bench("GET /sha512/<digest>, cached signer", len(digests), download(app, digests), options.repeat)
+
+    app = make_app({})
+    digests = add_files(app, options.requests)
+    print(f"signing {options.requests} S3 download URLs")
+    bench("GET /sha512/<digest>, client per request", len(digests), download(app, digests, forget_clients=True), options.repeat)
+    bench("GET /sha512/<digest>, cached client", len(digests), download(app, digests), options.repeat)
+
+    scopes = [f"project:releng:scope-{i}" for i in range(options.scopes)] + [f"queue:route:index.{i}.*" for i in range(options.scopes)]
+    permissions = list(tooltool_api.lib.auth.PERMISSIONS) * 4
+    print(f"checking {len(permissions)} permissions of a client with {len(scopes)} scopes")
+    bench("scopeMatch", len(permissions), check_permissions(scopes, permissions, False), options.repeat, unit="checks/s")
+    bench("TaskclusterUser.has_permissions", len(permissions), check_permissions(scopes, permissions, True), options.repeat, unit="checks/s")
+
+    root_url = start_auth_service(options.auth_latency / 1000.0)
+    print(f"authenticating {options.requests} requests, {options.auth_latency:.0f}ms from the auth service")
+    app = make_app({"TASKCLUSTER_ROOT_URL": root_url})
+    bench("Hawk, verified by the auth service", options.requests, authenticated(app, options.requests), options.repeat)
+    app = make_app({"TASKCLUSTER_ROOT_URL": root_url, "TASKCLUSTER_LOCAL_CREDENTIALS": {"project/releng/bench": "sekrit"}})
+    bench("Hawk, verified locally", options.requests, authenticated(app, options.requests), options.repeat)
+
+    batches = max(1, options.requests // 50)
+    print(f"uploading {batches} batches of new files, authenticated locally")
+    for batch_size in [int(size) for size in options.batch_sizes.split(",")]:
+        bench(f"POST /upload, {batch_size} files", batches, upload(app, batch_size, batches), options.repeat, unit="ms/batch", latency=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -255,3 +255,334 @@ def test_heartbeat(real_client):
     resp = real_client.get("/__heartbeat__")
     assert resp.status_code == 200
     assert resp.text == "OK"
+
+
+def test_multipart_upload(real_client, bucket, mocker, real_app):
+    mocker.patch.dict(real_app.config, {"MULTIPART_UPLOAD_THRESHOLD": 1024 * 1024, "MULTIPART_UPLOAD_PART_SIZE": 5 * 1024 * 1024})
+    data = os.urandom(6 * 1024 * 1024)
+    digest = hashlib.sha512(data).hexdigest()
+    header = build_header("test/user@mozilla.com", {"scopes": ["project:releng:services/tooltool/api/upload/public"]})
+    batch = {
+        "message": "multipart upload",
+        "files": {
+            "big.bin": {"size": len(data), "digest": digest, "algorithm": "sha512", "visibility": "public"},
+            "small.txt": {"size": 1, "digest": DIGEST, "algorithm": "sha512", "visibility": "public"},
+        },
+    }
+
+    # clients which do not ask for it never get multipart uploads
+    resp = real_client.post("/upload", json=batch, headers=[("Authorization", header)])
+    assert resp.status_code == 200
+    assert "put_url" in resp.json["result"]["files"]["big.bin"]
+
+    resp = real_client.post("/upload", json=batch, headers=[("Authorization", header), ("X-Tooltool-Multipart", "true")])
+    assert resp.status_code == 200
+    files = resp.json["result"]["files"]
+    assert "put_url" in files["small.txt"]
+    assert "put_url" not in files["big.bin"]
+    multipart = files["big.bin"]["multipart"]
+    assert multipart["part_size"] == 5 * 1024 * 1024
+    assert len(multipart["part_urls"]) == 2
+
+    with moto.mock_aws():
+        parts = []
+        for number, url in enumerate(multipart["part_urls"], 1):
+            offset = (number - 1) * multipart["part_size"]
+            resp = requests.put(url, data[offset : offset + multipart["part_size"]])
+            assert resp.status_code == 200
+            parts.append({"part_number": number, "etag": resp.headers["ETag"]})
+
+        # anonymous users cannot complete uploads
+        flask.g.pop("_login_user", None)
+        resp = real_client.post(f"/upload/multipart/sha512/{digest}", json={"upload_id": multipart["upload_id"], "parts": parts})
+        assert resp.status_code == 403
+
+        flask.g.pop("_login_user", None)
+        resp = real_client.post(
+            f"/upload/multipart/sha512/{digest}",
+            json={"upload_id": multipart["upload_id"], "parts": [{"part_number": 1, "etag": '"0123"'}, parts[1]]},
+            headers=[("Authorization", header)],
+        )
+        assert resp.status_code == 400
+
+        flask.g.pop("_login_user", None)
+        resp = real_client.post(
+            f"/upload/multipart/sha512/{digest}",
+            json={"upload_id": multipart["upload_id"], "parts": list(reversed(parts))},
+            headers=[("Authorization", header)],
+        )
+        assert resp.status_code == 200
+        assert resp.json["digest"] == digest
+
+        # the PUT URL handed out by the first batch is still valid
+        resp = real_client.get(f"/upload/complete/sha512/{digest}")
+        assert resp.status_code == 409
+        assert int(resp.headers["X-Retry-After"]) <= 61
+
+        fake_now = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=61)
+        mocker.patch("tooltool_api.utils.now", lambda: fake_now)
+        runner = real_app.test_cli_runner()
+        result = runner.invoke(args="check-pending-uploads")
+        assert result.exception is None
+        assert f"Upload of {digest} considered valid" in result.output
+
+        # nothing can replace a verified upload
+        flask.g.pop("_login_user", None)
+        resp = real_client.post(
+            f"/upload/multipart/sha512/{digest}",
+            json={"upload_id": multipart["upload_id"], "parts": parts},
+            headers=[("Authorization", header)],
+        )
+        assert resp.status_code == 409
+
+    resp = real_client.get(f"/file/sha512/{digest}")
+    assert resp.json["instances"] == ["us-east-1"]
+
+
+def test_multipart_upload_complete(real_client, bucket, mocker, real_app):
+    mocker.patch.dict(
+        real_app.config,
+        {"MULTIPART_UPLOAD_THRESHOLD": 1024 * 1024, "MULTIPART_UPLOAD_PART_SIZE": 5 * 1024 * 1024, "MULTIPART_UPLOAD_EXPIRES_IN": 3600},
+    )
+    data = os.urandom(2 * 1024 * 1024)
+    digest = hashlib.sha512(data).hexdigest()
+    header = build_header("test/user@mozilla.com", {"scopes": ["project:releng:services/tooltool/api/upload/public"]})
+    batch = {
+        "message": "multipart upload",
+        "files": {"big.bin": {"size": len(data), "digest": digest, "algorithm": "sha512", "visibility": "public"}},
+    }
+    resp = real_client.post("/upload", json=batch, headers=[("Authorization", header), ("X-Tooltool-Multipart", "true")])
+    assert resp.status_code == 200
+    multipart = resp.json["result"]["files"]["big.bin"]["multipart"]
+
+    with moto.mock_aws():
+        (url,) = multipart["part_urls"]
+        resp = requests.put(url, data)
+        assert resp.status_code == 200
+        parts = [{"part_number": 1, "etag": resp.headers["ETag"]}]
+
+        # the part URLs stay valid for an hour, but not past the completion
+        resp = real_client.get(f"/upload/complete/sha512/{digest}")
+        assert resp.status_code == 409
+        assert int(resp.headers["x-retry-after"]) > 3000
+
+        flask.g.pop("_login_user", None)
+        resp = real_client.post(
+            f"/upload/multipart/sha512/{digest}", json={"upload_id": multipart["upload_id"], "parts": parts}, headers=[("Authorization", header)]
+        )
+        assert resp.status_code == 200
+
+        resp = real_client.get(f"/upload/complete/sha512/{digest}")
+        assert resp.status_code == 202
+        resp = real_client.post("/upload/complete", json={"digests": [digest]})
+        assert resp.status_code == 202
+
+        runner = real_app.test_cli_runner()
+        result = runner.invoke(args="check-pending-uploads")
+        assert result.exception is None
+        assert f"Upload of {digest} considered valid" in result.output
+
+
+def test_upload_complete_batch(real_client, bucket, mocker, real_app):
+    data = os.urandom(16)
+    digest = hashlib.sha512(data).hexdigest()
+    header = build_header("test/user@mozilla.com", {"scopes": ["project:releng:services/tooltool/api/upload/public"]})
+    batch = {
+        "message": "batched completion",
+        "files": {
+            "test.txt": {"size": 1, "digest": DIGEST, "algorithm": "sha512", "visibility": "public"},
+            "data.bin": {"size": len(data), "digest": digest, "algorithm": "sha512", "visibility": "public"},
+        },
+    }
+    resp = real_client.post("/upload", json=batch, headers=[("Authorization", header)])
+    assert resp.status_code == 200
+    files = resp.json["result"]["files"]
+
+    resp = real_client.post("/upload/complete", json={"digests": [DIGEST, "abc"]})
+    assert resp.status_code == 400
+
+    pulse = mocker.patch.object(real_app, "pulse", create=True)
+    mocker.patch.dict(real_app.config, {"DISABLE_PULSE": False, "PULSE_USER": "pulse-user"})
+    with moto.mock_aws():
+        for content, file in ((b"\n", files["test.txt"]), (data, files["data.bin"])):
+            resp = requests.put(file["put_url"], content, headers={"Content-Type": "application/octet-stream"})
+            assert resp.status_code == 200
+
+        resp = real_client.post("/upload/complete", json={"digests": [DIGEST, digest]})
+        assert resp.status_code == 409
+        assert 0 < int(resp.headers["x-retry-after"]) <= 61
+        pulse.publish_many.assert_not_called()
+
+        fake_now = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=int(resp.headers["x-retry-after"]))
+        mocker.patch("tooltool_api.utils.now", lambda: fake_now)
+        resp = real_client.post("/upload/complete", json={"digests": [DIGEST, digest, DIGEST]})
+        assert resp.status_code == 202
+        pulse.publish_many.assert_called_once_with("exchange/pulse-user/tooltool_api", "check_file_pending_uploads", [{"digest": DIGEST}, {"digest": digest}])
+
+        runner = real_app.test_cli_runner()
+        result = runner.invoke(args="check-pending-uploads")
+        assert result.exception is None
+        assert f"Upload of {DIGEST} considered valid" in result.output
+        assert f"Upload of {digest} considered valid" in result.output
+
+
+def test_resolve_files(real_client, bucket, mocker, real_app):
+    data = os.urandom(16)
+    digest = hashlib.sha512(data).hexdigest()
+    missing = hashlib.sha512(b"missing").hexdigest()
+    scopes = ["project:releng:services/tooltool/api/upload/public", "project:releng:services/tooltool/api/upload/internal"]
+    header = build_header("test/user@mozilla.com", {"scopes": scopes})
+    batch = {
+        "message": "resolve",
+        "files": {
+            "test.txt": {"size": 1, "digest": DIGEST, "algorithm": "sha512", "visibility": "public"},
+            "data.bin": {"size": len(data), "digest": digest, "algorithm": "sha512", "visibility": "internal"},
+        },
+    }
+    resp = real_client.post("/upload", json=batch, headers=[("Authorization", header)])
+    assert resp.status_code == 200
+    files = resp.json["result"]["files"]
+
+    resp = real_client.post("/resolve", json={"digests": [DIGEST, "abc"]})
+    assert resp.status_code == 400
+
+    with moto.mock_aws():
+        # nothing can be downloaded before it is uploaded
+        resp = real_client.post("/resolve", json={"digests": [DIGEST, digest]})
+        assert resp.status_code == 200
+        assert resp.json == {"result": {}}
+
+        for content, file in ((b"\n", files["test.txt"]), (data, files["data.bin"])):
+            resp = requests.put(file["put_url"], content, headers={"Content-Type": "application/octet-stream"})
+            assert resp.status_code == 200
+        fake_now = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=61)
+        mocker.patch("tooltool_api.utils.now", lambda: fake_now)
+        result = real_app.test_cli_runner().invoke(args="check-pending-uploads")
+        assert result.exception is None
+
+        # anonymous users only get public files
+        flask.g.pop("_login_user", None)
+        resp = real_client.post("/resolve", json={"digests": [DIGEST, digest, missing]})
+        assert resp.status_code == 200
+        result = resp.json["result"]
+        assert list(result) == [DIGEST]
+        assert result[DIGEST]["size"] == 1
+        assert result[DIGEST]["instances"] == ["us-east-1"]
+        assert requests.get(result[DIGEST]["get_url"]).content == b"\n"
+
+        flask.g.pop("_login_user", None)
+        header = build_header("test/user@mozilla.com", {"scopes": ["project:releng:services/tooltool/api/download/internal"]})
+        resp = real_client.post("/resolve", json={"digests": [DIGEST, digest, missing]}, headers=[("Authorization", header)])
+        assert resp.status_code == 200
+        result = resp.json["result"]
+        assert sorted(result) == sorted([DIGEST, digest])
+        assert requests.get(result[digest]["get_url"]).content == data
+
+        # the links are those the per-file endpoint redirects to
+        resp = real_client.get(f"/sha512/{digest}", headers=[("Authorization", header)])
+        assert resp.status_code == 302
+        assert resp.headers["Location"].split("?")[0] == result[digest]["get_url"].split("?")[0]
+
+
+def test_upload_batch_bulk(real_client, bucket, mocker, real_app):
+    import sqlalchemy as sa
+
+    import tooltool_api.models
+
+    header = build_header("test/user@mozilla.com", {"scopes": ["project:releng:services/tooltool/api/upload/public"]})
+    resp = real_client.post(
+        "/upload",
+        json={"message": "first", "files": {"test.txt": {"size": 1, "digest": DIGEST, "algorithm": "sha512", "visibility": "public"}}},
+        headers=[("Authorization", header)],
+    )
+    assert resp.status_code == 200
+    first_expires = tooltool_api.models.PendingUpload.query.one().expires
+
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def upload(message, count):
+        files = {"again.txt": {"size": 1, "digest": DIGEST, "algorithm": "sha512", "visibility": "public"}}
+        for i in range(count):
+            digest = hashlib.sha512(f"{message}-{i}".encode("utf-8")).hexdigest()
+            files[f"{i}.bin"] = {"size": i, "digest": digest, "algorithm": "sha512", "visibility": "public"}
+        flask.g.pop("_login_user", None)
+        header = build_header("test/user@mozilla.com", {"scopes": ["project:releng:services/tooltool/api/upload/public"]})
+        del statements[:]
+        resp = real_client.post("/upload", json={"message": message, "files": files}, headers=[("Authorization", header)])
+        assert resp.status_code == 200, resp.json
+        return len(statements)
+
+    fake_now = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    mocker.patch("tooltool_api.utils.now", lambda: fake_now)
+    engine = real_app.db.engine
+    sa.event.listen(engine, "before_cursor_execute", count_statements)
+    try:
+        small = upload("small", 2)
+        large = upload("large", 50)
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", count_statements)
+    assert small == large
+
+    # the existing pending upload was extended, and one was added per new file
+    real_app.db.session.expire_all()
+    pending = {pu.file.sha512: pu for pu in tooltool_api.models.PendingUpload.query}
+    assert len(pending) == 1 + 2 + 50
+    assert pending[DIGEST].expires > first_expires
+    assert {pu.region for pu in pending.values()} == {"us-east-1"}
+
+    batch = tooltool_api.models.Batch.query.filter_by(message="large").one()
+    assert len(batch.files) == 51
+    assert batch.files["again.txt"].sha512 == DIGEST
+
+
+def test_search_substrings(real_client, bucket, real_app):
+    import tooltool_api.models
+
+    digests = [hashlib.sha512(f"{i}".encode("utf-8")).hexdigest() for i in range(3)]
+    batches = [
+        ("first upload of the toolchain", {"clang-17.tar.xz": digests[0], "cmake.tar.gz": digests[1]}),
+        ("second upload", {"clang-18.tar.xz": digests[2], "cmake-again.tar.gz": digests[1]}),
+    ]
+    for message, files in batches:
+        flask.g.pop("_login_user", None)
+        header = build_header("test/user@mozilla.com", {"scopes": ["project:releng:services/tooltool/api/upload/public"]})
+        files = {filename: {"size": 1, "digest": digest, "algorithm": "sha512", "visibility": "public"} for filename, digest in files.items()}
+        resp = real_client.post("/upload", json={"message": message, "files": files}, headers=[("Authorization", header)])
+        assert resp.status_code == 200
+
+    def search_batches(q):
+        resp = real_client.get("/upload", query_string={"q": q})
+        assert resp.status_code == 200
+        return sorted(batch["message"] for batch in resp.json["result"])
+
+    def search_files(q):
+        resp = real_client.get("/file", query_string={"q": q})
+        assert resp.status_code == 200
+        return sorted(file["digest"] for file in resp.json["result"])
+
+    assert search_batches("upload") == ["first upload of the toolchain", "second upload"]
+    assert search_batches("toolchain") == ["first upload of the toolchain"]
+    assert search_batches("user@moz") == ["first upload of the toolchain", "second upload"]
+    # shorter than a trigram
+    assert search_batches("nd") == ["second upload"]
+    assert search_batches("nothing like it") == []
+
+    assert search_files("ang-1") == sorted([digests[0], digests[2]])
+    assert search_files("18") == [digests[2]]
+    # once, though it was uploaded in two batches under matching names
+    assert search_files("cmake") == [digests[1]]
+    assert search_files("again") == [digests[1]]
+    assert search_files(digests[2][:10]) == [digests[2]]
+    assert search_files("xyz") == []
+
+    # the indexes follow changes to the batches
+    batch = tooltool_api.models.Batch.query.filter_by(message="second upload").one()
+    batch.message = "renamed"
+    real_app.db.session.delete(batch._files[0])
+    real_app.db.session.commit()
+    assert search_batches("second") == []
+    assert search_batches("renamed") == ["renamed"]
+    assert search_files("18") == []
@@ -6,9 +6,11 @@
 import base64
 import collections
 import hashlib
+import hmac
 import json
 import random
 import time
+import urllib.parse
 
 import pytest
 
@@ -28,6 +30,18 @@ def build_header(client_id, ext_data=None):
     return "Hawk {}".format(", ".join(parts))
 
 
+def build_hawk_header(client_id, access_token, method, url, ts=None, nonce=None):
+    """Build a real Hawk header, as the tooltool client does."""
+
+    url = urllib.parse.urlsplit(url)
+    resource = url.path + ("?" + url.query if url.query else "")
+    ts = str(int(time.time()) if ts is None else ts)
+    nonce = nonce or str(random.randint(0, 1000000))
+    normalized = "\n".join(["hawk.1.header", ts, nonce, method.upper(), resource, url.hostname, str(url.port or 80), "", "", ""])
+    mac = base64.b64encode(hmac.new(access_token.encode("utf-8"), normalized.encode("utf-8"), hashlib.sha256).digest()).decode("ascii")
+    return f'Hawk mac="{mac}", id="{client_id}", ts="{ts}", nonce="{nonce}"'
+
+
 def test_anonymous():
     """
     Test AnonymousUser instances
@@ -134,3 +148,139 @@ def test_scopes_admin(client):
     resp = client.get("/test-auth-scopes", headers=[("Authorization", header)])
     assert resp.status_code == 200
     assert resp.data == b"Your scopes are ok."
+
+
+@pytest.fixture
+def hawk_verifier(mocker):
+    import tooltool_api.lib.auth
+
+    verifier = tooltool_api.lib.auth.HawkVerifier("http://taskcluster.mock", credentials={"local/client": "sekrit"}, scopes_ttl=60, skew=900)
+    remote = mocker.patch.object(verifier, "_verify_remotely")
+    remote.side_effect = lambda payload: {
+        "status": "auth-success",
+        "clientId": tooltool_api.lib.auth.HAWK_ATTRIBUTE_RE.findall(payload["authorization"])[1][1],
+        "scopes": ["project/test/A"],
+    }
+    return verifier, remote
+
+
+def hawk_payload(header, url="http://localhost/upload?region=us-east-1", method="post"):
+    url = urllib.parse.urlsplit(url)
+    resource = url.path + ("?" + url.query if url.query else "")
+    return {"resource": resource, "method": method, "host": url.hostname, "port": url.port or 80, "authorization": header}
+
+
+def test_hawk_verified_locally(hawk_verifier):
+    """
+    Once taskcluster gave the scopes of a client whose credentials are known,
+    its requests are verified without asking again
+    """
+    import tooltool_api.lib.auth
+
+    verifier, remote = hawk_verifier
+    url = "http://localhost/upload?region=us-east-1"
+
+    resp = verifier.verify(hawk_payload(build_hawk_header("local/client", "sekrit", "post", url)))
+    assert resp["scopes"] == ["project/test/A"]
+    assert remote.call_count == 1
+
+    header = build_hawk_header("local/client", "sekrit", "post", url)
+    resp = verifier.verify(hawk_payload(header))
+    assert resp["clientId"] == "local/client"
+    assert remote.call_count == 1
+
+    # nonces can't be used twice
+    assert verifier.verify(hawk_payload(header)) is tooltool_api.lib.auth.NO_AUTH
+
+    # the MAC covers the method and the resource, query included
+    header = build_hawk_header("local/client", "sekrit", "post", url)
+    assert verifier.verify(hawk_payload(header, url="http://localhost/upload?region=us-west-2")) is tooltool_api.lib.auth.NO_AUTH
+    assert verifier.verify(hawk_payload(header, method="get")) is tooltool_api.lib.auth.NO_AUTH
+    header = build_hawk_header("local/client", "wrong", "post", url)
+    assert verifier.verify(hawk_payload(header)) is tooltool_api.lib.auth.NO_AUTH
+
+    # as does the timestamp, which must be recent
+    header = build_hawk_header("local/client", "sekrit", "post", url, ts=int(time.time()) - 1000)
+    assert verifier.verify(hawk_payload(header)) is tooltool_api.lib.auth.NO_AUTH
+    assert remote.call_count == 1
+
+
+def test_hawk_verified_remotely(hawk_verifier, mocker):
+    """
+    Clients without known credentials, and scopes past their TTL, are
+    verified by taskcluster
+    """
+    import tooltool_api.lib.auth
+
+    verifier, remote = hawk_verifier
+    url = "http://localhost/upload"
+
+    for _ in range(2):
+        verifier.verify(hawk_payload(build_hawk_header("remote/client", "whatever", "post", url)))
+    assert remote.call_count == 2
+
+    header = build_hawk_header("local/client", "sekrit", "post", url)
+    assert verifier.verify(hawk_payload(header))["clientId"] == "local/client"
+    assert remote.call_count == 3
+
+    # once the scopes are cached, a replay of a header taskcluster verified
+    # is caught here
+    assert verifier.verify(hawk_payload(header)) is tooltool_api.lib.auth.NO_AUTH
+    assert remote.call_count == 3
+
+    later = time.time() + 61
+    mocker.patch("time.time", return_value=later)
+    assert verifier.verify(hawk_payload(build_hawk_header("local/client", "sekrit", "post", url, ts=int(later))))
+    assert remote.call_count == 4
+
+
+def test_scope_set():
+    """
+    Compiled scope sets match like taskcluster's scopeMatch
+    """
+    import taskcluster.utils
+
+    import tooltool_api.lib.auth
+
+    scopes = ["project/test/A", "project/te*", "queue:*", "", "other/exact*", "other/exact"]
+    required = [
+        "project/test/A",
+        "project/test/B",
+        "project/t",
+        "project/te",
+        "project/te*",
+        "queue:",
+        "queue:x",
+        "*",
+        "",
+        "other/exac",
+        "other/exact",
+        "other/exactly",
+        "x",
+    ]
+    scope_set = tooltool_api.lib.auth.ScopeSet(scopes)
+    for scope in required:
+        assert scope_set.satisfies(scope) == taskcluster.utils.scopeMatch(scopes, [[scope]]), scope
+        assert scope_set.satisfies(scope) == taskcluster.utils.scopeMatch(scopes, [[scope]]), scope  # memoized
+
+    everything = tooltool_api.lib.auth.ScopeSet(["*"])
+    assert all(everything.satisfies(scope) for scope in required)
+    nothing = tooltool_api.lib.auth.ScopeSet([])
+    assert not any(nothing.satisfies(scope) for scope in required)
+
+    rng = random.Random(0)
+    for _ in range(200):
+        sets = [[rng.choice(required) for _ in range(rng.randint(1, 3))] for _ in range(rng.randint(1, 3))]
+        assert scope_set.match(sets) == taskcluster.utils.scopeMatch(scopes, sets), sets
+
+
+def test_taskcluster_user_scope_set(mocker):
+    import tooltool_api.lib.auth
+
+    user = tooltool_api.lib.auth.TaskclusterUser({"clientId": "test/user@mozilla.com", "scopes": ["project:releng:services/tooltool/api/upload/*"]})
+    compile = mocker.spy(tooltool_api.lib.auth, "ScopeSet")
+    assert user.has_permissions("project:releng:services/tooltool/api/upload/public")
+    assert user.has_permissions(["project:releng:services/tooltool/api/upload/public", "project:releng:services/tooltool/api/upload/internal"])
+    assert not user.has_permissions([["project:releng:services/tooltool/api/manage"], ["project:releng:services/tooltool/api/download/public"]])
+    assert user.has_permissions([["project:releng:services/tooltool/api/manage"], ["project:releng:services/tooltool/api/upload/internal"]])
+    assert compile.call_count == 1
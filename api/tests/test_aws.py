@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import base64
+import datetime
+import threading
+import urllib.parse
+
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+
+def make_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption())
+    return key, pem
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return make_key(), make_key()
+
+
+def verify(url, public_key, expire_time):
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    assert query["Expires"] == str(int(expire_time.timestamp()))
+    base_url = url.split("?")[0]
+    policy = f'{{"Statement":[{{"Resource":"{base_url}","Condition":{{"DateLessThan":{{"AWS:EpochTime":{query["Expires"]}}}}}}}]}}'
+    signature = base64.b64decode(query["Signature"].replace("-", "+").replace("_", "=").replace("~", "/"))
+    public_key.verify(signature, policy.encode("utf-8"), padding.PKCS1v15(), hashes.SHA1())
+    return query["Key-Pair-Id"]
+
+
+def test_cloudfront_signer_cached(keys, mocker):
+    import tooltool_api.aws
+
+    (key, pem), (other_key, other_pem) = keys
+    aws = tooltool_api.aws.AWS("access key id", "secret access key")
+    load = mocker.spy(tooltool_api.aws.serialization, "load_pem_private_key")
+    expire_time = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+
+    for i in range(3):
+        url = aws.generate_presigned_cloudfront_url(f"https://cdn.example.com/sha512/{i}", expire_time, "KEYPAIR", pem)
+        assert verify(url, key.public_key(), expire_time) == "KEYPAIR"
+    assert load.call_count == 1
+
+    # a rotated key is loaded again, and used from then on
+    url = aws.generate_presigned_cloudfront_url("https://cdn.example.com/sha512/0", expire_time, "KEYPAIR", other_pem)
+    verify(url, other_key.public_key(), expire_time)
+    url = aws.generate_presigned_cloudfront_url("https://cdn.example.com/sha512/1", expire_time, "KEYPAIR", other_pem)
+    verify(url, other_key.public_key(), expire_time)
+    assert load.call_count == 2
+
+    # each keypair has its own signer
+    url = aws.generate_presigned_cloudfront_url("https://cdn.example.com/sha512/0", expire_time, "OTHER", pem)
+    assert verify(url, key.public_key(), expire_time) == "OTHER"
+    assert load.call_count == 3
+
+
+def test_connect_to_cached(mocker):
+    import tooltool_api.aws
+
+    aws = tooltool_api.aws.AWS("access key id", "secret access key", max_pool_connections=20)
+    build = mocker.spy(tooltool_api.aws.boto3.Session, "resource")
+
+    s3 = aws.connect_to("s3", "us-east-1")
+    assert aws.connect_to("s3", "us-east-1") is s3
+    assert s3.meta.client.meta.config.max_pool_connections == 20
+    other_region = aws.connect_to("s3", "us-west-2")
+    assert other_region.meta.client is not s3.meta.client
+    assert other_region.meta.client.meta.region_name == "us-west-2"
+    assert build.call_count == 2
+
+    # other threads get their own resources, on the same client
+    in_thread = []
+    thread = threading.Thread(target=lambda: in_thread.append(aws.connect_to("s3", "us-east-1")))
+    thread.start()
+    thread.join()
+    assert in_thread[0] is not s3
+    assert in_thread[0].meta.client is s3.meta.client
+    assert build.call_count == 2
+
+
+def test_presigned_s3_put_urls(mocker):
+    import boto3
+    import botocore.config
+
+    import tooltool_api.aws
+
+    aws = tooltool_api.aws.AWS("access key id", "secret access key")
+    keys = [f"sha512/{i:0128x}" for i in range(3)]
+    signing_keys = {}
+    for day in (17, 17, 18):
+        now = datetime.datetime(2026, 10, day, 11, 5, 39, tzinfo=datetime.timezone.utc)
+        mocker.patch("tooltool_api.utils.now", lambda: now)
+        mocker.patch("botocore.auth.get_current_datetime", lambda: now.replace(tzinfo=None))
+        for region in ("us-east-1", "us-west-2"):
+            # the URLs are those botocore signs with SigV4, one at a time
+            session = boto3.Session(aws_access_key_id="access key id", aws_secret_access_key="secret access key", region_name=region)
+            client = session.client("s3", config=botocore.config.Config(signature_version="s3v4"))
+            expected = [
+                client.generate_presigned_url(
+                    ClientMethod="put_object", ExpiresIn=60, Params={"Bucket": "bucket", "Key": key, "ContentType": "application/octet-stream"}
+                )
+                for key in keys
+            ]
+            assert aws.generate_presigned_s3_put_urls(region, "bucket", keys, 60, "application/octet-stream") == expected
+            # the signing key is derived once per region and day
+            signing_key = aws._s3_signing_keys[region][2]
+            assert signing_keys.setdefault((region, day), signing_key) is signing_key
+    assert len(set(signing_keys.values())) == 4
+
+    assert aws.generate_presigned_s3_put_urls("us-east-1", "bucket", [], 60, "application/octet-stream") == []
+
+
+def test_server_timing(real_client, real_app):
+    import tooltool_api.models
+
+    digest = "0" * 128
+    session = real_app.db.session
+    file = tooltool_api.models.File(sha512=digest, visibility="public", size=1)
+    session.add(file)
+    session.flush()
+    session.add(tooltool_api.models.FileInstance(file_id=file.id, region="us-east-1"))
+    session.commit()
+
+    # requests which need no AWS clients don't report the time
+    resp = real_client.get("/upload/0")
+    assert "Server-Timing" not in resp.headers
+
+    resp = real_client.get(f"/sha512/{digest}")
+    assert resp.status_code == 302
+    name, duration = resp.headers["Server-Timing"].split(";")
+    assert name == "aws-connect"
+    assert float(duration.removeprefix("dur=")) >= 0
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Microbenchmarks for the tooltool client.
+
+Run as `python bench_tooltool.py [options]`; this is not part of the test
+suite."""
+
+import hashlib
+import io
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+import tooltool
+
+
+def make_files(directory, count, size):
+    filenames = []
+    block = os.urandom(1024 * 1024)
+    for i in range(count):
+        filename = os.path.join(directory, "file-%d" % i)
+        with open(filename, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        filenames.append(filename)
+    return filenames
+
+
+def small_chunk_digest(filename, algorithm):
+    # the 10 KiB read loop digest_file used to have, for comparison
+    h = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        data = f.read(1024 * 10)
+        while data:
+            h.update(data)
+            data = f.read(1024 * 10)
+    return h.hexdigest()
+
+
+def large_chunk_digest(filename, algorithm):
+    with open(filename, "rb") as f:
+        return tooltool.digest_file(f, algorithm)
+
+
+def make_tarball(count, size):
+    # many small files, as found in toolchain tarballs
+    buf = io.BytesIO()
+    with tooltool.TarFile.open(fileobj=buf, mode="w") as tar:
+        for i in range(count):
+            data = os.urandom(size)
+            info = tooltool.tarfile.TarInfo("basename/dir-%d/file-%d" % (i % 16, i))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def extract(data, directory, write_jobs):
+    def run():
+        shutil.rmtree(directory, ignore_errors=True)
+        tooltool.TarFile.write_jobs = write_jobs
+        with tooltool.TarFile.open(fileobj=io.BytesIO(data), mode="r|") as tar:
+            tooltool.safe_extract(tar, directory)
+
+    return run
+
+
+def validate(members, directory, validator):
+    def run():
+        check = validator(directory)
+        for member in members:
+            check(member)
+
+    return run
+
+
+def bench(name, total_bytes, func, repeat, unit="MB/s", scale=1000000.0):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-32s %8.1f %s  (%.3fs)" % (name, total_bytes / best / scale, unit, best))
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--files", type="int", default=8, help="number of files to hash")
+    parser.add_option(
+        "--size", type="int", default=64, help="size of each file, in MiB"
+    )
+    parser.add_option("--algorithm", default="sha512", help="hashing algorithm to use")
+    parser.add_option(
+        "--repeat", type="int", default=3, help="keep the best of this many runs"
+    )
+    parser.add_option(
+        "--tar-files",
+        type="int",
+        default=2000,
+        help="number of 16 KiB files in the tarball to unpack",
+    )
+    options, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = make_files(directory, options.files, options.size * 1024 * 1024)
+        total = options.files * options.size * 1024 * 1024
+        print(
+            "hashing %d files of %d MiB with %s, %d threads"
+            % (options.files, options.size, options.algorithm, tooltool.DIGEST_JOBS)
+        )
+
+        def serial(digest):
+            return lambda: [digest(f, options.algorithm) for f in filenames]
+
+        bench(
+            "10 KiB reads, serial",
+            total,
+            serial(small_chunk_digest),
+            options.repeat,
+        )
+        bench("digest_file, serial", total, serial(large_chunk_digest), options.repeat)
+        bench(
+            "digest_map(create_file_record)",
+            total,
+            lambda: tooltool.digest_map(
+                lambda f: tooltool.create_file_record(f, options.algorithm), filenames
+            ),
+            options.repeat,
+        )
+
+        data = make_tarball(options.tar_files, 16 * 1024)
+        write_jobs = max(2, tooltool.UNPACK_JOBS)
+        target = os.path.join(directory, "unpacked")
+        print(
+            "unpacking %d files of 16 KiB, %d writer threads"
+            % (options.tar_files, write_jobs)
+        )
+        bench("extractall, serial", len(data), extract(data, target, 1), options.repeat)
+        bench(
+            "extractall, writer threads",
+            len(data),
+            extract(data, target, write_jobs),
+            options.repeat,
+        )
+
+        members = []
+        for i in range(options.tar_files):
+            member = tooltool.tarfile.TarInfo(
+                "basename/dir-%d/sub/file-%d" % (i % 16, i)
+            )
+            member.mode = 0o644
+            members.append(member)
+        print("validating %d tar members" % len(members))
+        bench(
+            "validate_tar_member",
+            len(members),
+            validate(
+                members,
+                target,
+                lambda path: lambda m: tooltool.validate_tar_member(m, path),
+            ),
+            options.repeat,
+            unit="k members/s",
+            scale=1000.0,
+        )
+        bench(
+            "_TarMemberValidator",
+            len(members),
+            validate(
+                members,
+                target,
+                lambda path: tooltool._TarMemberValidator(path).check,
+            ),
+            options.repeat,
+            unit="k members/s",
+            scale=1000.0,
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,22 +2,30 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
 import contextlib
 import copy
 import hashlib
+import hmac
 import http.server
 import json
 import logging
 import mock
 import os
 import os.path
+import re
 import shutil
+import socket
 import sys
+import tarfile
+import zipfile
 import tempfile
 import stat
 import threading
+import time
 import tooltool
 import unittest
+import urllib.parse
 
 from io import StringIO, BytesIO
 from io import open
@@ -83,6 +91,109 @@ class DigestTests(unittest.TestCase):
         # of Linus Torvalds explaining how he pronounces 'Linux'
         self.assertEqual(test_digest, self.sample_digest)
 
+    def test_digest_file_large(self):
+        """Files spanning several read buffers hash correctly"""
+        data = os.urandom(tooltool.DIGEST_CHUNK_SIZE * 2 + 17)
+        self.assertEqual(tooltool.digest_file(BytesIO(data), 'sha512'), get_hexdigest(data))
+
+    def test_digest_file_no_readinto(self):
+        """File-like objects without readinto are read in chunks"""
+        f = mock.Mock(spec=['read'])
+        f.read.side_effect = [b'abc', b'def', b'']
+        self.assertEqual(tooltool.digest_file(f, 'sha512'), get_hexdigest(b'abcdef'))
+        f.read.assert_called_with(tooltool.DIGEST_CHUNK_SIZE)
+
+    def test_digest_map(self):
+        """digest_map keeps the order of its inputs, whatever the order of
+        completion on the threads"""
+        self.assertEqual(tooltool.digest_map(lambda i: i * 2, range(20), jobs=4),
+                         list(range(0, 40, 2)))
+
+    def test_digest_map_exception(self):
+        def fail(i):
+            raise tooltool.MissingFileException(filename=str(i))
+        with self.assertRaises(tooltool.MissingFileException):
+            tooltool.digest_map(fail, range(4), jobs=4)
+
+
+class DigestCacheTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        self.cache = tooltool.DigestCache('digests.db')
+        patcher = mock.patch('tooltool._digest_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write('data', b'abcd')
+
+    def tearDown(self):
+        self.cache.close()
+        self.tearDownTestDir()
+
+    def write(self, filename, data, age=60):
+        with open(filename, 'wb') as f:
+            f.write(data)
+        # pretend the file was last modified a while ago
+        old = os.stat(filename).st_mtime_ns - age * 10**9
+        os.utime(filename, ns=(old, old))
+
+    def digest(self):
+        with mock.patch('tooltool.digest_file', wraps=tooltool.digest_file) as digest_file:
+            digest = tooltool.file_digest('data', 'sha512')
+        return digest, digest_file.call_count
+
+    def test_hit(self):
+        self.assertEqual(self.digest(), (get_hexdigest(b'abcd'), 1))
+        self.assertEqual(self.digest(), (get_hexdigest(b'abcd'), 0))
+
+    def test_persistent(self):
+        self.digest()
+        self.cache.close()
+        self.cache = tooltool.DigestCache('digests.db')
+        with mock.patch('tooltool._digest_cache', self.cache):
+            self.assertEqual(self.digest(), (get_hexdigest(b'abcd'), 0))
+
+    def test_modified(self):
+        """Rewriting the file with the same size invalidates the entry"""
+        self.digest()
+        self.write('data', b'abce', age=30)
+        self.assertEqual(self.digest(), (get_hexdigest(b'abce'), 1))
+
+    def test_replaced(self):
+        """A different file renamed into place invalidates the entry"""
+        self.digest()
+        self.write('other', b'abce')
+        os.rename('other', 'data')
+        self.assertEqual(self.digest(), (get_hexdigest(b'abce'), 1))
+
+    def test_recently_modified(self):
+        """Files modified just now are not remembered"""
+        self.write('data', b'abcd', age=0)
+        self.assertEqual(self.digest(), (get_hexdigest(b'abcd'), 1))
+        self.assertEqual(self.digest(), (get_hexdigest(b'abcd'), 1))
+
+    def test_validate_digest(self):
+        record = tooltool.FileRecord('data', 4, get_hexdigest(b'abcd'), 'sha512')
+        self.assertTrue(record.validate_digest())
+        with mock.patch('tooltool.digest_file') as digest_file:
+            self.assertTrue(record.validate_digest())
+            self.assertFalse(digest_file.called)
+
+    def test_main_option(self):
+        tooltool.add_files('manifest.tt', 'sha512', ['data'], None, None, False)
+        self.assertEqual(call_main('tooltool', '--digest-cache', 'main.db', 'validate'), 0)
+        with mock.patch('tooltool.digest_file') as digest_file:
+            self.assertEqual(call_main('tooltool', '--digest-cache', 'main.db', 'validate'), 0)
+            self.assertFalse(digest_file.called)
+        self.assertIsNone(tooltool._digest_cache)
+
+    def test_main_option_unusable(self):
+        os.mkdir('dir.db')
+        tooltool.add_files('manifest.tt', 'sha512', ['data'], None, None, False)
+        with BufferHandler.capture('tooltool') as logged:
+            self.assertEqual(call_main('tooltool', '--digest-cache', 'dir.db', 'validate'), 0)
+        self.assertEqual(logged[0][0], logging.WARNING)
+
 
 class BaseFileRecordTest(unittest.TestCase):
 
@@ -547,13 +658,20 @@ def test_command_purge_no_folder():
 def test_command_purge():
     with mock.patch('tooltool.purge') as purge:
         assert call_main('tooltool', 'purge', '--cache', 'foo') == 1
-        purge.assert_called_with(folder='foo', gigs=0)
+        purge.assert_called_with(folder='foo', gigs=0, max_size=None, jobs=1)
 
 
 def test_command_purge_size():
     with mock.patch('tooltool.purge') as purge:
         assert call_main('tooltool', 'purge', '--size', '10', '--cache', 'foo') == 1
-        purge.assert_called_with(folder='foo', gigs=10)
+        purge.assert_called_with(folder='foo', gigs=10, max_size=None, jobs=1)
+
+
+def test_command_purge_max_cache_size():
+    with mock.patch('tooltool.purge') as purge:
+        assert call_main('tooltool', 'purge', '--max-cache-size', '2.5', '-j', '4',
+                         '--cache', 'foo') == 1
+        purge.assert_called_with(folder='foo', gigs=0, max_size=2.5, jobs=4)
 
 
 def test_command_fetch_no_url():
@@ -562,7 +680,8 @@ def test_command_fetch_no_url():
         fetch_files.assert_called_with('manifest.tt',
                                        ['https://tooltool.mozilla-releng.net/'],
                                        [], cache_folder=None, auth_file=None,
-                                       region=None)
+                                       region=None, jobs=1, cache_mode="copy", stream_unpack=False,
+                                       verify_unpacked=False)
 
 
 def test_command_fetch():
@@ -570,7 +689,8 @@ def test_command_fetch():
         assert call_main('tooltool', 'fetch', 'a', 'b', '--url', 'http://foo/bar/') == 0
         fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], ['a', 'b'],
                                        cache_folder=None, auth_file=None,
-                                       region=None)
+                                       region=None, jobs=1, cache_mode="copy", stream_unpack=False,
+                                       verify_unpacked=False)
 
 
 def test_command_fetch_no_trailing_slash():
@@ -578,7 +698,8 @@ def test_command_fetch_no_trailing_slash():
         assert call_main('tooltool', 'fetch', 'a', 'b', '--url', 'http://foo/bar') == 0
         fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], ['a', 'b'],
                                        cache_folder=None, auth_file=None,
-                                       region=None)
+                                       region=None, jobs=1, cache_mode="copy", stream_unpack=False,
+                                       verify_unpacked=False)
 
 
 def test_command_fetch_region():
@@ -587,7 +708,8 @@ def test_command_fetch_region():
                       '--region', 'us-east-1') == 0
         fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], ['a', 'b'],
                                        cache_folder=None, auth_file=None,
-                                       region='us-east-1')
+                                       region='us-east-1', jobs=1, cache_mode="copy", stream_unpack=False,
+                                       verify_unpacked=False)
 
 
 def test_command_fetch_auth_file():
@@ -603,23 +725,57 @@ def test_command_fetch_auth_file():
             fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'],
                                            ['a', 'b'], cache_folder=None,
                                            auth_file="HOME/.tooltool-token",
-                                           region=None)
+                                           region=None, jobs=1, cache_mode="copy", stream_unpack=False,
+                                       verify_unpacked=False)
     finally:
         os.path.expanduser = old_expanduser
 
 
+def test_command_fetch_jobs():
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        assert call_main('tooltool', 'fetch', '--url', 'http://foo/bar/', '-j', '4') == 0
+        fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], [],
+                                       cache_folder=None, auth_file=None,
+                                       region=None, jobs=4, cache_mode="copy", stream_unpack=False,
+                                       verify_unpacked=False)
+
+
+def test_command_fetch_link_cached_files():
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        assert call_main('tooltool', 'fetch', '--url', 'http://foo/bar/', '-c', 'cache',
+                         '--link-cached-files') == 0
+        fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], [],
+                                       cache_folder='cache', auth_file=None,
+                                       region=None, jobs=1, cache_mode="link", stream_unpack=False,
+                                       verify_unpacked=False)
+
+
+def test_command_fetch_bad_jobs():
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        assert call_main('tooltool', 'fetch', '--jobs', '0') == 'exit 2'
+        assert not fetch_files.called
+
+
 def test_command_upload():
     with mock.patch('tooltool.upload') as upload:
         assert call_main('tooltool', 'upload', '--url', 'http://foo/',
                       '--message', 'msg') == 0
-        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, None)
+        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, None, jobs=None)
+
+
+def test_command_upload_jobs():
+    with mock.patch('tooltool.upload') as upload:
+        assert call_main('tooltool', 'upload', '--url', 'http://foo/',
+                      '--message', 'msg', '-j', '2') == 0
+        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, None, jobs=2)
 
 
 def test_command_upload_region():
     with mock.patch('tooltool.upload') as upload:
         assert call_main('tooltool', 'upload', '--url', 'http://foo/',
                       '--message', 'msg', '--region=us-west-3') == 0
-        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, 'us-west-3')
+        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, 'us-west-3',
+                                  jobs=None)
 
 
 def test_command_upload_no_message():
@@ -633,7 +789,7 @@ def test_command_upload_no_url():
         assert call_main('tooltool', 'upload', '--message', 'msg') == 0
         upload.assert_called_with('manifest.tt', 'msg',
                                   ['https://tooltool.mozilla-releng.net/'],
-                                  None, None)
+                                  None, None, jobs=None)
 
 
 class UploadTests(TestDirMixin, unittest.TestCase):
@@ -648,8 +804,22 @@ class UploadTests(TestDirMixin, unittest.TestCase):
         def log_request(self, code=None, size=None):
             logging.getLogger('fake_web').info("%s %s" % (self.path, code))
 
+        def verify_hawk(self, credentials):
+            """Check the Hawk header as servers from before multipart uploads
+            did: with the request's path as the resource, without its query"""
+            attrs = dict(re.findall(r'(\w+)="([^"]*)"', self.headers.get('Authorization', '')))
+            host, port = self.headers['Host'].split(':')
+            normalized = '\n'.join(['hawk.1.header', attrs.get('ts', ''), attrs.get('nonce', ''), self.command,
+                                    self.path.split('?')[0], host, port, attrs.get('hash', ''), '', ''])
+            mac = hmac.new(credentials['accessToken'].encode('ascii'), normalized.encode('utf-8'), hashlib.sha256)
+            return (attrs.get('id') == credentials['clientId']
+                    and hmac.compare_digest(base64.b64encode(mac.digest()).decode('ascii'), attrs.get('mac', '')))
+
         def verify_auth(self):
             token = self.test_case.server_config.get('exp_auth_token')
+            hawk = self.test_case.server_config.get('exp_hawk_credentials')
+            if hawk and not self.verify_hawk(hawk):
+                token = 'a bearer token, since the Hawk header is wrong'
             if token:
                 if self.headers.get('Authorization') != 'Bearer %s' % token:
                     self.send_response(403, b"Forbidden")
@@ -662,8 +832,13 @@ class UploadTests(TestDirMixin, unittest.TestCase):
 
         def do_POST(self):
             cfg = self.test_case.server_config
-            if '?region=' in self.path:
-                self.path, self.test_case.server_got_region = self.path.split('?')
+            if self.path.startswith('/tooltool/upload/multipart/'):
+                return self.complete_multipart()
+            if self.path == '/tooltool/upload/complete':
+                return self.notify_batch()
+            if '?' in self.path:
+                self.path, query = self.path.split('?')
+                self.test_case.server_got_query = urllib.parse.parse_qs(query)
             assert self.path == '/tooltool/upload'
             assert self.headers['content-type'] == 'application/json'
             if not self.verify_auth():
@@ -673,8 +848,20 @@ class UploadTests(TestDirMixin, unittest.TestCase):
             assert body['message'] == 'hi mom'
 
             files_on_server = cfg.get('files_on_server', [])
+            multipart_files = cfg.get('multipart_files', [])
             for filename, file in body['files'].items():
-                if filename not in files_on_server:
+                if filename in files_on_server:
+                    continue
+                if filename in multipart_files and self.headers.get('X-Tooltool-Multipart') == 'true':
+                    part_size = 300
+                    count = -(-file['size'] // part_size)
+                    file['multipart'] = {
+                        'upload_id': 'upload-' + file['digest'][:10],
+                        'part_size': part_size,
+                        'part_urls': [self.test_case.s3url('/part/%s/%d' % (file['digest'], i))
+                                      for i in range(1, count + 1)],
+                    }
+                else:
                     file['put_url'] = self.test_case.s3url('/sha512/' + file['digest'])
 
             if cfg.get('post_fails'):
@@ -688,8 +875,65 @@ class UploadTests(TestDirMixin, unittest.TestCase):
                 self.end_headers()
                 self.wfile.write(to_binary(json.dumps({'result': body})))
 
+        def notify_batch(self):
+            cfg = self.test_case.server_config
+            if not self.verify_auth():
+                return
+            body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+            if cfg.get('no_batch_notify'):
+                self.send_response(404, b'Not Found')
+            else:
+                self.test_case.server_requests.setdefault('NOTIFY', []).append(body['digests'])
+                if cfg.get('get_fails'):
+                    self.send_response(500, b'NOPE')
+                elif cfg.get('get_409s'):
+                    self.send_response(409, b'Conflict')
+                    self.send_header('X-Retry-After', '10')
+                    del cfg['get_409s']  # succeed on retry
+                else:
+                    self.send_response(202, b'Accepted')
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+
+        def complete_multipart(self):
+            if not self.verify_auth():
+                return
+            digest = self.path[-128:]
+            body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+            self.test_case.server_requests.setdefault('COMPLETE', []).append(body)
+            assert body['upload_id'] == 'upload-' + digest[:10]
+            parts = self.test_case.server_parts.get(digest, {})
+            data = b''.join(parts[p['part_number']] for p in body['parts'])
+            if [p['etag'] for p in body['parts']] == ['"%d"' % p['part_number'] for p in body['parts']] \
+                    and get_hexdigest(data) == digest:
+                self.send_response(200, b'OK')
+            else:
+                self.send_response(400, b'Bad parts')
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(to_binary(json.dumps({})))
+
+        def put_part(self):
+            cfg = self.test_case.server_config
+            digest, part_number = self.path.split('/')[2:]
+            data = self.rfile.read(int(self.headers['content-length']))
+            self.test_case.server_requests.setdefault('PART', []).append(int(part_number))
+            failures = cfg.get('part_failures', {})
+            if failures.get(int(part_number)):
+                failures[int(part_number)] -= 1
+                self.send_response(500, b'NOPE')
+            else:
+                self.test_case.server_parts.setdefault(digest, {})[int(part_number)] = data
+                self.send_response(200, b'OK')
+                self.send_header('ETag', '"%s"' % part_number)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
         def do_PUT(self):  # S3 upload
             cfg = self.test_case.server_config
+            assert self.headers['content-type'] == 'application/octet-stream'
+            if self.path.startswith('/part/'):
+                return self.put_part()
             assert self.path.startswith('/sha512/'), self.path
             assert self.headers['content-type'] == 'application/octet-stream'
             content_length = int(self.headers.get('content-length', -1))
@@ -728,6 +972,7 @@ class UploadTests(TestDirMixin, unittest.TestCase):
     def start_server(self):
         self.server_config = {}
         self.server_requests = {}
+        self.server_parts = {}
         UploadTests.Handler.test_case = self
         self.httpd = http.server.HTTPServer(("127.0.0.1", 0), UploadTests.Handler)
         self.http_port = self.httpd.server_port
@@ -792,9 +1037,94 @@ class UploadTests(TestDirMixin, unittest.TestCase):
                 'message': 'hi mom',
             }],
             'PUT': [bar_digest],
-            'GET': [bar_digest],
+            'NOTIFY': [[bar_digest]],
         })
 
+    def test_upload_jobs(self):
+        """The number of files uploaded at the same time can be limited"""
+        self.start_server()
+        digests = [self.add_file("file-%d.txt" % i) for i in range(4)]
+        running = []
+        most = []
+        lock = threading.Lock()
+        real_s3_upload = tooltool._s3_upload
+
+        def s3_upload(filename, file):
+            with lock:
+                running.append(filename)
+                most.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(filename)
+            real_s3_upload(filename, file)
+        with mock.patch('tooltool._s3_upload', side_effect=s3_upload):
+            self.assertTrue(tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None,
+                                            jobs=2))
+        self.assertEqual(max(most), 2)
+        self.assertEqual(sorted(self.server_requests['PUT']), sorted(digests))
+        self.assertEqual([sorted(n) for n in self.server_requests['NOTIFY']], [sorted(digests)])
+
+    def test_upload_multipart(self):
+        """A file the server asks to be uploaded in parts is uploaded part by
+        part, and the upload completed before the server is notified"""
+        self.start_server()
+        self.server_config['multipart_files'] = ['foo.txt']
+        foo_digest = self.add_file("foo.txt")
+        bar_digest = self.add_file("bar.txt")
+        self.assertTrue(tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None))
+        self.assertEqual(sorted(self.server_requests['PART']), [1, 2, 3, 4])
+        self.assertEqual(self.server_requests['PUT'], [bar_digest])
+        self.assertEqual(self.server_requests['COMPLETE'], [{
+            'upload_id': 'upload-' + foo_digest[:10],
+            'parts': [{'part_number': i, 'etag': '"%d"' % i} for i in range(1, 5)],
+        }])
+        self.assertEqual([sorted(n) for n in self.server_requests['NOTIFY']], [sorted([foo_digest, bar_digest])])
+
+    def test_upload_multipart_hawk(self):
+        """Uploads ask for multipart uploads without changing the resource
+        signed with taskcluster credentials, so servers which verify the
+        signature against the path alone accept them"""
+        self.start_server()
+        self.server_config['multipart_files'] = ['foo.txt']
+        self.server_config['exp_hawk_credentials'] = credentials = {'clientId': 'project/releng/me', 'accessToken': 'sekrit'}
+        with open('auth', mode='w', encoding='utf-8') as f:
+            json.dump(credentials, f)
+        foo_digest = self.add_file("foo.txt")
+        self.assertTrue(tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], 'auth', None))
+        self.assertFalse(hasattr(self, 'server_got_query'))
+        self.assertEqual(sorted(self.server_requests['PART']), [1, 2, 3, 4])
+        self.assertEqual(self.server_requests['NOTIFY'], [[foo_digest]])
+
+        # and the server does check the signature
+        with open('auth', mode='w', encoding='utf-8') as f:
+            json.dump(dict(credentials, accessToken='wrong'), f)
+        self.assertFalse(tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], 'auth', None))
+
+    def test_upload_multipart_part_retried(self):
+        """A part which fails to upload is retried on its own"""
+        self.start_server()
+        self.server_config['multipart_files'] = ['foo.txt']
+        self.server_config['part_failures'] = {2: 2}
+        foo_digest = self.add_file("foo.txt")
+        with mock.patch('tooltool.MULTIPART_RETRY_SLEEP', 0):
+            self.assertTrue(tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None))
+        self.assertEqual(sorted(self.server_requests['PART']), [1, 2, 2, 2, 3, 4])
+        self.assertEqual(len(self.server_requests['COMPLETE']), 1)
+        self.assertEqual(self.server_requests['NOTIFY'], [[foo_digest]])
+
+    def test_upload_multipart_fails(self):
+        """When a part keeps failing, the upload fails and is neither
+        completed nor notified"""
+        self.start_server()
+        self.server_config['multipart_files'] = ['foo.txt']
+        self.server_config['part_failures'] = {3: 100}
+        self.add_file("foo.txt")
+        with mock.patch('tooltool.MULTIPART_RETRY_SLEEP', 0):
+            self.assertFalse(tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None))
+        self.assertEqual(self.server_requests['PART'].count(3), tooltool.MULTIPART_ATTEMPTS)
+        self.assertNotIn('COMPLETE', self.server_requests)
+        self.assertNotIn('NOTIFY', self.server_requests)
+
     def test_upload_success_auth(self):
         """An upload with authentication information succeeds when the server expects
         authentication."""
@@ -823,7 +1153,7 @@ class UploadTests(TestDirMixin, unittest.TestCase):
         self.start_server()
         self.add_file("foo.txt", on_server=True)
         self.assertTrue(tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, 'us-west-1'))
-        self.assertEqual(self.server_got_region, 'region=us-west-1')
+        self.assertEqual(self.server_got_query, {'region': ['us-west-1']})
 
     def test_upload_failure_auth(self):
         """An upload with incorrect authentication information fails"""
@@ -900,7 +1230,7 @@ class UploadTests(TestDirMixin, unittest.TestCase):
         batch = {'message': 'hi mom', 'files': {}}
         self.assertEqual(tooltool._send_batch(self.mkurl(''), None, batch, 'us-south-1'), batch)
         self.assertEqual(self.server_requests, {'POST': [batch]})
-        self.assertEqual(self.server_got_region, 'region=us-south-1')
+        self.assertEqual(self.server_got_query, {'region': ['us-south-1']})
 
     def test_send_batch_failure(self):
         self.start_server()
@@ -954,7 +1284,7 @@ class UploadTests(TestDirMixin, unittest.TestCase):
         self.server_config['get_fails'] = True
         file = {'algorithm': 'sha512', 'digest': self.digest}
         with BufferHandler.capture('tooltool') as logged:
-            with mock.patch("urllib.request.urlopen") as urlopen:
+            with mock.patch("tooltool._urlopen") as urlopen:
                 urlopen.side_effect = RuntimeError('oh noes')
                 tooltool._notify_upload_complete(self.mkurl(''), None, file)
         self.assertEqual(self.server_requests, {})
@@ -962,6 +1292,111 @@ class UploadTests(TestDirMixin, unittest.TestCase):
             (logging.ERROR, 'While notifying server of upload completion:'))
 
 
+    def test_notify_uploads(self):
+        self.start_server()
+        files = [{'algorithm': 'sha512', 'digest': d} for d in (self.digest, 'f' * 128)]
+        tooltool._notify_uploads_complete(self.mkurl(''), None, files)
+        self.assertEqual(self.server_requests, {'NOTIFY': [[self.digest, 'f' * 128]]})
+
+    def test_notify_uploads_wait(self):
+        """A batch of files waits once for all of the upload URLs to expire"""
+        self.start_server()
+        self.server_config['get_409s'] = True
+        files = [{'algorithm': 'sha512', 'digest': d} for d in (self.digest, 'f' * 128)]
+        with mock.patch('time.sleep') as fake_sleep:
+            tooltool._notify_uploads_complete(self.mkurl(''), None, files)
+        fake_sleep.assert_called_once_with(10)
+        self.assertEqual(self.server_requests, {'NOTIFY': [[self.digest, 'f' * 128]] * 2})
+
+    def test_notify_uploads_fails(self):
+        self.start_server()
+        self.server_config['get_fails'] = True
+        files = [{'algorithm': 'sha512', 'digest': self.digest}]
+        with BufferHandler.capture('tooltool') as logged:
+            tooltool._notify_uploads_complete(self.mkurl(''), None, files)
+        self.assertEqual(self.server_requests, {'NOTIFY': [[self.digest]]})
+        self.assertEqual(logged, [(logging.ERROR, 'Error making RelengAPI request:')])
+
+    def test_notify_uploads_old_server(self):
+        """Servers without the batch endpoint are notified file by file"""
+        self.start_server()
+        self.server_config['no_batch_notify'] = True
+        files = [{'algorithm': 'sha512', 'digest': d} for d in (self.digest, 'f' * 128)]
+        tooltool._notify_uploads_complete(self.mkurl(''), None, files)
+        self.assertEqual(self.server_requests, {'GET': [self.digest, 'f' * 128]})
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        """A keep-alive webserver answering every GET with its path"""
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, code=None, size=None):
+            pass
+
+        def do_GET(self):
+            body = to_binary(self.path)
+            self.send_response(200, 'OK')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def setUp(self):
+        self.pool = tooltool.ConnectionPool()
+        patcher = mock.patch('tooltool._connection_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.httpd = http.server.HTTPServer(("127.0.0.1", 0), ConnectionPoolTests.Handler)
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever)
+        self.server_thread.daemon = 1
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.pool.close()
+        self.httpd.shutdown()
+        self.server_thread.join()
+        self.httpd.server_close()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_port, path)
+
+    def test_reuse(self):
+        """Requests to the same host share a connection once each body is read"""
+        for path in ('/a', '/b', '/c'):
+            with tooltool.request(self.url(path)) as f:
+                self.assertEqual(f.read(), to_binary(path))
+        self.assertEqual((self.pool.opened, self.pool.reused), (1, 2))
+
+    def test_unread_body_not_reused(self):
+        """A connection with part of a body left to read is not reused"""
+        with tooltool.request(self.url('/abcdef')) as f:
+            self.assertEqual(f.read(2), b'/a')
+        with tooltool.request(self.url('/b')) as f:
+            self.assertEqual(f.read(), b'/b')
+        self.assertEqual((self.pool.opened, self.pool.reused), (2, 0))
+
+    def test_stale_connection(self):
+        """A request on an idle connection the server has closed is retried"""
+        with tooltool.request(self.url('/a')) as f:
+            f.read()
+        # simulate the server timing out the idle connection
+        for conns in self.pool._idle.values():
+            for conn in conns:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        with tooltool.request(self.url('/b')) as f:
+            self.assertEqual(f.read(), b'/b')
+        self.assertEqual((self.pool.opened, self.pool.reused), (2, 1))
+
+    def test_main_logs_counts(self):
+        with BufferHandler.capture('tooltool') as logged:
+            with mock.patch('tooltool.process_command') as process_command:
+                process_command.return_value = True
+                self.assertEqual(tooltool.main(['tooltool', '-v', 'list'], _skip_logging=True), 0)
+        self.assertIn((logging.DEBUG, 'HTTP connections: 0 opened, 0 reused'), logged)
+
+
 def test_log_api_error_generic():
     with BufferHandler.capture('tooltool') as logged:
         tooltool._log_api_error(RuntimeError('uhoh'))
@@ -990,17 +1425,23 @@ class FetchTests(TestDirMixin, unittest.TestCase):
     def setUp(self):
         self.setUpTestDir()
         self.cache_dir = os.path.abspath('cache')
+        # the fake servers can't resolve files
+        self.resolve_files = mock.patch('tooltool.resolve_files', return_value={}).start()
+        self.addCleanup(mock.patch.stopall)
 
     def tearDown(self):
         self.tearDownTestDir()
 
-    def fake_fetch_file(self, urls, file_record, auth_file=None, region=None):
+    def fake_fetch_file(self, urls, file_record, auth_file=None, region=None, sink=None,
+                        resolved_url=None):
         self.assertEqual(urls, self.urls)
         if file_record.digest in self.server_files_by_hash:
             if self.server_corrupt:
-                content = 'XXX'
-            else:
-                content = self.server_files_by_hash[file_record.digest]
+                # like fetch_file, refuse content which doesn't match
+                return None
+            content = self.server_files_by_hash[file_record.digest]
+            if sink is not None:
+                sink.write(to_binary(content))
             fd, temp_path = tempfile.mkstemp(dir=self.test_dir)
             os.write(fd, to_binary(content))
             os.close(fd)
@@ -1044,7 +1485,9 @@ class FetchTests(TestDirMixin, unittest.TestCase):
         if not files and not os.path.exists(self.cache_dir):
             return
         hashes = [get_hexdigest(to_binary(f)) for f in files]
-        self.assertEqual(sorted(os.listdir(self.cache_dir)), sorted(hashes))
+        # the index and lock files are dotfiles
+        self.assertEqual(sorted(f for f in os.listdir(self.cache_dir) if not f.startswith('.')),
+                         sorted(hashes))
         for f, h in zip(files, hashes):
             self.assertEqual(open(os.path.join(self.cache_dir, h), encoding='utf-8').read(), f)
 
@@ -1152,6 +1595,136 @@ class FetchTests(TestDirMixin, unittest.TestCase):
         self.assert_files('one', 'two', 'three', 'four', 'five')
         self.assert_cached_files('one', 'two', 'three', 'five')
 
+    def test_cached_files_read_only(self):
+        """Files added to the cache are read-only, but the fetched copies aren't"""
+        self.make_manifest('manifest.tt', 'one')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache'))
+        cached = os.path.join(self.cache_dir, get_hexdigest(b'one'))
+        self.assertEqual(stat.S_IMODE(os.stat(cached).st_mode), 0o444)
+        self.assertTrue(os.stat('file-one').st_mode & stat.S_IWUSR)
+        self.assertNotEqual(os.stat(cached).st_ino, os.stat('file-one').st_ino)
+
+    def test_link_cached_files(self):
+        """With the link cache mode, cached files are hardlinked, read-only"""
+        self.add_file_to_cache('one')
+        self.make_manifest('manifest.tt', 'one')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = RuntimeError
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache',
+                                                 cache_mode='link'))
+        self.assert_files('one')
+        cached = os.path.join(self.cache_dir, get_hexdigest(b'one'))
+        self.assertEqual(os.stat(cached).st_ino, os.stat('file-one').st_ino)
+        self.assertFalse(os.stat('file-one').st_mode & 0o222)
+
+    def test_link_fetched_files(self):
+        """With the link cache mode, fetched files are hardlinked into the cache"""
+        self.make_manifest('manifest.tt', 'one')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache',
+                                                 cache_mode='link'))
+        self.assert_files('one')
+        self.assert_cached_files('one')
+        cached = os.path.join(self.cache_dir, get_hexdigest(b'one'))
+        self.assertEqual(os.stat(cached).st_ino, os.stat('file-one').st_ino)
+
+    def test_clone_file_fallbacks(self):
+        """When reflinks and copy_file_range aren't supported, the file is copied"""
+        with open('src', 'wb') as f:
+            f.write(b'x' * 100000)
+        unsupported = OSError(95, 'Operation not supported')
+        with mock.patch('fcntl.ioctl', side_effect=unsupported), \
+                mock.patch('os.copy_file_range', side_effect=unsupported, create=True):
+            self.assertEqual(tooltool._materialize('src', 'dst'), 'copied')
+        self.assertEqual(open('dst', 'rb').read(), b'x' * 100000)
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir('.')), ['dst', 'src'])
+
+    def test_clone_file_copy_file_range(self):
+        if not hasattr(os, 'copy_file_range'):
+            raise unittest.SkipTest("os.copy_file_range is not available")
+        with open('src', 'wb') as f:
+            f.write(b'x' * 100000)
+        with mock.patch('fcntl.ioctl', side_effect=OSError(95, 'Operation not supported')):
+            self.assertEqual(tooltool._materialize('src', 'dst'), 'copied (copy_file_range)')
+        self.assertEqual(open('dst', 'rb').read(), b'x' * 100000)
+
+    def test_mixed_parallel(self):
+        """fetch with several jobs gives the same result as a serial fetch"""
+        self.add_file_to_dir('one', corrupt=True)
+        self.add_file_to_cache('two', corrupt=True)
+        self.add_file_to_dir('four')
+        self.add_file_to_cache('five')
+        self.make_manifest('manifest.tt', 'one', 'two', 'three', 'four', 'five')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache',
+                                                 jobs=4))
+        self.assert_files('one', 'two', 'three', 'four', 'five')
+        self.assert_cached_files('one', 'two', 'three', 'five')
+
+    def test_parallel_failures(self):
+        """fetch with several jobs reports every file that failed"""
+        self.add_file_to_dir('one')
+        self.make_manifest('manifest.tt', 'one', 'two', 'ninetynine', 'eighty')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            with BufferHandler.capture('tooltool') as logged:
+                self.assertFalse(tooltool.fetch_files('manifest.tt', self.urls, jobs=3))
+        self.assertIn((logging.ERROR, "The following files failed: 'file-ninetynine', 'file-eighty'"),
+                      logged)
+        self.assert_files('one', 'two')
+
+    def test_resolved_urls(self):
+        """Links to the files which need fetching are resolved in one go and
+        passed on to fetch_file"""
+        self.add_file_to_dir('one')
+        self.make_manifest('manifest.tt', 'one', 'two', 'three')
+        two, three = get_hexdigest(b'two'), get_hexdigest(b'three')
+        self.resolve_files.return_value = {two: {'get_url': 'https://s3/two', 'size': 3}}
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls))
+        (urls, records), kwargs = self.resolve_files.call_args
+        self.assertEqual(urls, self.urls)
+        self.assertEqual([f.digest for f in records], [two, three])
+        self.assertEqual(
+            sorted((c[0][1].filename, c[1]['resolved_url']) for c in fetch_file.call_args_list),
+            [('file-three', None), ('file-two', 'https://s3/two')])
+        self.assert_files('one', 'two', 'three')
+
+    def test_resolved_urls_cached(self):
+        """Files in the cache are not resolved, and nothing is when all of
+        them are"""
+        self.add_file_to_cache('one')
+        self.make_manifest('manifest.tt', 'one', 'two')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache'))
+        (urls, records), kwargs = self.resolve_files.call_args
+        self.assertEqual([f.digest for f in records], [get_hexdigest(b'two')])
+
+        for filename in ('file-one', 'file-two'):
+            os.remove(filename)
+        self.resolve_files.reset_mock()
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache'))
+            fetch_file.assert_not_called()
+        self.resolve_files.assert_not_called()
+        self.assert_files('one', 'two')
+
+    def test_jobs_largest_first(self):
+        """With several jobs, the largest files are fetched first"""
+        self.make_manifest('manifest.tt', 'one', 'three', 'two')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, jobs=2))
+        self.assertEqual(fetch_file.call_args_list[0][0][1].filename, 'file-three')
+        self.assert_files('one', 'two', 'three')
+
     def test_region_arg(self):
         """A region argument passed to fetch_files gets passed on to fetch_file"""
         self.make_manifest('manifest.tt', 'one')
@@ -1160,7 +1733,7 @@ class FetchTests(TestDirMixin, unittest.TestCase):
             self.assertTrue(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache',
                                                  region='ca-north-2'))
             fetch_file.assert_called_with(self.urls, mock.ANY, auth_file=None,
-                                          region='ca-north-2')
+                                          region='ca-north-2', sink=None, resolved_url=None)
         self.assert_files('one')
         self.assert_cached_files('one')
 
@@ -1263,6 +1836,10 @@ class FetchTests(TestDirMixin, unittest.TestCase):
         self.assertRaises(Exception, lambda: tooltool.unpack_file(os.path.join(CWD_PATH, 'archive-link.tar')))
         self.assertRaises(Exception, lambda: tooltool.unpack_file(os.path.join(CWD_PATH, 'archive-link-abs.tar')))
         self.assertRaises(Exception, lambda: tooltool.unpack_file(os.path.join(CWD_PATH, 'archive-double-link.tar')))
+        self.assertRaisesRegex(Exception, 'Attempted path traversal in tar file: l2/evil',
+                               lambda: tooltool.unpack_file(os.path.join(CWD_PATH, 'archive-hardlink-to-symlink.tar')))
+        self.assertRaisesRegex(Exception, 'Attempted path traversal in tar file: y/z',
+                               lambda: tooltool.unpack_file(os.path.join(CWD_PATH, 'archive-hardlink-over-symlink.tar')))
 
     def test_unpack_deferred_symlink(self):
         with mock.patch('os.symlink') as symlink:
@@ -1275,17 +1852,26 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
     def setUp(self):
         BaseFileRecordTest.setUp(self)
         self.setUpTestDir()
+        self.abcd_hash = get_hexdigest(b'abcd')
+        self.abcd_record = tooltool.FileRecord('abcd', 4, self.abcd_hash, 'sha512')
+        self.abcd_partial = self.abcd_hash + tooltool.PARTIAL_SUFFIX
+        self.requested_ranges = []
 
     def tearDown(self):
         self.tearDownTestDir()
         BaseFileRecordTest.tearDown(self)
 
     @contextlib.contextmanager
-    def mocked_urllib2(self, data, exp_size=4096, exp_token=None):
-        with mock.patch("urllib.request.urlopen") as urlopen:
+    def mocked_urllib2(self, data, exp_size=4096, exp_token=None, ranges=False, interrupted=()):
+        """Serve `data`, a dict of URL to content.  If `ranges` is set, Range
+        requests are honored.  Downloads of URLs in `interrupted` fail once
+        all of their content has been read."""
+        with mock.patch("tooltool._urlopen") as urlopen:
             def fake_read(url, size):
                 self.assertEqual(size, exp_size)
                 remaining = data[url]
+                if not remaining and url in interrupted:
+                    raise ConnectionResetError("connection reset")
                 rv, remaining = remaining[:size], remaining[size:]
                 data[url] = remaining
                 return rv
@@ -1306,6 +1892,12 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
                 if url not in data:
                     raise URLError("bogus url")
                 m = mock.Mock(name='Response')
+                m.status = 200
+                range_header = req.get_header('Range')
+                if ranges and range_header:
+                    self.requested_ranges.append(range_header)
+                    data[url] = data[url][int(range_header[6:-1]):]
+                    m.status = 206
                 m.read = lambda size: fake_read(url, size)
                 return m
             urlopen.side_effect = replacement
@@ -1313,52 +1905,862 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
 
     def test_fetch_file(self):
         # note: the first URL doesn't match, so this loops twice
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}):
-            filename = tooltool.fetch_file(['http://a', 'http://b'], self.test_record)
+        with self.mocked_urllib2({'http://b/sha512/' + self.abcd_hash: b'abcd'}):
+            filename = tooltool.fetch_file(['http://a', 'http://b'], self.abcd_record)
             self.assertTrue(filename)
             self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
             os.unlink(filename)
 
     def test_fetch_file_region(self):
-        with self.mocked_urllib2({'http://a/sha512/%s?region=us-west-1' % self.sample_hash: b'abcd'}):
-            filename = tooltool.fetch_file(['http://a'], self.test_record, region='us-west-1')
+        with self.mocked_urllib2({'http://a/sha512/%s?region=us-west-1' % self.abcd_hash: b'abcd'}):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record, region='us-west-1')
             self.assertTrue(filename)
             self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
             os.unlink(filename)
 
     def test_fetch_file_size(self):
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}, exp_size=1024):
+        with self.mocked_urllib2({'http://b/sha512/' + self.abcd_hash: b'abcd'}, exp_size=1024):
             filename = tooltool.fetch_file(
-                ['http://a', 'http://b'], self.test_record, grabchunk=1024)
+                ['http://a', 'http://b'], self.abcd_record, grabchunk=1024)
             self.assertTrue(filename)
             self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
             os.unlink(filename)
 
     def test_fetch_file_auth_file(self):
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}, exp_token='TOKTOK'):
+        with self.mocked_urllib2({'http://b/sha512/' + self.abcd_hash: b'abcd'}, exp_token='TOKTOK'):
             with open("auth", mode="w", encoding="utf-8") as f:
                 f.write('TOKTOK')
             filename = tooltool.fetch_file(
-                ['http://a', 'http://b'], self.test_record, auth_file='auth')
+                ['http://a', 'http://b'], self.abcd_record, auth_file='auth')
             self.assertTrue(filename)
             self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
             os.unlink(filename)
 
     def test_fetch_file_auth_file_taskcluster(self):
         credentials = json.dumps({'clientId': '123', 'accessToken': '456'})
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}, exp_token=credentials):
+        with self.mocked_urllib2({'http://b/sha512/' + self.abcd_hash: b'abcd'}, exp_token=credentials):
             with open("auth", mode="w", encoding="utf-8") as f:
                 f.write(credentials)
             filename = tooltool.fetch_file(
-                ['http://a', 'http://b'], self.test_record, auth_file='auth')
+                ['http://a', 'http://b'], self.abcd_record, auth_file='auth')
             self.assertTrue(filename)
             self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
             os.unlink(filename)
 
+    def test_fetch_file_resolved(self):
+        """A resolved link is tried first, without authentication"""
+        with open("auth", mode="w", encoding="utf-8") as f:
+            f.write('TOKTOK')
+        with self.mocked_urllib2({'https://s3/abcd?sig': b'abcd'}):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record, auth_file='auth',
+                                           resolved_url='https://s3/abcd?sig')
+            self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
+
+    def test_fetch_file_resolved_expired(self):
+        """When a resolved link doesn't work, the servers are asked"""
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abcd'}):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record,
+                                           resolved_url='https://s3/abcd?sig')
+            self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
+
+    def test_resolve_files(self):
+        """Files one server doesn't resolve are asked of the next"""
+        other = tooltool.FileRecord('other', 5, get_hexdigest(b'other'), 'sha512')
+        answers = {
+            'http://a/resolve': {self.abcd_hash: {'get_url': 'https://s3/abcd', 'size': 4}},
+            'http://b/resolve': {other.digest: {'get_url': 'https://s3/other', 'size': 5}},
+        }
+        asked = []
+        with mock.patch("tooltool._urlopen") as urlopen:
+            def replacement(req):
+                asked.append((req.get_full_url(), json.loads(req.data)['digests']))
+                if req.get_full_url() not in answers:
+                    raise HTTPError(req.get_full_url(), 404, "Not Found", {}, None)
+                return BytesIO(to_binary(json.dumps({'result': answers[req.get_full_url()]})))
+            urlopen.side_effect = replacement
+            resolved = tooltool.resolve_files(['http://c', 'http://a', 'http://b'],
+                                              [self.abcd_record, other])
+        self.assertEqual(resolved, {self.abcd_hash: answers['http://a/resolve'][self.abcd_hash],
+                                    other.digest: answers['http://b/resolve'][other.digest]})
+        digests = sorted([self.abcd_hash, other.digest])
+        self.assertEqual(asked, [('http://c/resolve', digests), ('http://a/resolve', digests),
+                                 ('http://b/resolve', [other.digest])])
+
     def test_fetch_file_fails(self):
         with self.mocked_urllib2({}):
-            filename = tooltool.fetch_file(['http://a'], self.test_record)
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
+            self.assertIsNone(filename)
+
+    def test_fetch_file_digest_mismatch(self):
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abce'}):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
+            self.assertIsNone(filename)
+        self.assertEqual(os.listdir('.'), [])
+
+    def test_fetch_file_too_short(self):
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abc'}):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
+            self.assertIsNone(filename)
+
+    def test_fetch_file_too_long(self):
+        """A download stops as soon as it is longer than the expected size"""
+        data = {'http://a/sha512/' + self.abcd_hash: b'abcd' * 1024}
+        with self.mocked_urllib2(data, exp_size=3):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record, grabchunk=3)
+            self.assertIsNone(filename)
+        # only the first two chunks were read
+        self.assertEqual(len(data['http://a/sha512/' + self.abcd_hash]), 4096 - 6)
+
+    def test_fetch_file_mismatch_next_url(self):
+        """When a server provides a corrupt file, the next one is tried"""
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abce',
+                                  'http://b/sha512/' + self.abcd_hash: b'abcd'}):
+            filename = tooltool.fetch_file(['http://a', 'http://b'], self.abcd_record)
+            self.assertTrue(filename)
+            self.assertEqual(open(filename, encoding='utf-8').read(), 'abcd')
+
+    def test_fetch_file_interrupted_kept(self):
+        """An interrupted download is kept for later"""
+        url = 'http://a/sha512/' + self.abcd_hash
+        with self.mocked_urllib2({url: b'ab'}, interrupted=[url]):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
             self.assertIsNone(filename)
+        self.assertEqual(open(self.abcd_partial, 'rb').read(), b'ab')
+
+    def test_fetch_file_resume_next_url(self):
+        """A download interrupted on one server is resumed from the next"""
+        url = 'http://a/sha512/' + self.abcd_hash
+        with self.mocked_urllib2({url: b'ab', 'http://b/sha512/' + self.abcd_hash: b'abcd'},
+                                 ranges=True, interrupted=[url]):
+            filename = tooltool.fetch_file(['http://a', 'http://b'], self.abcd_record)
+            self.assertEqual(filename, self.abcd_partial)
+            self.assertEqual(open(filename, 'rb').read(), b'abcd')
+        self.assertEqual(self.requested_ranges, ['bytes=2-'])
+
+    def test_fetch_file_resume_next_run(self):
+        """A partial download left by a previous run is resumed"""
+        with open(self.abcd_partial, 'wb') as f:
+            f.write(b'abc')
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abcd'}, ranges=True):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
+            self.assertEqual(open(filename, 'rb').read(), b'abcd')
+        self.assertEqual(self.requested_ranges, ['bytes=3-'])
+
+    def test_fetch_file_resume_unsupported(self):
+        """A server ignoring the Range header causes the download to start over"""
+        with open(self.abcd_partial, 'wb') as f:
+            f.write(b'abc')
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abcd'}):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
+            self.assertEqual(open(filename, 'rb').read(), b'abcd')
+
+    def test_fetch_file_resume_corrupt(self):
+        """A partial download with the wrong content is discarded once the
+        whole file doesn't match, and fetched again from the next server"""
+        with open(self.abcd_partial, 'wb') as f:
+            f.write(b'xy')
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abcd',
+                                  'http://b/sha512/' + self.abcd_hash: b'abcd'}, ranges=True):
+            filename = tooltool.fetch_file(['http://a', 'http://b'], self.abcd_record)
+            self.assertEqual(open(filename, 'rb').read(), b'abcd')
+        self.assertEqual(self.requested_ranges, ['bytes=2-'])
+
+    def test_fetch_file_already_complete(self):
+        """A complete partial download is used without fetching anything"""
+        with open(self.abcd_partial, 'wb') as f:
+            f.write(b'abcd')
+        with self.mocked_urllib2({}):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
+            self.assertEqual(open(filename, 'rb').read(), b'abcd')
+
+    def test_fetch_file_partial_too_large(self):
+        with open(self.abcd_partial, 'wb') as f:
+            f.write(b'abcde')
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abcd'}, ranges=True):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record)
+            self.assertEqual(open(filename, 'rb').read(), b'abcd')
+        self.assertEqual(self.requested_ranges, [])
+
+    def test_fetch_file_sink(self):
+        sink = mock.Mock(name='sink')
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abcd'}, exp_size=2):
+            filename = tooltool.fetch_file(['http://a'], self.abcd_record, grabchunk=2, sink=sink)
+            self.assertTrue(filename)
+        self.assertEqual(sink.write.call_args_list, [mock.call(b'ab'), mock.call(b'cd')])
+        self.assertFalse(sink.abandon.called)
+
+    def test_fetch_file_sink_resume(self):
+        """A sink is abandoned when resuming a download from an earlier run"""
+        with open(self.abcd_partial, 'wb') as f:
+            f.write(b'ab')
+        sink = mock.Mock(name='sink')
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abcd'}, ranges=True):
+            self.assertTrue(tooltool.fetch_file(['http://a'], self.abcd_record, sink=sink))
+        sink.abandon.assert_called_once_with()
+        self.assertFalse(sink.write.called)
+
+    def test_fetch_file_sink_next_url(self):
+        """A sink keeps receiving data when a download resumes from another server"""
+        url = 'http://a/sha512/' + self.abcd_hash
+        sink = mock.Mock(name='sink')
+        with self.mocked_urllib2({url: b'ab', 'http://b/sha512/' + self.abcd_hash: b'abcd'},
+                                 ranges=True, interrupted=[url]):
+            self.assertTrue(tooltool.fetch_file(['http://a', 'http://b'], self.abcd_record,
+                                                sink=sink))
+        self.assertEqual(sink.write.call_args_list, [mock.call(b'ab'), mock.call(b'cd')])
+        self.assertFalse(sink.abandon.called)
+
+    def test_fetch_file_sink_mismatch(self):
+        sink = mock.Mock(name='sink')
+        with self.mocked_urllib2({'http://a/sha512/' + self.abcd_hash: b'abce',
+                                  'http://b/sha512/' + self.abcd_hash: b'abcd'}):
+            self.assertTrue(tooltool.fetch_file(['http://a', 'http://b'], self.abcd_record,
+                                                sink=sink))
+        sink.abandon.assert_called_once_with()
+        sink.write.assert_called_once_with(b'abce')
+
+    def test_fetch_file_range_not_satisfiable(self):
+        with open(self.abcd_partial, 'wb') as f:
+            f.write(b'ab')
+        with mock.patch("tooltool._urlopen") as urlopen:
+            urlopen.side_effect = HTTPError('http://a', 416, 'Range Not Satisfiable', {}, None)
+            self.assertIsNone(tooltool.fetch_file(['http://a'], self.abcd_record))
+        self.assertFalse(os.path.exists(self.abcd_partial))
+
+
+class LocalCacheTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        os.mkdir('cache')
+        self.cache = tooltool.LocalCache('cache')
+
+    def tearDown(self):
+        self.cache.close()
+        self.tearDownTestDir()
+
+    def add(self, content):
+        with open('src', 'wb') as f:
+            f.write(content)
+        digest = get_hexdigest(content)
+        self.cache.insert('src', digest)
+        return digest
+
+    def rows(self):
+        return self.cache._execute('SELECT digest, size, hits FROM entries ORDER BY last_access')
+
+    def test_insert(self):
+        digest = self.add(b'abcd')
+        self.assertEqual(self.rows(), [(digest, 4, 0)])
+        self.assertEqual(open(self.cache.path(digest), 'rb').read(), b'abcd')
+
+    def test_retrieve(self):
+        one = self.add(b'one')
+        two = self.add(b'two')
+        self.cache.retrieve(one, 'dst')
+        self.assertEqual(open('dst', 'rb').read(), b'one')
+        # the retrieved entry is now the most recently used
+        self.assertEqual(self.rows(), [(two, 3, 0), (one, 3, 1)])
+        self.assertEqual(self.cache.entries(), [(two, 3), (one, 3)])
+
+    def test_retrieve_missing(self):
+        self.assertRaises(IOError, lambda: self.cache.retrieve('nosuch', 'dst'))
+        self.assertFalse(os.path.exists('dst'))
+
+    def test_remove(self):
+        digest = self.add(b'abcd')
+        self.cache.remove(digest)
+        self.assertEqual(self.rows(), [])
+        self.assertEqual(os.listdir('cache'), ['.tooltool-index.sqlite'])
+
+    def test_reconcile(self):
+        """Files added without the index are indexed by mtime, and index
+        entries without a file are dropped"""
+        gone = self.add(b'gone')
+        os.remove(self.cache.path(gone))
+        for name, mtime in (('new', 1500000000), ('old', 1000000000)):
+            with open(self.cache.path(name), 'wb') as f:
+                f.write(b'x' * 10)
+            os.utime(self.cache.path(name), (mtime, mtime))
+        self.assertEqual(self.cache.entries(), [('old', 10), ('new', 10)])
+
+    def test_no_index(self):
+        """If the index can't be opened, the cache still works, using mtimes"""
+        os.mkdir(os.path.join('cache', tooltool.LocalCache.index_name))
+        for name, mtime in (('new', 1500000000), ('old', 1000000000)):
+            with open(self.cache.path(name), 'wb') as f:
+                f.write(b'x' * 10)
+            os.utime(self.cache.path(name), (mtime, mtime))
+        self.assertEqual(self.cache.entries(), [('old', 10), ('new', 10)])
+        self.cache.retrieve('old', 'dst')
+        self.assertEqual(self.cache.entries(), [('new', 10), ('old', 10)])
+
+    def test_lock(self):
+        """Locks on the same digest exclude each other"""
+        events = []
+
+        def locker(name):
+            with self.cache.lock('abc'):
+                events.append(name + ' in')
+                time.sleep(0.05)
+                events.append(name + ' out')
+        threads = [threading.Thread(target=locker, args=(n,)) for n in ('a', 'b')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertIn(events, [['a in', 'a out', 'b in', 'b out'],
+                               ['b in', 'b out', 'a in', 'a out']])
+
+    def test_concurrent_fetch_once(self):
+        """Two entries with the same digest fetched in parallel are only
+        downloaded once"""
+        digest = get_hexdigest(b'data')
+        with open('manifest.tt', 'w') as f:
+            json.dump([{'filename': name, 'size': 4, 'algorithm': 'sha512', 'digest': digest}
+                       for name in ('a', 'b')], f)
+
+        def fake_fetch_file(urls, file_record, auth_file=None, region=None, sink=None,
+                            resolved_url=None):
+            time.sleep(0.05)
+            with open('fetched', 'wb') as f:
+                f.write(b'data')
+            return 'fetched'
+        with mock.patch('tooltool.fetch_file') as fetch_file, \
+                mock.patch('tooltool.resolve_files', return_value={}):
+            fetch_file.side_effect = fake_fetch_file
+            self.assertTrue(tooltool.fetch_files('manifest.tt', ['http://a'],
+                                                 cache_folder='cache', jobs=2))
+        self.assertEqual(fetch_file.call_count, 1)
+        self.assertEqual(open('a', 'rb').read(), b'data')
+        self.assertEqual(open('b', 'rb').read(), b'data')
+
+
+class StreamingUnpackTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        mock.patch('tooltool.resolve_files', return_value={}).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def make_archive(self, filename, text="in tarball"):
+        os.mkdir('basename')
+        open("basename/README.txt", mode="w", encoding="utf-8").write(text)
+        if filename.endswith('.tar.zst'):
+            import zstandard
+            buf = BytesIO()
+            with tarfile.open(fileobj=buf, mode='w') as tar:
+                tar.add('basename')
+            data = zstandard.ZstdCompressor().compress(buf.getvalue())
+        else:
+            buf = BytesIO()
+            with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+                tar.add('basename')
+            data = buf.getvalue()
+        shutil.rmtree('basename')
+        return data
+
+    def stream(self, filename, data, chunk=1000):
+        unpacker = tooltool.StreamingUnpacker(filename, os.getcwd())
+        for i in range(0, len(data), chunk):
+            unpacker.write(data[i:i + chunk])
+        return unpacker
+
+    def test_stream_tar_gz(self):
+        data = self.make_archive('basename.tar.gz')
+        os.mkdir('basename')
+        open("basename/LEFTOVER.txt", mode="w", encoding="utf-8").write("rm me")
+        unpacker = self.stream('basename.tar.gz', data)
+        self.assertTrue(unpacker.finish())
+        # nothing is in place before the swap
+        self.assertTrue(os.path.exists('basename/LEFTOVER.txt'))
+        unpacker.swap()
+        self.assertEqual(open('basename/README.txt', encoding='utf-8').read(), 'in tarball')
+        self.assertFalse(os.path.exists('basename/LEFTOVER.txt'))
+        self.assertEqual(os.listdir('.'), ['basename'])
+
+    def test_stream_tar_zst(self):
+        data = self.make_archive('basename.tar.zst')
+        unpacker = self.stream('basename.tar.zst', data)
+        self.assertTrue(unpacker.finish())
+        unpacker.swap()
+        self.assertEqual(open('basename/README.txt', encoding='utf-8').read(), 'in tarball')
+
+    def test_stream_trailing_data(self):
+        """Data after the end of the archive doesn't block the writer"""
+        data = self.make_archive('basename.tar.zst') + b'\0' * (1024 * 1024)
+        unpacker = self.stream('basename.tar.zst', data, chunk=65536)
+        self.assertTrue(unpacker.finish())
+
+    def test_stream_not_an_archive(self):
+        unpacker = self.stream('basename.tar.gz', os.urandom(200000))
+        self.assertFalse(unpacker.finish())
+        self.assertEqual(os.listdir('.'), [])
+
+    def test_stream_abandon(self):
+        data = self.make_archive('basename.tar.gz')
+        unpacker = self.stream('basename.tar.gz', data[:100])
+        unpacker.abandon()
+        unpacker.write(data[100:])
+        self.assertFalse(unpacker.finish())
+        self.assertEqual(os.listdir('.'), [])
+
+    def test_can_unpack(self):
+        self.assertTrue(tooltool.StreamingUnpacker.can_unpack('x.tar.xz'))
+        self.assertFalse(tooltool.StreamingUnpacker.can_unpack('x.zip'))
+
+    def fetch(self, filename, data):
+        digest = get_hexdigest(data)
+        with open('manifest.tt', 'w') as f:
+            json.dump([{'filename': filename, 'size': len(data), 'algorithm': 'sha512',
+                        'digest': digest, 'unpack': True}], f)
+
+        def fake_fetch_file(urls, file_record, auth_file=None, region=None, sink=None,
+                            resolved_url=None):
+            with open('fetched', 'wb') as f:
+                f.write(data)
+            if sink is not None:
+                sink.write(data)
+            return 'fetched'
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = fake_fetch_file
+            with mock.patch('tooltool.unpack_file', wraps=tooltool.unpack_file) as unpack_file:
+                self.assertTrue(tooltool.fetch_files('manifest.tt', ['http://a'],
+                                                     stream_unpack=True))
+                return unpack_file.called
+
+    def test_fetch_files_stream_unpack(self):
+        self.assertFalse(self.fetch('basename.tar.gz', self.make_archive('basename.tar.gz')))
+        self.assertEqual(open('basename/README.txt', encoding='utf-8').read(), 'in tarball')
+        self.assertTrue(os.path.exists('basename.tar.gz'))
+
+    def test_fetch_files_stream_unpack_fallback(self):
+        """If the streaming extraction fails, the archive is unpacked afterwards"""
+        data = self.make_archive('basename.tar.gz')
+        with mock.patch('tooltool.StreamingUnpacker._extract', autospec=True) as extract:
+            def fail(self, read_fd):
+                os.close(read_fd)
+                self.error = RuntimeError('uhoh')
+            extract.side_effect = fail
+            self.assertTrue(self.fetch('basename.tar.gz', data))
+        self.assertEqual(open('basename/README.txt', encoding='utf-8').read(), 'in tarball')
+        self.assertEqual(sorted(os.listdir('.')),
+                         ['basename', 'basename.checksum', 'basename.tar.gz', 'manifest.tt'])
+
+    def test_fetch_files_stream_unpack_swap_fails(self):
+        data = self.make_archive('basename.tar.gz')
+        with mock.patch('tooltool.StreamingUnpacker.swap') as swap:
+            swap.side_effect = OSError('uhoh')
+            self.assertTrue(self.fetch('basename.tar.gz', data))
+        self.assertEqual(open('basename/README.txt', encoding='utf-8').read(), 'in tarball')
+
+
+class UnpackStateTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        os.makedirs('basename/sub')
+        open('basename/README.txt', mode='w', encoding='utf-8').write('in tarball')
+        open('basename/sub/deep.txt', mode='w', encoding='utf-8').write('deep')
+        with tarfile.open('basename.tar.gz', mode='w:gz') as tar:
+            tar.add('basename')
+        shutil.rmtree('basename')
+        data = open('basename.tar.gz', 'rb').read()
+        self.record = tooltool.FileRecord('basename.tar.gz', len(data), get_hexdigest(data),
+                                          'sha512', unpack=True)
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def unpack(self, verify=False):
+        with mock.patch('tooltool.unpack_file', wraps=tooltool.unpack_file) as unpack_file:
+            self.assertTrue(tooltool.unpack_file_record(self.record, verify=verify))
+            return unpack_file.called
+
+    def test_unpacked_path(self):
+        self.assertEqual(tooltool.unpacked_path('a/basename.tar.gz'), 'a/basename')
+        self.assertEqual(tooltool.unpacked_path('basename.tar.zst'), 'basename')
+        self.assertEqual(tooltool.unpacked_path('basename.zip'), 'basename')
+
+    def test_marker_written(self):
+        self.assertFalse(tooltool.is_unpacked(self.record))
+        self.assertTrue(self.unpack())
+        self.assertTrue(os.path.exists('basename.checksum'))
+        self.assertTrue(tooltool.is_unpacked(self.record))
+        self.assertTrue(tooltool.is_unpacked(self.record, verify=True))
+
+    def test_unpack_skipped(self):
+        self.unpack()
+        self.assertFalse(self.unpack())
+        self.assertFalse(self.unpack(verify=True))
+
+    def test_top_level_change(self):
+        """Adding or removing a top-level entry is noticed without verify"""
+        self.unpack()
+        os.remove('basename/README.txt')
+        self.assertFalse(tooltool.is_unpacked(self.record))
+        self.assertTrue(self.unpack())
+        self.assertTrue(os.path.exists('basename/README.txt'))
+
+    def test_replaced_directory(self):
+        self.unpack()
+        shutil.rmtree('basename')
+        self.assertFalse(tooltool.is_unpacked(self.record))
+        self.assertTrue(self.unpack())
+
+    def test_deep_change_needs_verify(self):
+        self.unpack()
+        with open('basename/sub/deep.txt', 'a') as f:
+            f.write('er')
+        self.assertTrue(tooltool.is_unpacked(self.record))
+        self.assertFalse(tooltool.is_unpacked(self.record, verify=True))
+        self.assertTrue(self.unpack(verify=True))
+        self.assertEqual(open('basename/sub/deep.txt', encoding='utf-8').read(), 'deep')
+
+    def test_different_archive(self):
+        self.unpack()
+        self.record.digest = get_hexdigest(b'something else')
+        self.assertFalse(tooltool.is_unpacked(self.record))
+
+    def test_corrupt_marker(self):
+        self.unpack()
+        open('basename.checksum', 'w').write('{garbage')
+        self.assertFalse(tooltool.is_unpacked(self.record))
+        self.assertTrue(self.unpack())
+        self.assertTrue(tooltool.is_unpacked(self.record))
+
+    def test_failed_unpack_removes_marker(self):
+        self.unpack()
+        os.remove('basename/README.txt')
+        with mock.patch('tooltool.unpack_file') as unpack_file:
+            unpack_file.return_value = False
+            self.assertFalse(tooltool.unpack_file_record(self.record))
+        self.assertFalse(os.path.exists('basename.checksum'))
+
+    def test_fetch_files_skips_unpacked(self):
+        with open('manifest.tt', 'w') as f:
+            json.dump([self.record], f, cls=tooltool.FileRecordJSONEncoder)
+        with mock.patch('tooltool.unpack_file', wraps=tooltool.unpack_file) as unpack_file:
+            self.assertTrue(tooltool.fetch_files('manifest.tt', ['http://a']))
+            self.assertEqual(unpack_file.call_count, 1)
+            self.assertTrue(tooltool.fetch_files('manifest.tt', ['http://a']))
+            self.assertTrue(tooltool.fetch_files('manifest.tt', ['http://a'],
+                                                 verify_unpacked=True))
+            self.assertEqual(unpack_file.call_count, 1)
+
+
+class ParallelUnpackTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        os.makedirs('basename/sub')
+        for i in range(50):
+            with open('basename/sub/file-%d' % i, 'wb') as f:
+                f.write(os.urandom(i * 1000))
+            os.utime('basename/sub/file-%d' % i, (1500000000 + i, 1500000000 + i))
+        os.chmod('basename/sub/file-7', 0o755)
+        os.link('basename/sub/file-3', 'basename/hardlink')
+        os.symlink('sub/file-4', 'basename/symlink')
+        os.utime('basename/sub', (1500000000, 1500000000))
+        buf = BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            tar.add('basename')
+            # a later member replaces an earlier one
+            info = tarfile.TarInfo('basename/sub/file-1')
+            info.size = 8
+            tar.addfile(info, BytesIO(b'replaced'))
+        self.tar_data = buf.getvalue()
+        shutil.rmtree('basename')
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def extract(self, path, write_jobs):
+        with mock.patch('tooltool.TarFile.write_jobs', write_jobs):
+            with tooltool.TarFile.open(fileobj=BytesIO(self.tar_data), mode='r|') as tar:
+                tooltool.safe_extract(tar, path)
+
+    def snapshot(self, path):
+        result = {}
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                full = os.path.join(root, name)
+                st = os.lstat(full)
+                if stat.S_ISLNK(st.st_mode):
+                    result[os.path.relpath(full, path)] = os.readlink(full)
+                    continue
+                content = None
+                if stat.S_ISREG(st.st_mode):
+                    content = open(full, 'rb').read()
+                result[os.path.relpath(full, path)] = (st.st_mode, st.st_mtime, st.st_nlink, content)
+        return result
+
+    def test_parallel_matches_serial(self):
+        self.extract('serial', 1)
+        self.extract('parallel', 8)
+        self.assertEqual(self.snapshot('serial'), self.snapshot('parallel'))
+        self.assertEqual(open('parallel/basename/sub/file-1', 'rb').read(), b'replaced')
+        self.assertEqual(os.stat('parallel/basename/sub').st_mtime, 1500000000)
+        self.assertEqual(os.stat('parallel/basename/sub/file-9').st_mtime, 1500000009)
+
+    def test_write_error(self):
+        with mock.patch('tooltool._write_file') as write_file:
+            write_file.side_effect = OSError('disk full')
+            self.assertRaises(OSError, lambda: self.extract('parallel', 8))
+
+    def test_link_after_pending_write(self):
+        buf = BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for name, type, linkname in [('x/y', tarfile.DIRTYPE, ''),
+                                         ('d', tarfile.SYMTYPE, 'x/y'),
+                                         ('s', tarfile.SYMTYPE, 'd/..'),
+                                         ('s/ESCAPED', tarfile.REGTYPE, ''),
+                                         ('d', tarfile.SYMTYPE, '.')]:
+                info = tarfile.TarInfo(name)
+                info.type = type
+                info.linkname = linkname
+                tar.addfile(info, BytesIO())
+        self.tar_data = buf.getvalue()
+        os.makedirs('ex')
+
+        # s/ESCAPED is checked while s resolves to x, and must be written
+        # before d changes
+        def slow_write_file(path, data):
+            time.sleep(0.2)
+            write_file(path, data)
+        write_file = tooltool._write_file
+        with mock.patch('tooltool._write_file', slow_write_file):
+            self.extract('ex/root', 8)
+        self.assertFalse(os.path.exists('ex/ESCAPED'))
+        self.assertTrue(os.path.exists('ex/root/x/ESCAPED'))
+
+    def zstd_frames(self, *pieces):
+        import zstandard
+        cctx = zstandard.ZstdCompressor(write_checksum=True)
+        return b''.join(cctx.compress(piece) for piece in pieces)
+
+    def test_zstd_frames(self):
+        data = self.zstd_frames(self.tar_data[:10000], self.tar_data[10000:20000], self.tar_data[20000:])
+        # a skippable frame
+        data += (0x184D2A50).to_bytes(4, 'little') + (3).to_bytes(4, 'little') + b'abc'
+        frames = tooltool._zstd_frames(BytesIO(data))
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(frames[0][0], 0)
+        self.assertEqual(sum(size for _, size in frames), len(data) - 11)
+
+    def test_zstd_frames_not_zstd(self):
+        self.assertIsNone(tooltool._zstd_frames(BytesIO(b'\0' * 100)))
+        self.assertIsNone(tooltool._zstd_frames(BytesIO(self.zstd_frames(b'abc')[:-2])))
+
+    def test_zstd_reader(self):
+        pieces = [self.tar_data[i:i + 20000] for i in range(0, len(self.tar_data), 20000)]
+        for data in (self.zstd_frames(*pieces), self.zstd_frames(self.tar_data)):
+            for jobs in (1, 4):
+                with tooltool.zstd_reader(BytesIO(data), jobs=jobs) as reader:
+                    self.assertEqual(reader.read(), self.tar_data)
+
+    def test_zstd_reader_corrupt(self):
+        data = self.zstd_frames(self.tar_data[:10000], self.tar_data[10000:])
+        data = data[:100] + b'garbage' + data[107:]
+        with tooltool.zstd_reader(BytesIO(data), jobs=4) as reader:
+            self.assertRaises(Exception, reader.read)
+
+    def test_unpack_file_multi_frame(self):
+        pieces = [self.tar_data[i:i + 20000] for i in range(0, len(self.tar_data), 20000)]
+        with open('basename.tar.zst', 'wb') as f:
+            f.write(self.zstd_frames(*pieces))
+        with mock.patch('tooltool.UNPACK_JOBS', 4), mock.patch('tooltool.TarFile.write_jobs', 4):
+            with mock.patch('tooltool._decompress_zstd_frames',
+                            wraps=tooltool._decompress_zstd_frames) as decompress:
+                self.assertTrue(tooltool.unpack_file('basename.tar.zst'))
+                self.assertTrue(decompress.called)
+        self.extract('serial', 1)
+        self.assertEqual(self.snapshot('basename'), self.snapshot('serial/basename'))
+
+
+class TarMemberValidatorTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        os.mkdir('root')
+        self.validator = tooltool._TarMemberValidator('root')
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def member(self, name, type=tarfile.REGTYPE, linkname='', mode=0o644):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.linkname = linkname
+        info.mode = mode
+        return info
+
+    def check(self, *members):
+        for member in members:
+            self.validator.check(member)
+
+    def assertRejected(self, *members):
+        self.assertRaises(Exception, lambda: self.check(*members))
+
+    def test_plain_members(self):
+        self.check(self.member('basename', tarfile.DIRTYPE),
+                   self.member('basename/a/b/c'),
+                   self.member('basename/./d/../e'))
+
+    def test_traversal(self):
+        self.assertRejected(self.member('basename/../../x'))
+        self.assertRejected(self.member('/etc/passwd'))
+
+    def test_setuid(self):
+        self.assertRejected(self.member('basename/x', mode=0o4755))
+
+    def test_symlinks(self):
+        self.check(self.member('basename/sub', tarfile.DIRTYPE),
+                   self.member('basename/link', tarfile.SYMTYPE, 'sub'),
+                   self.member('basename/link/file'),
+                   self.member('basename/up', tarfile.SYMTYPE, '..'),
+                   self.member('basename/up/basename/file'))
+
+    def test_symlink_escape(self):
+        self.assertRejected(self.member('basename/link', tarfile.SYMTYPE, '../..'))
+        self.assertRejected(self.member('basename/link', tarfile.SYMTYPE, '/etc'))
+
+    def test_symlink_chain_escape(self):
+        """Each link stays inside, but following both leaves the root"""
+        self.assertRejected(self.member('basename/a/up', tarfile.SYMTYPE, '..'),
+                            self.member('basename/a/up2', tarfile.SYMTYPE, 'up/..'),
+                            self.member('basename/a/up3', tarfile.SYMTYPE, 'up2/..'),
+                            self.member('basename/a/up3/x'))
+
+    def test_symlink_loop(self):
+        self.check(self.member('basename/a', tarfile.SYMTYPE, 'b'),
+                   self.member('basename/b', tarfile.SYMTYPE, 'a'))
+        # too many hops for the model; the realpath check decides
+        self.check(self.member('basename/a/x'))
+
+    def test_hardlink_escape(self):
+        self.check(self.member('basename/file'),
+                   self.member('basename/hard', tarfile.LNKTYPE, 'basename/file'))
+        self.assertRejected(self.member('basename/hard2', tarfile.LNKTYPE, '../outside'))
+        self.assertRaises(Exception, lambda: tooltool.validate_tar_member(
+            self.member('basename/hard2', tarfile.LNKTYPE, '../outside'), 'root'))
+
+    def test_hardlink_to_symlink(self):
+        """A hard link to a symlink, or the copy of a symlink tarfile makes
+        when linking fails, is a symlink relative to its own directory"""
+        for directory in ('', 'new/'):
+            self.validator = tooltool._TarMemberValidator('root')
+            self.check(self.member('pkg/a/b', tarfile.DIRTYPE),
+                       self.member('pkg/a/b/l', tarfile.SYMTYPE, '../../x'),
+                       self.member(directory + 'l2', tarfile.LNKTYPE, 'pkg/a/b/l'))
+            # what extracting the hard link leaves on disk
+            os.makedirs(os.path.join('root', directory), exist_ok=True)
+            os.symlink('../../x', os.path.join('root', directory, 'l2'))
+            self.assertRejected(self.member(directory + 'l2/evil'))
+
+    def test_hardlink_over_symlink(self):
+        """A hard link replaces a symlink of the same name, rather than what
+        the symlink points to"""
+        self.check(self.member('a', tarfile.DIRTYPE),
+                   self.member('x', tarfile.SYMTYPE, 'b'),
+                   self.member('a/x', tarfile.SYMTYPE, '..'),
+                   self.member('x', tarfile.LNKTYPE, 'a/x'))
+        os.mkdir('root/a')
+        os.symlink('..', 'root/a/x')
+        os.symlink('..', 'root/x')
+        self.assertRejected(self.member('x/z'))
+
+    def test_existing_symlink(self):
+        """Symlinks which were already on disk are followed"""
+        os.mkdir('outside')
+        os.mkdir('root/inside')
+        os.symlink(os.path.abspath('outside'), 'root/out')
+        os.symlink('inside', 'root/in')
+        self.check(self.member('in/x'))
+        self.assertRejected(self.member('out/x'))
+
+    def test_prefix_of_root(self):
+        """A sibling of the root whose name starts with the root's name is
+        outside of it"""
+        os.mkdir('rootbis')
+        self.assertRejected(self.member('basename/link', tarfile.SYMTYPE, '../../rootbis'))
+
+    def test_lstat_once_per_existing_directory(self):
+        os.mkdir('root/existing')
+        members = [self.member('basename/dir-%d/file-%d' % (i % 10, i)) for i in range(1000)]
+        members += [self.member('existing/file-%d' % i) for i in range(10)]
+        with mock.patch('os.lstat', wraps=os.lstat) as lstat:
+            self.check(*members)
+        # basename, existing, and each of the files in existing
+        self.assertEqual(lstat.call_count, 12)
+
+
+class ExtractZipTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        self.contents = {}
+        with zipfile.ZipFile('basename.zip', 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('basename/', '')
+            for i in range(20):
+                # no entries for these directories
+                name = 'basename/dir-%d/file-%d' % (i % 3, i)
+                self.contents[name] = os.urandom(i * 3000) + b'\0' * 10000
+                z.writestr(name, self.contents[name])
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def make_zip(self, name, mode=0o644):
+        info = zipfile.ZipInfo(name)
+        info.external_attr = mode << 16
+        with zipfile.ZipFile('other.zip', 'w') as z:
+            z.writestr(info, b'data')
+
+    def assert_extracted(self, path='.'):
+        for name, data in self.contents.items():
+            self.assertEqual(open(os.path.join(path, name), 'rb').read(), data)
+
+    def test_extract_serial(self):
+        tooltool.extract_zip('basename.zip', jobs=1)
+        self.assert_extracted()
+
+    def test_extract_parallel(self):
+        with mock.patch('zipfile.ZipFile', wraps=zipfile.ZipFile) as ZipFile:
+            tooltool.extract_zip('basename.zip', 'dest', jobs=4)
+            # one to list the entries, and one per thread
+            self.assertTrue(2 < ZipFile.call_count <= 5)
+        self.assert_extracted('dest')
+
+    def test_preallocate(self):
+        with mock.patch('tooltool._preallocate') as preallocate:
+            tooltool.extract_zip('basename.zip', jobs=2)
+        self.assertEqual(sorted(call[0][1] for call in preallocate.call_args_list),
+                         sorted(len(data) for data in self.contents.values()))
+
+    def test_traversal(self):
+        self.make_zip('../evil')
+        self.assertRaises(Exception, lambda: tooltool.extract_zip('other.zip', 'dest'))
+        self.assertFalse(os.path.exists('evil'))
+
+    def test_absolute(self):
+        self.make_zip('/tmp/evil')
+        self.assertRaises(Exception, lambda: tooltool.extract_zip('other.zip', 'dest'))
+
+    def test_setuid(self):
+        self.make_zip('basename/setuid', 0o4755)
+        self.assertRaises(Exception, lambda: tooltool.extract_zip('other.zip'))
+        self.assertFalse(os.path.exists('basename/setuid'))
+
+    def test_existing_symlink(self):
+        os.mkdir('outside')
+        os.mkdir('dest')
+        os.symlink(os.path.abspath('outside'), 'dest/basename')
+        self.assertRaises(Exception, lambda: tooltool.extract_zip('basename.zip', 'dest'))
+        self.assertEqual(os.listdir('outside'), [])
 
 
 def test_touch():
@@ -1383,17 +2785,22 @@ class PurgeTests(TestDirMixin, unittest.TestCase):
     def tearDown(self):
         self.tearDownTestDir()
 
+    def listdir(self):
+        # ignoring the cache index and lock files
+        return sorted(f for f in os.listdir(self.test_dir) if not f.startswith('.'))
+
     def fake_freespace(self, p):
         # A fake 10G drive, with each file = 1G
         self.assertEqual(p, self.test_dir)
-        return 1024 ** 3 * (10 - len(os.listdir(self.test_dir)))
+        return 1024 ** 3 * (10 - len(self.listdir()))
 
     def add_files(self, *files):
         now = 1426127031
-        # add files, with ordered mtime
+        # add sparse 1G files, with ordered mtime
         for f in files:
             path = os.path.join(self.test_dir, f)
-            open(path, 'wb')
+            with open(path, 'wb') as fh:
+                fh.truncate(1024 ** 3)
             os.utime(path, (now, now))
             now += 10
 
@@ -1403,7 +2810,7 @@ class PurgeTests(TestDirMixin, unittest.TestCase):
         os.chmod(self.test_dir, 0o500)  # prevent delete
         try:
             tooltool.purge(self.test_dir, 0)
-            self.assertEqual(os.listdir(self.test_dir), ['sticky'])
+            self.assertEqual(self.listdir(), ['sticky'])
         finally:
             os.chmod(self.test_dir, 0o700)
 
@@ -1411,7 +2818,7 @@ class PurgeTests(TestDirMixin, unittest.TestCase):
         path = os.path.join(self.test_dir, 'somedir')
         os.mkdir(path)
         tooltool.purge(self.test_dir, 0)
-        self.assertEqual(os.listdir(self.test_dir), ['somedir'])
+        self.assertEqual(self.listdir(), ['somedir'])
 
     def test_purge_nonzero(self):
         # six files means six gigs consumed, so we'll delete two
@@ -1419,21 +2826,67 @@ class PurgeTests(TestDirMixin, unittest.TestCase):
         with mock.patch('tooltool.freespace') as freespace:
             freespace.side_effect = self.fake_freespace
             tooltool.purge(self.test_dir, 6)
-        self.assertEqual(sorted(os.listdir(self.test_dir)),
+        self.assertEqual(self.listdir(),
             sorted(['three', 'four', 'five', 'six']))
 
+    def test_purge_statvfs_once(self):
+        """The free space is only checked once, however many files are deleted"""
+        self.add_files("one", "two", "three", "four", "five", "six")
+        with mock.patch('tooltool.freespace') as freespace:
+            freespace.side_effect = self.fake_freespace
+            tooltool.purge(self.test_dir, 8)
+        self.assertEqual(freespace.call_count, 1)
+        self.assertEqual(self.listdir(), sorted(['five', 'six']))
+
+    def test_purge_max_size(self):
+        self.add_files("one", "two", "three", "four", "five", "six")
+        with mock.patch('tooltool.freespace') as freespace:
+            tooltool.purge(self.test_dir, 0, max_size=2.5)
+            self.assertFalse(freespace.called)
+        self.assertEqual(self.listdir(), sorted(['five', 'six']))
+
+    def test_purge_max_size_and_gigs(self):
+        """With both a free space goal and a maximum size, both are met"""
+        self.add_files("one", "two", "three", "four", "five", "six")
+        with mock.patch('tooltool.freespace') as freespace:
+            freespace.side_effect = self.fake_freespace
+            tooltool.purge(self.test_dir, 5, max_size=4)
+        self.assertEqual(self.listdir(), sorted(['three', 'four', 'five', 'six']))
+
+    def test_purge_max_size_no_need(self):
+        self.add_files("one", "two")
+        tooltool.purge(self.test_dir, 0, max_size=2)
+        self.assertEqual(self.listdir(), ['one', 'two'])
+
+    def test_purge_least_recently_used(self):
+        """Files retrieved from the cache recently are purged last"""
+        self.add_files("one", "two", "three")
+        cache = tooltool.LocalCache(self.test_dir)
+        cache.retrieve("one", os.path.join(self.test_dir, ".retrieved"))
+        cache.close()
+        tooltool.purge(self.test_dir, 0, max_size=1)
+        self.assertEqual(self.listdir(), ['one'])
+
+    def test_purge_threads(self):
+        self.add_files("one", "two", "three", "four")
+        with BufferHandler.capture('tooltool') as logged:
+            tooltool.purge(self.test_dir, 0, max_size=1, jobs=3)
+        self.assertEqual(self.listdir(), ['four'])
+        self.assertTrue(logged[-1][1].startswith(
+            "Purged 3 files from %s, reclaiming 3221.2 MB in " % self.test_dir), logged)
+
     def test_purge_no_need(self):
         self.add_files("one", "two")
         with mock.patch('tooltool.freespace') as freespace:
             freespace.side_effect = self.fake_freespace
             tooltool.purge(self.test_dir, 4)
-        self.assertEqual(sorted(os.listdir(self.test_dir)),
+        self.assertEqual(self.listdir(),
             sorted(['one', 'two']))
 
     def test_purge_zero(self):
         self.add_files("one", "two", "three")
         tooltool.purge(self.test_dir, 0)
-        self.assertEqual(os.listdir(self.test_dir), [])
+        self.assertEqual(self.listdir(), [])
 
     def test_freespace(self):
         # we can't set up a dedicated partition for this test, so just assume
@@ -26,14 +26,18 @@ import base64
 import calendar
 import hashlib
 import hmac
+import io
 import json
 import logging
 import math
 import optparse
 import os
 import pprint
+import queue
 import re
 import shutil
+import socket
+import sqlite3
 import ssl
 import stat
 import sys
@@ -42,7 +46,8 @@ import tempfile
 import threading
 import time
 import zipfile
-from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager, nullcontext
 from functools import wraps
 from io import open
 from random import random
@@ -50,6 +55,8 @@ from subprocess import PIPE, Popen
 
 if os.name == "nt":
     import certifi
+else:
+    import fcntl
 
 __version__ = "1.4.0"
 
@@ -63,7 +70,7 @@ TOOLTOOL_PACKAGE_SUFFIX = ".TOOLTOOL-PACKAGE"
 HAWK_VER = 1
 
 import urllib.request as urllib2
-from http.client import HTTPConnection, HTTPSConnection
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
 from urllib.error import HTTPError, URLError
 from urllib.parse import urljoin, urlparse
 from urllib.request import Request
@@ -508,8 +515,7 @@ class FileRecord(object):
 
     def validate_digest(self):
         if self.present():
-            with open(self.filename, "rb") as f:
-                return self.digest == digest_file(f, self.algorithm)
+            return self.digest == file_digest(self.filename, self.algorithm)
         else:
             log.debug("trying to validate digest on a missing file, %s', self.filename")
             raise MissingFileException(filename=self.filename)
@@ -530,16 +536,13 @@ class FileRecord(object):
 
 
 def create_file_record(filename, algorithm):
-    fo = open(filename, "rb")
     stored_filename = os.path.split(filename)[1]
-    fr = FileRecord(
+    return FileRecord(
         stored_filename,
         os.path.getsize(filename),
-        digest_file(fo, algorithm),
+        file_digest(filename, algorithm),
         algorithm,
     )
-    fo.close()
-    return fr
 
 
 class FileRecordJSONEncoder(json.JSONEncoder):
@@ -666,10 +669,10 @@ class Manifest(object):
         return all(i.validate_size() for i in self.file_records)
 
     def validate_digests(self):
-        return all(i.validate_digest() for i in self.file_records)
+        return all(digest_map(FileRecord.validate_digest, self.file_records))
 
     def validate(self):
-        return all(i.validate() for i in self.file_records)
+        return all(digest_map(FileRecord.validate, self.file_records))
 
     def load(self, data_file, fmt="json"):
         assert fmt in self.valid_formats
@@ -713,20 +716,136 @@ class Manifest(object):
             )
 
 
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+# hashlib releases the GIL while hashing large buffers, so hashing several
+# files on threads uses several cores
+DIGEST_JOBS = min(8, os.cpu_count() or 1)
+
+
 def digest_file(f, a):
     """I take a file like object 'f' and return a hex-string containing
     of the result of the algorithm 'a' applied to 'f'."""
     h = hashlib.new(a)
-    chunk_size = 1024 * 10
-    data = f.read(chunk_size)
-    while data:
-        h.update(data)
-        data = f.read(chunk_size)
+    if hasattr(f, "readinto"):
+        # reuse a single large buffer rather than allocating one per read
+        buf = bytearray(DIGEST_CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    else:
+        data = f.read(DIGEST_CHUNK_SIZE)
+        while data:
+            h.update(data)
+            data = f.read(DIGEST_CHUNK_SIZE)
     name = repr(f.name) if hasattr(f, "name") else "a file"
     log.debug("hashed %s with %s to be %s", name, a, h.hexdigest())
     return h.hexdigest()
 
 
+def digest_map(func, items, jobs=None):
+    """I return the list of `func(item)` for each item, calling `func` on
+    DIGEST_JOBS threads (or `jobs`, if given).  This is meant for functions
+    which spend their time hashing files."""
+    items = list(items)
+    jobs = jobs or DIGEST_JOBS
+    if jobs == 1 or len(items) < 2:
+        return [func(i) for i in items]
+    with ThreadPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+class DigestCache(object):
+    """I remember the digests of files in a sqlite database, keyed by
+    device, inode and algorithm.  An entry is only used while the size,
+    mtime and ctime of the file are still those it was hashed with."""
+
+    # a file modified this recently could change again without its mtime
+    # changing, given the timestamp granularity of some filesystems, so its
+    # digest isn't remembered
+    racy_ns = 2 * 10**9
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "dev INTEGER, ino INTEGER, algorithm TEXT, "
+            "size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, digest TEXT, "
+            "PRIMARY KEY (dev, ino, algorithm))"
+        )
+
+    def lookup(self, st, algorithm):
+        """I return the digest of the file with stat result `st`, or None"""
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT size, mtime_ns, ctime_ns, digest FROM digests "
+                    "WHERE dev = ? AND ino = ? AND algorithm = ?",
+                    (st.st_dev, st.st_ino, algorithm),
+                ).fetchone()
+        except sqlite3.Error:
+            log.debug("failed to read digest cache %s" % self.path, exc_info=True)
+            return None
+        if row and tuple(row[:3]) == (st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+            return row[3]
+        return None
+
+    def store(self, st, algorithm, digest):
+        if time.time_ns() - st.st_mtime_ns < self.racy_ns:
+            return
+        try:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        st.st_dev,
+                        st.st_ino,
+                        algorithm,
+                        st.st_size,
+                        st.st_mtime_ns,
+                        st.st_ctime_ns,
+                        digest,
+                    ),
+                )
+        except sqlite3.Error:
+            log.debug("failed to write digest cache %s" % self.path, exc_info=True)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# the DigestCache given with --digest-cache, if any
+_digest_cache = None
+
+
+def _stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def file_digest(filename, algorithm):
+    """I return the digest of the file named `filename`, using the digest
+    cache if there is one and it knows the file as it is now."""
+    cache = _digest_cache
+    with open(filename, "rb") as f:
+        st = os.fstat(f.fileno())
+        if cache is not None:
+            digest = cache.lookup(st, algorithm)
+            if digest is not None:
+                log.debug("found digest of %r in the digest cache" % filename)
+                return digest
+        digest = digest_file(f, algorithm)
+        # don't remember a digest if the file changed while it was hashed
+        if cache is not None and _stat_key(st) == _stat_key(os.fstat(f.fileno())):
+            cache.store(st, algorithm, digest)
+    return digest
+
+
 def execute(cmd):
     """Execute CMD, logging its stdout at the info level"""
     process = Popen(cmd, shell=True, stdout=PIPE)
@@ -764,11 +883,14 @@ def list_manifest(manifest_file):
             )
         )
         return False
-    for f in manifest.file_records:
+    states = digest_map(
+        lambda f: (f.present(), f.present() and f.validate()), manifest.file_records
+    )
+    for f, (present, valid) in zip(manifest.file_records, states):
         print(
             "{}\t{}\t{}".format(
-                "P" if f.present() else "-",
-                "V" if f.present() and f.validate() else "-",
+                "P" if present else "-",
+                "V" if valid else "-",
                 f.filename,
             )
         )
@@ -791,10 +913,13 @@ def validate_manifest(manifest_file):
         return False
     invalid_files = []
     absent_files = []
-    for f in manifest.file_records:
-        if not f.present():
+    states = digest_map(
+        lambda f: (f.present(), f.present() and f.validate()), manifest.file_records
+    )
+    for f, (present, valid) in zip(manifest.file_records, states):
+        if not present:
             absent_files.append(f)
-        elif not f.validate():
+        elif not valid:
             invalid_files.append(f)
     if len(invalid_files + absent_files) == 0:
         return True
@@ -815,10 +940,11 @@ def add_files(manifest_file, algorithm, filenames, version, visibility, unpack):
         old_manifest = Manifest()
         log.debug("creating a new manifest file")
     new_manifest = Manifest()  # use a different manifest for the output
-    for filename in filenames:
+    new_records = digest_map(
+        lambda filename: create_file_record(filename, algorithm), filenames
+    )
+    for filename, new_fr in zip(filenames, new_records):
         log.debug("adding %s" % filename)
-        path, name = os.path.split(filename)
-        new_fr = create_file_record(filename, algorithm)
         new_fr.version = version
         new_fr.visibility = visibility
         new_fr.unpack = unpack
@@ -863,76 +989,451 @@ def touch(f):
         log.warning("impossible to update utime of file %s" % f)
 
 
+class _PooledHTTPResponse(HTTPResponse):
+    """I am an HTTP response which gives my connection back to the pool it
+    came from once my body has been read completely."""
+
+    _pool_release = None
+
+    def _release(self, reusable):
+        release, self._pool_release = self._pool_release, None
+        if release is not None:
+            release(reusable)
+
+    def _close_conn(self):
+        # this is called when the end of the body is reached, but also when
+        # the body is cut short
+        complete = self.chunked or self.length == 0
+        HTTPResponse._close_conn(self)
+        self._release(complete and not self.will_close)
+
+    def close(self):
+        if self.fp is not None:
+            # the rest of the body is still waiting on the connection
+            self._release(False)
+        HTTPResponse.close(self)
+
+
+class ConnectionPool(object):
+    """I keep idle keep-alive connections to each host seen during a tooltool
+    run, so that requests to the API server, S3 and CloudFront can reuse them
+    instead of paying for a new TCP and TLS handshake every time."""
+
+    max_idle_per_host = 16
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._ssl_context = None
+        self.opened = 0
+        self.reused = 0
+
+    def _get_ssl_context(self):
+        with self._lock:
+            if self._ssl_context is None:
+                cafile = certifi.where() if os.name == "nt" else None
+                self._ssl_context = ssl.create_default_context(cafile=cafile)
+            return self._ssl_context
+
+    def _get(self, key, timeout):
+        scheme, host = key
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+            if conn:
+                self.reused += 1
+            else:
+                self.opened += 1
+            counts = (self.opened, self.reused)
+        if conn:
+            log.debug(
+                "reusing connection to %s://%s (%d opened, %d reused)"
+                % ((scheme, host) + counts)
+            )
+            return conn, True
+        log.debug(
+            "opening connection to %s://%s (%d opened, %d reused)"
+            % ((scheme, host) + counts)
+        )
+        if scheme == "https":
+            conn = HTTPSConnection(
+                host, timeout=timeout, context=self._get_ssl_context()
+            )
+        else:
+            conn = HTTPConnection(host, timeout=timeout)
+        conn.response_class = _PooledHTTPResponse
+        return conn, False
+
+    def _release(self, key, conn, reusable):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def request(
+        self,
+        scheme,
+        host,
+        method,
+        url,
+        body=None,
+        headers={},
+        timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+        **kwargs
+    ):
+        """I send a request to `host` and return the response.  An idle
+        connection is used if there is one; if the server turns out to have
+        closed it in the meantime, the request is sent again on another
+        connection."""
+        key = (scheme, host)
+        while True:
+            conn, reused = self._get(key, timeout)
+            try:
+                conn.request(method, url, body, headers, **kwargs)
+                resp = conn.getresponse()
+            except (OSError, HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                log.debug("idle connection to %s://%s was closed" % key)
+                if hasattr(body, "seek"):
+                    body.seek(0)
+                continue
+            resp._pool_release = lambda reusable: self._release(key, conn, reusable)
+            return resp
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+_connection_pool = ConnectionPool()
+
+
+def _pooled_open(scheme, req):
+    # this mirrors urllib.request.AbstractHTTPHandler.do_open, without
+    # forcing "Connection: close"
+    if not req.host:
+        raise URLError("no host given")
+    headers = dict(req.unredirected_hdrs)
+    headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+    headers = dict((name.title(), val) for name, val in headers.items())
+    try:
+        r = _connection_pool.request(
+            scheme,
+            req.host,
+            req.get_method(),
+            req.selector,
+            req.data,
+            headers,
+            timeout=req.timeout,
+            encode_chunked=req.has_header("Transfer-encoding"),
+        )
+    except OSError as err:
+        if isinstance(err, URLError):
+            raise
+        raise URLError(err)
+    r.url = req.get_full_url()
+    r.msg = r.reason
+    return r
+
+
+class _PooledHTTPHandler(urllib2.HTTPHandler):
+    def http_open(self, req):
+        return _pooled_open("http", req)
+
+
+class _PooledHTTPSHandler(urllib2.HTTPSHandler):
+    def https_open(self, req):
+        if req._tunnel_host:
+            # connections tunneled through a proxy aren't pooled
+            return urllib2.HTTPSHandler.https_open(self, req)
+        return _pooled_open("https", req)
+
+
+_opener = urllib2.build_opener(_PooledHTTPHandler, _PooledHTTPSHandler)
+
+
 def _urlopen(req):
-    ssl_context = None
-    if os.name == "nt":
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-    return urllib2.urlopen(req, context=ssl_context)
+    return _opener.open(req)
 
 
 @contextmanager
 @retriable(sleeptime=2)
-def request(url, auth_file=None):
+def request(url, auth_file=None, headers=None):
     req = Request(url)
+    # headers added this way are kept when following redirects
+    for name, value in (headers or {}).items():
+        req.add_header(name, value)
     _authorize(req, auth_file)
     with closing(_urlopen(req)) as f:
         log.debug("opened %s for reading" % url)
         yield f
 
 
-def fetch_file(base_urls, file_record, grabchunk=1024 * 4, auth_file=None, region=None):
+PARTIAL_SUFFIX = ".partial"
+
+_partial_locks = {}
+_partial_locks_lock = threading.Lock()
+
+
+def _partial_lock(partial_path):
+    """I return the lock guarding writes to `partial_path`, so that two
+    manifest entries with the same digest fetched in parallel don't write to
+    the same partial file."""
+    with _partial_locks_lock:
+        return _partial_locks.setdefault(partial_path, threading.Lock())
+
+
+def _discard_partial(partial_path):
+    try:
+        os.remove(partial_path)
+    except OSError:
+        pass
+
+
+def _resume_partial(file_record, partial_path):
+    """I return a hash object and a size describing the data an earlier,
+    interrupted download left in `partial_path`.  Hash objects can't be
+    saved, so the local data is hashed again, which is much cheaper than
+    downloading it again."""
+    h = hashlib.new(file_record.algorithm)
+    size = 0
+    try:
+        with open(partial_path, mode="rb") as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+                size += len(data)
+    except FileNotFoundError:
+        return h, 0
+    except IOError:
+        log.info("failed to read partial download %s" % partial_path, exc_info=True)
+        _discard_partial(partial_path)
+        return hashlib.new(file_record.algorithm), 0
+    if file_record.size is not None and size > file_record.size:
+        log.info(
+            "partial download %s is larger than %s, discarding it"
+            % (partial_path, file_record.filename)
+        )
+        _discard_partial(partial_path)
+        return hashlib.new(file_record.algorithm), 0
+    if size:
+        log.info(
+            "Found %d bytes of a previous download of %s" % (size, file_record.filename)
+        )
+    return h, size
+
+
+def resolve_files(base_urls, file_records, auth_file=None):
+    """I ask the servers for download links to all of `file_records` in a
+    single request each, and return what the servers know of the files,
+    keyed by digest.  Files the servers didn't resolve, or every file if
+    none of them supports this, are left out, for fetch_file to ask for one
+    at a time."""
+    digests = sorted(set(f.digest for f in file_records if f.algorithm == "sha512"))
+    resolved = {}
+    for base_url in base_urls:
+        remaining = [digest for digest in digests if digest not in resolved]
+        if not remaining:
+            break
+        data = json.dumps({"digests": remaining}).encode("utf-8")
+        req = Request(
+            urljoin(base_url, "resolve"), data, {"Content-Type": "application/json"}
+        )
+        _authorize(req, auth_file)
+        try:
+            with closing(_urlopen(req)) as resp:
+                result = json.load(resp)["result"]
+        except (URLError, HTTPException, ValueError, KeyError):
+            log.info("...failed to resolve files at %s" % base_url, exc_info=True)
+            continue
+        for digest in remaining:
+            if result.get(digest, {}).get("get_url"):
+                resolved[digest] = result[digest]
+    log.debug("resolved %d of %d files" % (len(resolved), len(digests)))
+    return resolved
+
+
+def fetch_file(
+    base_urls,
+    file_record,
+    grabchunk=1024 * 4,
+    auth_file=None,
+    region=None,
+    sink=None,
+    resolved_url=None,
+):
+    """I download the file described by `file_record` to a file in the
+    current working directory and return its name, or None if no server
+    could provide it.  The size and digest are computed while the data is
+    written, so the returned file is already known to be valid.
+
+    Interrupted downloads are kept in a file named after the digest, and
+    the next server, or the next run, is asked for the rest of the file
+    with a Range request.
+
+    If `sink` is given, every chunk written to the file is also given to its
+    `write` method, for as long as the data so far is the beginning of the
+    file; if that stops being true, `sink.abandon()` is called.
+
+    A `resolved_url` from resolve_files is tried before the servers, which
+    are still asked if it has expired in the meantime."""
     # A file which is requested to be fetched that exists locally will be
     # overwritten by this function
-    fd, temp_path = tempfile.mkstemp(dir=os.getcwd())
-    os.close(fd)
-    fetched_path = None
+    partial_path = os.path.join(os.getcwd(), file_record.digest + PARTIAL_SUFFIX)
+    with _partial_lock(partial_path):
+        return _fetch_file(
+            base_urls,
+            file_record,
+            partial_path,
+            grabchunk,
+            auth_file,
+            region,
+            sink,
+            resolved_url,
+        )
+
+
+def _fetch_file(
+    base_urls,
+    file_record,
+    partial_path,
+    grabchunk,
+    auth_file,
+    region,
+    sink=None,
+    resolved_url=None,
+):
+    h, size = _resume_partial(file_record, partial_path)
+    if sink is not None and size:
+        # the sink would need the data downloaded by an earlier run
+        sink.abandon()
+        sink = None
+
+    def start_over():
+        nonlocal h, size, sink
+        if sink is not None and size:
+            sink.abandon()
+            sink = None
+        h, size = hashlib.new(file_record.algorithm), 0
+
+    def verified():
+        return (
+            file_record.size is None or size == file_record.size
+        ) and h.hexdigest() == file_record.digest
+
+    if size and size == file_record.size:
+        # an earlier run got all of the data but didn't get to use it
+        if verified():
+            log.info(
+                "File %s was already fully downloaded as %s"
+                % (file_record.filename, partial_path)
+            )
+            return os.path.split(partial_path)[1]
+        _discard_partial(partial_path)
+        start_over()
+
+    sources = []
+    if resolved_url is not None:
+        # the link is signed, and needs no authentication
+        sources.append((urlparse(resolved_url).netloc, resolved_url, None))
     for base_url in base_urls:
         # Generate the URL for the file on the server side
         url = urljoin(base_url, "%s/%s" % (file_record.algorithm, file_record.digest))
         if region is not None:
             url += "?region=" + region
+        sources.append((base_url, url, auth_file))
 
+    fetched_path = None
+    for base_url, url, source_auth_file in sources:
         log.info("Attempting to fetch from '%s'..." % base_url)
 
-        # Well, the file doesn't exist locally.  Let's fetch it.
+        headers = {}
+        if size:
+            headers["Range"] = "bytes=%d-" % size
         try:
-            with request(url, auth_file) as f, open(temp_path, mode="wb") as out:
-                k = True
-                size = 0
-                while k:
-                    # TODO: print statistics as file transfers happen both for info and to stop
-                    # buildbot timeouts
-                    indata = f.read(grabchunk)
-                    out.write(indata)
-                    size += len(indata)
-                    if len(indata) == 0:
-                        k = False
-                log.info(
-                    "File %s fetched from %s as %s"
-                    % (file_record.filename, base_url, temp_path)
-                )
-                fetched_path = temp_path
-                break
-        except (URLError, HTTPError, ValueError):
+            with request(url, source_auth_file, headers=headers) as f:
+                if size and getattr(f, "status", None) != 206:
+                    log.info(
+                        "...%s doesn't support resuming downloads, starting over"
+                        % base_url
+                    )
+                    start_over()
+                elif size:
+                    log.info("...resuming download at byte %d" % size)
+                with open(partial_path, mode="r+b" if size else "wb") as out:
+                    # anything after `size` wasn't accounted for by the hash
+                    out.seek(size)
+                    out.truncate()
+                    while True:
+                        # TODO: print statistics as file transfers happen both for info and to stop
+                        # buildbot timeouts
+                        indata = f.read(grabchunk)
+                        if len(indata) == 0:
+                            break
+                        if (
+                            file_record.size is not None
+                            and size + len(indata) > file_record.size
+                        ):
+                            # no need to download the rest of a file which is
+                            # already known to be wrong
+                            raise DigestMismatchException(filename=file_record.filename)
+                        out.write(indata)
+                        h.update(indata)
+                        size += len(indata)
+                        if sink is not None:
+                            sink.write(indata)
+            if not verified():
+                raise DigestMismatchException(filename=file_record.filename)
+            log.info(
+                "File %s fetched from %s as %s and verified"
+                % (file_record.filename, base_url, partial_path)
+            )
+            fetched_path = partial_path
+            break
+        except DigestMismatchException:
+            log.error(
+                "...'%s' fetched from %s does not match the manifest"
+                % (file_record.filename, base_url)
+            )
+            _discard_partial(partial_path)
+            start_over()
+        except HTTPError as e:
             log.info(
                 "...failed to fetch '%s' from %s" % (file_record.filename, base_url),
                 exc_info=True,
             )
-        except IOError:  # pragma: no cover
+            if e.code == 416:
+                # the data we have can't be the start of this file
+                _discard_partial(partial_path)
+                start_over()
+        except (URLError, HTTPException, ValueError):
             log.info(
-                "failed to write to temporary file for '%s'" % file_record.filename,
+                "...failed to fetch '%s' from %s" % (file_record.filename, base_url),
+                exc_info=True,
+            )
+        except IOError:
+            log.info(
+                "...failed to download '%s' from %s to %s"
+                % (file_record.filename, base_url, partial_path),
                 exc_info=True,
             )
 
-    # cleanup temp file in case of issues
     if fetched_path:
         return os.path.split(fetched_path)[1]
-    else:
-        try:
-            os.remove(temp_path)
-        except OSError:  # pragma: no cover
-            pass
-        return None
+    if not size:
+        # nothing worth resuming later
+        _discard_partial(partial_path)
+    return None
 
 
 def clean_path(dirname):
@@ -959,11 +1460,392 @@ def validate_tar_member(member, path):
         link_path = os.path.join(os.path.dirname(member_path), member.linkname)
         if not _is_within_directory(path, link_path):
             raise Exception("Attempted link path traversal in tar file: " + member.name)
+    if member.islnk():
+        link_path = os.path.join(path, member.linkname)
+        if not _is_within_directory(path, link_path):
+            raise Exception(
+                "Attempted hard link path traversal in tar file: " + member.name
+            )
     if member.mode & (stat.S_ISUID | stat.S_ISGID):
         raise Exception("Attempted setuid or setgid in tar file: " + member.name)
 
 
+class _Undecided(Exception):
+    pass
+
+
+def _path_parts(name):
+    return os.path.normcase(name).replace(os.sep, "/").split("/")
+
+
+class _TarMemberValidator(object):
+    """I check tar members the way validate_tar_member() does, but without
+    calling os.path.realpath for each of them.  Member paths are resolved
+    against a model of the extraction directory `path`: its real path is
+    computed once, the symlinks extracted from the archive are remembered,
+    and the filesystem is only looked at for directories which existed
+    before the extraction, once each.  Anything the model cannot settle
+    (absolute paths, symlinks which were already on disk, ...) is left to
+    validate_tar_member()."""
+
+    # as many symlinks as os.path.realpath would follow on Linux
+    max_hops = 40
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.realpath(path)
+        # what the path, as a tuple of components relative to the root, is
+        # known to be: a symlink target, "new" (created by the extraction,
+        # as is everything below it) or "plain" (not a symlink)
+        self._links = {}
+        self._state = {}
+        # the paths with something below them in either, and those of hard
+        # links, which are looked at on disk even below a new directory
+        self._parents = set()
+        self._hardlinks = set()
+        self._undecided = False
+        self._hops = 0
+
+    def _resolve(self, parts):
+        """Return the components, relative to the root, of the real path of
+        the relative path made of `parts`, or None if it is outside the
+        root."""
+        resolved = []
+        for part in parts:
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if not resolved:
+                    return None
+                resolved.pop()
+                continue
+            resolved.append(part)
+            key = tuple(resolved)
+            target = self._links.get(key)
+            if target is not None:
+                self._hops += 1
+                if self._hops > self.max_hops or os.path.isabs(target):
+                    raise _Undecided()
+                resolved = self._resolve(resolved[:-1] + _path_parts(target))
+                if resolved is None:
+                    return None
+            elif key not in self._state:
+                self._parents.add(key[:-1])
+                if self._state.get(key[:-1]) == "new" and key not in self._hardlinks:
+                    self._state[key] = "new"
+                    continue
+                try:
+                    st = os.lstat(os.path.join(self.root, *key))
+                except OSError:
+                    self._state[key] = "new"
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    raise _Undecided()
+                self._state[key] = "plain"
+        return resolved
+
+    def _check(self, member):
+        if os.path.isabs(member.name) or os.path.splitdrive(member.name)[0]:
+            raise _Undecided()
+        self._hops = 0
+        parts = _path_parts(member.name)
+        resolved = self._resolve(parts)
+        if resolved is None:
+            raise Exception("Attempted path traversal in tar file: " + member.name)
+        if member.issym():
+            if os.path.isabs(member.linkname) or parts[-1] in ("", ".", ".."):
+                raise _Undecided()
+            parent = self._resolve(parts[:-1])
+            if (
+                parent is None
+                or self._resolve(parent + _path_parts(member.linkname)) is None
+            ):
+                raise Exception(
+                    "Attempted link path traversal in tar file: " + member.name
+                )
+            self._links[tuple(parent + [parts[-1]])] = member.linkname
+            self._parents.add(tuple(parent))
+        if member.islnk():
+            if os.path.isabs(member.linkname):
+                raise _Undecided()
+            if self._resolve(_path_parts(member.linkname)) is None:
+                raise Exception(
+                    "Attempted hard link path traversal in tar file: " + member.name
+                )
+            # What the hard link ends up being is not in the model: a link to
+            # a symlink, or the copy of a symlink tarfile makes when linking
+            # fails, is a symlink of its own.  Forget what is known of its
+            # path, so that it is looked at on disk, once extracted.  tarfile
+            # replaces the last component of the member's path, even if it
+            # is a symlink.
+            if parts[-1] in ("", ".", ".."):
+                raise _Undecided()
+            key = tuple(self._resolve(parts[:-1]) + [parts[-1]])
+            self._hardlinks.add(key)
+            self._links.pop(key, None)
+            self._state.pop(key, None)
+            if key in self._parents:
+                for known in (self._links, self._state):
+                    for path in [path for path in known if path[: len(key)] == key]:
+                        del known[path]
+        if member.mode & (stat.S_ISUID | stat.S_ISGID):
+            raise Exception("Attempted setuid or setgid in tar file: " + member.name)
+
+    def check(self, member):
+        """I raise an exception if extracting `member` would write outside
+        of the extraction directory or create a setuid or setgid file."""
+        if not self._undecided:
+            try:
+                self._check(member)
+                return
+            except _Undecided:
+                # the model is incomplete from now on
+                self._undecided = True
+        validate_tar_member(member, self.path)
+
+
+# archives are decompressed, and their small files written, on this many
+# threads
+UNPACK_JOBS = min(8, os.cpu_count() or 1)
+
+# regular files up to this size are written by the writer threads of
+# TarFile.extractall, larger ones as they are read from the archive
+UNPACK_WRITE_LIMIT = 4 * 1024 * 1024
+
+# how much member data, or decompressed data, can wait in memory for a thread
+UNPACK_BUFFER_SIZE = 64 * 1024 * 1024
+
+ZSTD_MAGIC = 0xFD2FB528
+
+
+def _zstd_frames(f):
+    """Return the offset and size of each frame of the zstd file `f`, as
+    found by walking the frame and block headers, or None if that cannot be
+    done (e.g. `f` is not a zstd file)."""
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    frames = []
+    offset = 0
+    while offset < end:
+        f.seek(offset)
+        header = f.read(14)
+        if len(header) < 8:
+            return None
+        magic = int.from_bytes(header[:4], "little")
+        if magic & 0xFFFFFFF0 == 0x184D2A50:
+            # skippable frame, with no content
+            offset += 8 + int.from_bytes(header[4:8], "little")
+            continue
+        if magic != ZSTD_MAGIC:
+            return None
+        descriptor = header[4]
+        single_segment = (descriptor >> 5) & 1
+        pos = offset + 5 + (not single_segment)
+        pos += (0, 1, 2, 4)[descriptor & 3]
+        pos += (single_segment, 2, 4, 8)[descriptor >> 6]
+        while True:
+            f.seek(pos)
+            block = f.read(3)
+            if len(block) < 3:
+                return None
+            block = int.from_bytes(block, "little")
+            block_type = (block >> 1) & 3
+            if block_type == 3:
+                return None
+            # RLE blocks hold a single byte
+            pos += 3 + (1 if block_type == 1 else block >> 3)
+            if block & 1:
+                break
+        if (descriptor >> 2) & 1:
+            pos += 4
+        if pos > end:
+            return None
+        frames.append((offset, pos - offset))
+        offset = pos
+    return frames
+
+
+def _prefetch(chunks, depth=4):
+    """Yield the items of the iterable `chunks`, produced ahead of time on a
+    separate thread."""
+    items = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(done)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _decompress_zstd_frames(f, frames, jobs):
+    """Yield the decompressed content of each of the `frames` of the zstd
+    file `f`, decompressing up to `jobs` frames at the same time."""
+    import zstandard
+
+    local = threading.local()
+
+    def decompress(data):
+        if not hasattr(local, "dctx"):
+            local.dctx = zstandard.ZstdDecompressor()
+        return local.dctx.decompressobj().decompress(data)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = []
+        for offset, size in frames:
+            if len(pending) >= jobs:
+                yield pending.pop(0).result()
+            f.seek(offset)
+            pending.append(executor.submit(decompress, f.read(size)))
+        for future in pending:
+            yield future.result()
+
+
+class _ChunkReader(io.RawIOBase):
+    """I am a readable file object returning the content of an iterable of
+    byte strings."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer = memoryview(chunk)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed and hasattr(self._chunks, "close"):
+            self._chunks.close()
+        super(_ChunkReader, self).close()
+
+
+def zstd_reader(f, jobs=None):
+    """Return a file object reading the decompressed content of the zstd file
+    object `f`.  If `f` is made of several independent frames, they are
+    decompressed on UNPACK_JOBS threads (or `jobs`, if given); otherwise the
+    content is decompressed on a thread of its own, ahead of the reads."""
+    import zstandard
+
+    jobs = jobs or UNPACK_JOBS
+    frames = None
+    if jobs > 1 and f.seekable():
+        frames = _zstd_frames(f)
+    # frames are decompressed into memory all at once
+    max_frame = UNPACK_BUFFER_SIZE // (4 * jobs)
+    if frames and len(frames) > 1 and max(size for _, size in frames) <= max_frame:
+        chunks = _decompress_zstd_frames(f, frames, jobs)
+    else:
+        # when reading from a pipe, whatever follows the first frame is not
+        # necessarily part of the archive
+        seekable = f.seekable()
+        if seekable:
+            f.seek(0)
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=seekable
+        )
+        chunks = _prefetch(iter(lambda: reader.read(DIGEST_CHUNK_SIZE), b""))
+    return io.BufferedReader(_ChunkReader(chunks), DIGEST_CHUNK_SIZE)
+
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class _TarWriter(object):
+    """I run the writes of regular tar members, and the changes to their
+    attributes which follow, on a pool of threads, keeping at most
+    UNPACK_BUFFER_SIZE bytes of member data in memory."""
+
+    def __init__(self, tar, jobs):
+        self.tar = tar
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+        self._pending = {}
+        self._buffered = 0
+
+    def _run(self, calls):
+        for call in calls:
+            try:
+                call[0](*call[1:])
+            except tarfile.ExtractError as e:
+                # like TarFile._handle_nonfatal_error
+                if self.tar.errorlevel > 1:
+                    raise
+                self.tar._dbg(1, "tarfile: %s" % e)
+
+    def submit(self, path, size, calls):
+        self.wait(path)
+        while self._pending and self._buffered + size > UNPACK_BUFFER_SIZE:
+            self.wait(next(iter(self._pending)))
+        self._pending[path] = (self._executor.submit(self._run, calls), size)
+        self._buffered += size
+
+    def wait(self, path):
+        """I wait for the pending write of `path`, if any."""
+        entry = self._pending.pop(path, None)
+        if entry is not None:
+            self._buffered -= entry[1]
+            entry[0].result()
+
+    def drain(self):
+        while self._pending:
+            self.wait(next(iter(self._pending)))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
 class TarFile(tarfile.TarFile):
+    # while extractall() reads the archive, regular files are written on up to
+    # this many threads; with 1, every member is extracted in turn
+    write_jobs = UNPACK_JOBS
+
+    _writer = None
+    _calls = None
+
+    def _wait_for(self, path):
+        if self._writer is not None:
+            self._writer.wait(path)
+
     def _tooltool_do_extract(
         self, extract, member, path="", set_attrs=True, numeric_owner=False, **kwargs
     ):
@@ -971,6 +1853,15 @@ class TarFile(tarfile.TarFile):
         if not isinstance(member, tarfile.TarInfo):
             member = self.getmember(member)
         targetpath = os.path.normcase(os.path.join(path, member.name))
+        # a member may replace an earlier one which is still being written
+        self._wait_for(targetpath)
+        if self._writer is not None and (
+            member.issym() or member.islnk() or os.path.lexists(targetpath)
+        ):
+            # pending writes were checked against the links on disk when they
+            # were submitted, and must not see what this member changes; the
+            # file a hard link points to must also be complete
+            self._writer.drain()
 
         if deferred_links is not None and member.issym():
             if os.path.lexists(targetpath):
@@ -987,6 +1878,7 @@ class TarFile(tarfile.TarFile):
                 )
 
                 if source in self._extracted_members:
+                    self._wait_for(source)
                     shutil.copy(source, targetpath)
                     self.chown(member, targetpath, numeric_owner)
                 else:
@@ -997,7 +1889,10 @@ class TarFile(tarfile.TarFile):
 
         extract(member, path, set_attrs, numeric_owner=numeric_owner, **kwargs)
         if deferred_links is not None:
-            for tarinfo, linkpath, numeric_owner in deferred_links.pop(targetpath, []):
+            links = deferred_links.pop(targetpath, [])
+            if links:
+                self._wait_for(targetpath)
+            for tarinfo, linkpath, numeric_owner in links:
                 shutil.copy(targetpath, linkpath)
                 self.chown(tarinfo, linkpath, numeric_owner)
             self._extracted_members.add(targetpath)
@@ -1010,10 +1905,70 @@ class TarFile(tarfile.TarFile):
     def _extract_one(self, *args, **kwargs):
         self._tooltool_do_extract(super(TarFile, self)._extract_one, *args, **kwargs)
 
+    def _extract_member(self, tarinfo, targetpath, *args, **kwargs):
+        if (
+            self._writer is None
+            or not tarinfo.isreg()
+            or tarinfo.sparse is not None
+            or tarinfo.size > UNPACK_WRITE_LIMIT
+        ):
+            return super(TarFile, self)._extract_member(
+                tarinfo, targetpath, *args, **kwargs
+            )
+        # makefile(), chown(), chmod() and utime() record what they would do
+        # in self._calls, and the writer threads do it
+        self._calls = []
+        try:
+            super(TarFile, self)._extract_member(tarinfo, targetpath, *args, **kwargs)
+            calls = self._calls
+        finally:
+            self._calls = None
+        path = targetpath.rstrip("/").replace("/", os.sep)
+        self._writer.submit(os.path.normcase(path), tarinfo.size, calls)
+
+    def makefile(self, tarinfo, targetpath):
+        if self._calls is None:
+            return super(TarFile, self).makefile(tarinfo, targetpath)
+        self.fileobj.seek(tarinfo.offset_data)
+        data = self.fileobj.read(tarinfo.size)
+        if len(data) != tarinfo.size:
+            raise tarfile.ReadError("unexpected end of data")
+        self._calls.append((_write_file, targetpath, data))
+
+    def _set_attr(self, method, tarinfo, *args):
+        if self._calls is not None:
+            self._calls.append((method, tarinfo) + args)
+            return
+        if tarinfo.isdir() and self._writer is not None:
+            # directories get their attributes once extractall() has
+            # extracted everything, and writing a file would change the mtime
+            # of its directory
+            self._writer.drain()
+        method(tarinfo, *args)
+
+    def chown(self, tarinfo, targetpath, numeric_owner):
+        chown = super(TarFile, self).chown
+        self._set_attr(chown, tarinfo, targetpath, numeric_owner)
+
+    def chmod(self, tarinfo, targetpath):
+        self._set_attr(super(TarFile, self).chmod, tarinfo, targetpath)
+
+    def utime(self, tarinfo, targetpath):
+        self._set_attr(super(TarFile, self).utime, tarinfo, targetpath)
+
     def extractall(self, *args, **kwargs):
         self._deferred_links = {}
         self._extracted_members = set()
-        super(TarFile, self).extractall(*args, **kwargs)
+        if self.write_jobs > 1:
+            self._writer = _TarWriter(self, self.write_jobs)
+        try:
+            super(TarFile, self).extractall(*args, **kwargs)
+            if self._writer is not None:
+                self._writer.drain()
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
         for links in self._deferred_links.values():
             for tarinfo, linkpath, numeric_owner in links:
                 log.warn("Cannot create dangling symbolic link: %s", linkpath)
@@ -1022,14 +1977,88 @@ class TarFile(tarfile.TarFile):
 
 
 def safe_extract(tar, path=".", *, numeric_owner=False):
+    validator = _TarMemberValidator(path)
+
     def _files(tar, path):
         for member in tar:
-            validate_tar_member(member, path)
+            validator.check(member)
             yield member
 
     tar.extractall(path, members=_files(tar, path), numeric_owner=numeric_owner)
 
 
+def _zip_member_info(info):
+    """Return a TarInfo describing what extract_zip() makes of the zip entry
+    `info`, for _TarMemberValidator.  Like ZipFile.extract, extract_zip()
+    writes symlinks as regular files."""
+    member = tarfile.TarInfo(info.filename)
+    member.type = tarfile.DIRTYPE if info.is_dir() else tarfile.REGTYPE
+    member.mode = (info.external_attr >> 16) & 0o7777
+    return member
+
+
+def _preallocate(f, size):
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+def extract_zip(filename, path=".", jobs=None):
+    """Extract the zip file `filename` into `path`, inflating its entries on
+    UNPACK_JOBS threads (or `jobs`, if given).  Entries are checked like the
+    members of tar files are by safe_extract()."""
+    jobs = jobs or UNPACK_JOBS
+    validator = _TarMemberValidator(path)
+    files = {}
+    with zipfile.ZipFile(filename) as z:
+        for info in z.infolist():
+            validator.check(_zip_member_info(info))
+            name = os.path.normpath(os.path.join(*info.filename.split("/")))
+            if name == os.pardir or name.startswith(os.pardir + os.sep):
+                # the validator follows symlinks, but the target is resolved
+                # lexically
+                raise Exception("Attempted path traversal in zip file: " + name)
+            target = os.path.join(path, name)
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+            else:
+                # of several entries with the same name, the last one wins
+                files[target] = info
+    for dirname in sorted(set(os.path.dirname(target) for target in files)):
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    # each entry is compressed on its own, so several of them can be inflated
+    # at the same time, as long as each thread reads from its own ZipFile
+    local = threading.local()
+    opened = []
+
+    def extract(item):
+        target, info = item
+        z = getattr(local, "zip", None)
+        if z is None:
+            z = local.zip = zipfile.ZipFile(filename)
+            opened.append(z)
+        with z.open(info) as src, open(target, "wb") as dst:
+            _preallocate(dst, info.file_size)
+            shutil.copyfileobj(src, dst, DIGEST_CHUNK_SIZE)
+
+    # the largest entries first, so that one of them is not left for last
+    items = sorted(files.items(), key=lambda item: item[1].compress_size, reverse=True)
+    try:
+        if jobs > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+                list(executor.map(extract, items))
+        else:
+            for item in items:
+                extract(item)
+    finally:
+        for z in opened:
+            z.close()
+
+
 def unpack_file(filename):
     """Untar `filename`, assuming it is uncompressed or compressed with bzip2,
     xz, gzip, zst, or unzip a zip file. The file is assumed to contain a single
@@ -1043,194 +2072,774 @@ def unpack_file(filename):
         with TarFile.open(filename) as tar:
             safe_extract(tar)
     elif os.path.isfile(filename) and filename.endswith(".tar.zst"):
-        import zstandard
-
         base_file = filename.replace(".tar.zst", "")
         clean_path(base_file)
         log.info('untarring "%s"' % filename)
-        dctx = zstandard.ZstdDecompressor()
-        with dctx.stream_reader(open(filename, "rb")) as fileobj:
+        with open(filename, "rb") as f, zstd_reader(f) as fileobj:
             with TarFile.open(fileobj=fileobj, mode="r|") as tar:
                 safe_extract(tar)
     elif os.path.isfile(filename) and zipfile.is_zipfile(filename):
         base_file = filename.replace(".zip", "")
         clean_path(base_file)
         log.info('unzipping "%s"' % filename)
-        z = zipfile.ZipFile(filename)
-        z.extractall()
-        z.close()
+        extract_zip(filename)
     else:
         log.error("Unknown archive extension for filename '%s'" % filename)
         return False
     return True
 
 
-def fetch_files(
-    manifest_file,
-    base_urls,
-    filenames=[],
-    cache_folder=None,
-    auth_file=None,
-    region=None,
-):
-    # Lets load the manifest file
+def unpacked_path(filename):
+    """Return the directory unpack_file() expects `filename` to unpack to."""
+    if filename.endswith(".tar.zst"):
+        return filename.replace(".tar.zst", "")
+    if filename.endswith(".zip"):
+        return filename.replace(".zip", "")
+    tar_file, zip_ext = os.path.splitext(filename)
+    return os.path.splitext(tar_file)[0]
+
+
+def _tree_fingerprint(dirname):
+    """Return a digest of the names, types, sizes, modes and modification
+    times of everything under `dirname`, without reading any file."""
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(dirname):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            entry = [os.path.relpath(path, dirname), st.st_mode, st.st_mtime_ns]
+            if stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                entry.append(st.st_size)
+            h.update(json.dumps(entry).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _unpack_state(file_record, full):
+    """Return what the unpack state marker of `file_record` records about
+    its unpacked directory, or None if that directory is missing.  The
+    fingerprint of the whole tree is only computed if `full` is true."""
+    dirname = unpacked_path(file_record.filename)
     try:
-        manifest = open_manifest(manifest_file)
-    except InvalidManifest as e:
-        log.error(
-            "failed to load manifest file at '%s': %s"
-            % (
-                manifest_file,
-                str(e),
-            )
+        st = os.lstat(dirname)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return None
+    state = {
+        "filename": file_record.filename,
+        "algorithm": file_record.algorithm,
+        "digest": file_record.digest,
+        # the directory's inode changes when it is replaced and its
+        # modification time when an entry is added to or removed from it
+        "fingerprint": [st.st_ino, st.st_mtime_ns],
+    }
+    if full:
+        state["tree"] = _tree_fingerprint(dirname)
+    return state
+
+
+def is_unpacked(file_record, verify=False):
+    """Return True if the archive described by `file_record` was unpacked by
+    an earlier fetch and its unpacked directory still looks untouched.  With
+    `verify`, every file in that directory is checked, not just its top."""
+    marker = unpacked_path(file_record.filename) + CHECKSUM_SUFFIX
+    try:
+        with open(marker, "r") as f:
+            recorded = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    current = _unpack_state(file_record, verify)
+    if current is None or not isinstance(recorded, dict):
+        return False
+    return all(recorded.get(key) == value for key, value in current.items())
+
+
+def _forget_unpacked(file_record):
+    marker = unpacked_path(file_record.filename) + CHECKSUM_SUFFIX
+    if os.path.lexists(marker):
+        os.remove(marker)
+
+
+def _mark_unpacked(file_record):
+    """I record that the archive described by `file_record` has just been
+    unpacked, so that later fetches can skip unpacking it again."""
+    state = _unpack_state(file_record, True)
+    if state is None:
+        # the archive did not unpack to the expected directory, so there is
+        # no cheap way of telling whether it is still there
+        return
+    marker = unpacked_path(file_record.filename) + CHECKSUM_SUFFIX
+    try:
+        with open(marker + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(marker + ".tmp", marker)
+    except (IOError, OSError):
+        log.warning("failed to write %s" % marker, exc_info=True)
+
+
+def unpack_file_record(file_record, verify=False):
+    """Unpack the archive described by `file_record`, unless it has already
+    been unpacked (see is_unpacked()).  Return False if unpacking failed."""
+    if is_unpacked(file_record, verify):
+        log.info(
+            '"%s" is already unpacked in "%s"'
+            % (file_record.filename, unpacked_path(file_record.filename))
         )
+        return True
+    # an interrupted unpack must not leave a marker behind
+    _forget_unpacked(file_record)
+    if not unpack_file(file_record.filename):
         return False
+    _mark_unpacked(file_record)
+    return True
+
+
+STREAMABLE_EXTENSIONS = (
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tar.xz",
+    ".tar.zst",
+)
+
+
+class StreamingUnpacker(object):
+    """I extract a tar archive on a thread, into a staging directory, as its
+    data is given to my `write` method, so that a download and its unpacking
+    can overlap.  Once the whole archive has been written, `finish` waits for
+    the extraction and `swap` moves what was extracted into place.  If
+    anything goes wrong, the staging directory is discarded and `finish`
+    returns False, so that the caller can unpack the archive the usual way.
 
-    # we want to track files already in current working directory AND valid
-    # we will not need to fetch these
-    present_files = []
-
-    # We want to track files that fail to be fetched as well as
-    # files that are fetched
-    failed_files = []
-    fetched_files = []
-
-    # Files that we want to unpack.
-    unpack_files = []
-
-    # Lets go through the manifest and fetch the files that we want
-    for f in manifest.file_records:
-        # case 1: files are already present
-        if f.present():
-            if f.validate():
-                present_files.append(f.filename)
-                if f.unpack:
-                    unpack_files.append(f.filename)
+    Like unpack_file, I assume the archive contains a single directory with
+    a name matching the base of the archive filename."""
+
+    def __init__(self, filename, dirname="."):
+        self.filename = filename
+        self.dirname = dirname
+        self.staging = tempfile.mkdtemp(
+            prefix=".%s.unpack-" % os.path.basename(filename), dir=dirname
+        )
+        self.error = None
+        self._abandoned = False
+        read_fd, self._write_fd = os.pipe()
+        self._thread = threading.Thread(target=self._extract, args=(read_fd,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def can_unpack(filename):
+        return filename.endswith(STREAMABLE_EXTENSIONS)
+
+    def _extract(self, read_fd):
+        raw = open(read_fd, "rb", buffering=DIGEST_CHUNK_SIZE)
+
+        def drain():
+            # whatever follows the end of the archive must still be read, or
+            # the writer would block
+            while raw.read(DIGEST_CHUNK_SIZE):
+                pass
+
+        try:
+            if self.filename.endswith(".tar.zst"):
+                with zstd_reader(raw) as fileobj:
+                    with TarFile.open(fileobj=fileobj, mode="r|") as tar:
+                        safe_extract(tar, self.staging)
+                drain()
             else:
-                # we have an invalid file here, better to cleanup!
-                # this invalid file needs to be replaced with a good one
-                # from the local cash or fetched from a tooltool server
-                log.info(
-                    "File %s is present locally but it is invalid, so I will remove it "
-                    "and try to fetch it" % f.filename
-                )
-                os.remove(os.path.join(os.getcwd(), f.filename))
+                with TarFile.open(fileobj=raw, mode="r|*") as tar:
+                    safe_extract(tar, self.staging)
+                drain()
+        except Exception as e:
+            self.error = e
+            log.info("streaming extraction of %s failed" % self.filename, exc_info=True)
+        finally:
+            # with the read end closed, further writes fail with EPIPE
+            raw.close()
 
-        # check if file is already in cache
-        if cache_folder and f.filename not in present_files:
+    def write(self, data):
+        if self._write_fd is None:
+            return
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(self._write_fd, view) :]
+        except OSError:
+            # the extraction thread has stopped; finish() will report it
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def _close(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+        self._thread.join()
+
+    def abandon(self):
+        """I stop the extraction and discard whatever was extracted."""
+        self._abandoned = True
+        self._close()
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+    def finish(self):
+        """I wait for the extraction to complete and return True if it
+        succeeded."""
+        self._close()
+        if self._abandoned or self.error is not None:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            return False
+        return True
+
+    def swap(self):
+        """I move the extracted files into place, replacing any previous
+        version of them."""
+        log.info('moving files unpacked from "%s" into place' % self.filename)
+        for name in os.listdir(self.staging):
+            target = os.path.join(self.dirname, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                clean_path(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+            os.rename(os.path.join(self.staging, name), target)
+        os.rmdir(self.staging)
+
+
+# ioctl request to share a file's extents with another file on filesystems
+# which support it (btrfs, xfs, ...), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _clone_file(src, dst, link=False):
+    """I give `dst` the content of `src` as cheaply as the filesystem
+    allows and return how that was done.  Unless `link` is true, `dst` is an
+    independent file."""
+    if sys.platform.startswith("linux"):
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
             try:
-                shutil.copy(
-                    os.path.join(cache_folder, f.digest),
-                    os.path.join(os.getcwd(), f.filename),
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return "reflinked"
+            except OSError:
+                pass
+    if link:
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            # a hardlink shares its permissions with the cached file;
+            # make sure neither can be modified in place
+            if os.name != "nt":
+                os.chmod(dst, stat.S_IMODE(os.stat(dst).st_mode) & ~0o222)
+            return "hardlinked"
+        except OSError:
+            log.debug("failed to hardlink %s to %s" % (src, dst), exc_info=True)
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+                return "copied (copy_file_range)"
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, DIGEST_CHUNK_SIZE)
+        return "copied"
+
+
+def _materialize(src, dst, link=False, mode=None):
+    """I put a file with the content of `src` at `dst`, atomically, using
+    _clone_file.  If `mode` is given, the new file gets those permissions
+    before it appears at `dst`."""
+    # a dotfile, so that it is never mistaken for a cache entry
+    dirname, basename = os.path.split(dst)
+    tmp = os.path.join(
+        dirname, ".%s.tmp-%d-%d" % (basename, os.getpid(), threading.get_ident())
+    )
+    try:
+        how = _clone_file(src, tmp, link=link)
+        if mode is not None and os.name != "nt":
+            os.chmod(tmp, mode)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    log.debug("%s %s to %s" % (how, src, dst))
+    return how
+
+
+class LocalCache(object):
+    """I manage a cache folder.  Cached files are named after their digest
+    and kept flat in the folder; an index next to them records the size, last
+    access time and number of hits of each one, so that eviction doesn't need
+    to look at every file.  Entries appear atomically, and fetches of the same
+    digest by several processes are serialized with a lock file.
+
+    Files in the folder which aren't in the index yet, e.g. those added by
+    older versions of tooltool, are indexed by `reconcile` using their mtime.
+    If the index can't be used, I fall back to file mtimes."""
+
+    index_name = ".tooltool-index.sqlite"
+    locks_name = ".locks"
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_failed = False
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest)
+
+    def _index(self):
+        """I return the index database, opening it if necessary, or None if it
+        isn't usable.  The caller must hold self._lock."""
+        if self._db is None and not self._db_failed:
+            try:
+                self._db = sqlite3.connect(
+                    os.path.join(self.folder, self.index_name),
+                    timeout=60,
+                    check_same_thread=False,
+                    isolation_level=None,
                 )
-                log.info(
-                    "File %s retrieved from local cache %s" % (f.filename, cache_folder)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "digest TEXT PRIMARY KEY, size INTEGER, "
+                    "last_access REAL, hits INTEGER)"
                 )
-                touch(os.path.join(cache_folder, f.digest))
-
-                filerecord_for_validation = FileRecord(
-                    f.filename, f.size, f.digest, f.algorithm
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_last_access "
+                    "ON entries (last_access)"
                 )
-                if filerecord_for_validation.validate():
-                    present_files.append(f.filename)
-                    if f.unpack:
-                        unpack_files.append(f.filename)
-                else:
-                    # the file copied from the cache is invalid, better to
-                    # clean up the cache version itself as well
-                    log.warning(
-                        "File %s retrieved from cache is invalid! I am deleting it from the "
-                        "cache as well" % f.filename
-                    )
-                    os.remove(os.path.join(os.getcwd(), f.filename))
-                    os.remove(os.path.join(cache_folder, f.digest))
-            except IOError:
-                log.info(
-                    "File %s not present in local cache folder %s"
-                    % (f.filename, cache_folder)
+            except sqlite3.Error:
+                log.warning(
+                    "cannot use the index of cache folder %s" % self.folder,
+                    exc_info=True,
                 )
-
-        # now I will try to fetch all files which are not already present and
-        # valid, appending a suffix to avoid race conditions
-        temp_file_name = None
-        # 'filenames' is the list of filenames to be managed, if this variable
-        # is a non empty list it can be used to filter if filename is in
-        # present_files, it means that I have it already because it was already
-        # either in the working dir or in the cache
-        if (
-            f.filename in filenames or len(filenames) == 0
-        ) and f.filename not in present_files:
-            log.debug("fetching %s" % f.filename)
-            temp_file_name = fetch_file(
-                base_urls, f, auth_file=auth_file, region=region
+                self._db, self._db_failed = None, True
+        return self._db
+
+    def _execute(self, sql, params=()):
+        """I run `sql` on the index and return the resulting rows, or None if
+        the index isn't usable."""
+        with self._lock:
+            db = self._index()
+            if db is None:
+                return None
+            try:
+                return db.execute(sql, params).fetchall()
+            except sqlite3.Error:
+                log.warning(
+                    "failed to update the index of cache folder %s" % self.folder,
+                    exc_info=True,
+                )
+                return None
+
+    def _execute_many(self, sql, seq):
+        """I run `sql` once for each parameter tuple in `seq`, in a single
+        transaction, and return False if the index isn't usable."""
+        with self._lock:
+            db = self._index()
+            if db is None:
+                return False
+            try:
+                db.execute("BEGIN")
+                db.executemany(sql, seq)
+                db.execute("COMMIT")
+                return True
+            except sqlite3.Error:
+                log.warning(
+                    "failed to update the index of cache folder %s" % self.folder,
+                    exc_info=True,
+                )
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                return False
+
+    @contextmanager
+    def lock(self, digest):
+        """I hold an exclusive lock on `digest` for the duration of the
+        context, across threads and processes.  If the lock file can't be
+        created, the context runs unlocked."""
+        if os.name == "nt":
+            yield
+            return
+        try:
+            os.makedirs(self.folder, 0o0700, exist_ok=True)
+            os.makedirs(os.path.join(self.folder, self.locks_name), exist_ok=True)
+            fd = os.open(
+                os.path.join(self.folder, self.locks_name, digest),
+                os.O_RDWR | os.O_CREAT,
+                0o600,
+            )
+        except OSError:
+            log.debug("cannot lock %s in %s" % (digest, self.folder), exc_info=True)
+            yield
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def retrieve(self, digest, dst, link=False):
+        """I put the cached file for `digest` at `dst`, raising IOError if
+        there is no such file."""
+        _materialize(self.path(digest), dst, link=link)
+        now = time.time()
+        # the file may not be indexed yet if an older tooltool added it
+        if self._execute_many(
+            "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, 0)",
+            [(digest, os.path.getsize(dst), now)],
+        ):
+            self._execute(
+                "UPDATE entries SET last_access = ?, hits = hits + 1 WHERE digest = ?",
+                (now, digest),
             )
-            if temp_file_name:
-                fetched_files.append((f, temp_file_name))
-            else:
-                failed_files.append(f.filename)
         else:
-            log.debug("skipping %s" % f.filename)
+            touch(self.path(digest))
+
+    def insert(self, src, digest, link=False):
+        """I add the file `src` to the cache as `digest`."""
+        os.makedirs(self.folder, 0o0700, exist_ok=True)
+        # cached files are read-only, which also protects hardlinks to them
+        # from being modified in place
+        _materialize(src, self.path(digest), link=link, mode=0o444)
+        self._execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, 0)",
+            (digest, os.path.getsize(self.path(digest)), time.time()),
+        )
 
-    # lets ensure that fetched files match what the manifest specified
-    for localfile, temp_file_name in fetched_files:
-        # since I downloaded to a temp file, I need to perform all validations on the temp file
-        # this is why filerecord_for_validation is created
+    def remove(self, digest):
+        """I remove `digest` from the cache, raising OSError if its file
+        can't be removed."""
+        os.remove(self.path(digest))
+        self._execute("DELETE FROM entries WHERE digest = ?", (digest,))
+        self._remove_lock_file(digest)
 
-        filerecord_for_validation = FileRecord(
-            temp_file_name, localfile.size, localfile.digest, localfile.algorithm
+    def _remove_lock_file(self, digest):
+        try:
+            os.remove(os.path.join(self.folder, self.locks_name, digest))
+        except OSError:
+            pass
+
+    def remove_many(self, digests, jobs=1):
+        """I remove all of `digests` from the cache, deleting files on `jobs`
+        threads and updating the index once, and return the list of digests
+        which were actually removed."""
+
+        def remove_file(digest):
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                log.info("Impossible to remove %s" % self.path(digest), exc_info=True)
+                return False
+            self._remove_lock_file(digest)
+            return True
+
+        if jobs > 1 and len(digests) > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(remove_file, digests))
+        else:
+            results = [remove_file(d) for d in digests]
+        removed = [d for d, ok in zip(digests, results) if ok]
+        self._execute_many(
+            "DELETE FROM entries WHERE digest = ?", ((d,) for d in removed)
+        )
+        return removed
+
+    def reconcile(self):
+        """I make the index match the files in the cache folder."""
+        with os.scandir(self.folder) as it:
+            names = dict(
+                (entry.name, entry)
+                for entry in it
+                if not entry.name.startswith(".") and entry.is_file()
+            )
+        rows = self._execute("SELECT digest FROM entries")
+        if rows is None:
+            return
+        indexed = set(row[0] for row in rows)
+        self._execute_many(
+            "DELETE FROM entries WHERE digest = ?",
+            ((d,) for d in indexed.difference(names)),
         )
+        added = []
+        for digest in set(names).difference(indexed):
+            try:
+                st = names[digest].stat()
+            except OSError:
+                continue
+            added.append((digest, st.st_size, st.st_mtime))
+        if added:
+            log.info(
+                "indexing %d files found in cache folder %s" % (len(added), self.folder)
+            )
+            self._execute_many(
+                "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, 0)", added
+            )
 
-        if filerecord_for_validation.validate():
-            # great!
-            # I can rename the temp file
+    def entries(self):
+        """I return (digest, size) for every cached file, least recently used
+        first."""
+        self.reconcile()
+        rows = self._execute("SELECT digest, size FROM entries ORDER BY last_access")
+        if rows is not None:
+            return rows
+        entries = []
+        for f in os.listdir(self.folder):
+            p = self.path(f)
+            if f.startswith(".") or not os.path.isfile(p):
+                continue
+            entries.append((os.path.getmtime(p), f, os.path.getsize(p)))
+        return [(f, size) for _, f, size in sorted(entries)]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def _fetch_file_record(
+    f,
+    base_urls,
+    filenames,
+    cache=None,
+    auth_file=None,
+    region=None,
+    cache_mode="copy",
+    stream_unpack=False,
+    verify_unpacked=False,
+    resolved_url=None,
+):
+    """I make the file described by the FileRecord `f` present and valid in
+    the current working directory, taking it from there, from the LocalCache
+    `cache` or from a tooltool server, and unpack it if requested.  I return
+    False if any of those steps failed."""
+    present = False
+    unpacker = None
+
+    # case 1: files are already present
+    if f.present():
+        if f.validate():
+            present = True
+        else:
+            # we have an invalid file here, better to cleanup!
+            # this invalid file needs to be replaced with a good one
+            # from the local cash or fetched from a tooltool server
             log.info(
-                "File integrity verified, renaming %s to %s"
-                % (temp_file_name, localfile.filename)
+                "File %s is present locally but it is invalid, so I will remove it "
+                "and try to fetch it" % f.filename
             )
+            os.remove(os.path.join(os.getcwd(), f.filename))
+
+    # while this digest is locked, other processes wait for it to appear in
+    # the cache instead of downloading it too
+    with cache.lock(f.digest) if cache and not present else nullcontext():
+        # check if file is already in cache
+        if cache and not present:
+            present = _fetch_from_cache(f, cache, cache_mode)
+
+        # now I will try to fetch the file if it is not already present and
+        # valid, appending a suffix to avoid race conditions.
+        # 'filenames' is the list of filenames to be managed, if this variable
+        # is a non empty list it can be used to filter which files are fetched
+        if present:
+            pass
+        elif f.filename in filenames or len(filenames) == 0:
+            log.debug("fetching %s" % f.filename)
+            if (
+                stream_unpack
+                and f.unpack
+                and StreamingUnpacker.can_unpack(f.filename)
+                and not is_unpacked(f, verify_unpacked)
+            ):
+                # unpack the archive as it is downloaded
+                unpacker = StreamingUnpacker(f.filename, os.getcwd())
+            # fetch_file validates the size and digest of the temp file while
+            # downloading it, so there is no need to read it again here
+            temp_file_name = fetch_file(
+                base_urls,
+                f,
+                auth_file=auth_file,
+                region=region,
+                sink=unpacker,
+                resolved_url=resolved_url,
+            )
+            if not temp_file_name:
+                if unpacker is not None:
+                    unpacker.abandon()
+                return False
+
+            # great!
+            # I can rename the temp file
+            log.info("Renaming %s to %s" % (temp_file_name, f.filename))
             os.rename(
                 os.path.join(os.getcwd(), temp_file_name),
-                os.path.join(os.getcwd(), localfile.filename),
+                os.path.join(os.getcwd(), f.filename),
             )
 
-            if localfile.unpack:
-                unpack_files.append(localfile.filename)
-
-            # if I am using a cache and a new file has just been retrieved from a
-            # remote location, I need to update the cache as well
-            if cache_folder:
-                log.info("Updating local cache %s..." % cache_folder)
+            # if I am using a cache and a new file has just been retrieved
+            # from a remote location, I need to update the cache as well
+            if cache:
+                log.info("Updating local cache %s..." % cache.folder)
                 try:
-                    if not os.path.exists(cache_folder):
-                        log.info("Creating cache in %s..." % cache_folder)
-                        os.makedirs(cache_folder, 0o0700)
-                    shutil.copy(
-                        os.path.join(os.getcwd(), localfile.filename),
-                        os.path.join(cache_folder, localfile.digest),
+                    cache.insert(
+                        os.path.join(os.getcwd(), f.filename),
+                        f.digest,
+                        link=cache_mode == "link",
                     )
                     log.info(
-                        "Local cache %s updated with %s"
-                        % (cache_folder, localfile.filename)
+                        "Local cache %s updated with %s" % (cache.folder, f.filename)
                     )
-                    touch(os.path.join(cache_folder, localfile.digest))
                 except (OSError, IOError):
                     log.warning(
                         "Impossible to add file %s to cache folder %s"
-                        % (localfile.filename, cache_folder),
+                        % (f.filename, cache.folder),
                         exc_info=False,
                     )
         else:
-            failed_files.append(localfile.filename)
-            log.error("'%s'" % filerecord_for_validation.describe())
-            os.remove(temp_file_name)
+            log.debug("skipping %s" % f.filename)
+            return True
+
+    # Unpack the file if it needs to be unpacked.  The download has been
+    # verified by now, so files unpacked while it was in flight can be used.
+    if unpacker is not None and unpacker.finish():
+        try:
+            _forget_unpacked(f)
+            unpacker.swap()
+            _mark_unpacked(f)
+            return True
+        except OSError:
+            log.warning(
+                "failed to move files unpacked from %s into place" % f.filename,
+                exc_info=True,
+            )
+            shutil.rmtree(unpacker.staging, ignore_errors=True)
+    if f.unpack and not unpack_file_record(f, verify=verify_unpacked):
+        return False
+    return True
+
+
+def _fetch_from_cache(f, cache, cache_mode):
+    """I put the file described by the FileRecord `f` in the current working
+    directory from the LocalCache `cache`, and return True if it is there and
+    valid."""
+    try:
+        cache.retrieve(
+            f.digest,
+            os.path.join(os.getcwd(), f.filename),
+            link=cache_mode == "link",
+        )
+    except IOError:
+        log.info(
+            "File %s not present in local cache folder %s" % (f.filename, cache.folder)
+        )
+        return False
+    log.info("File %s retrieved from local cache %s" % (f.filename, cache.folder))
+
+    filerecord_for_validation = FileRecord(f.filename, f.size, f.digest, f.algorithm)
+    if filerecord_for_validation.validate():
+        return True
+    # the file copied from the cache is invalid, better to
+    # clean up the cache version itself as well
+    log.warning(
+        "File %s retrieved from cache is invalid! I am deleting it from the "
+        "cache as well" % f.filename
+    )
+    os.remove(os.path.join(os.getcwd(), f.filename))
+    try:
+        cache.remove(f.digest)
+    except OSError:
+        log.warning("Impossible to remove %s" % cache.path(f.digest), exc_info=True)
+    return False
 
-    # Unpack files that need to be unpacked.
-    for filename in unpack_files:
-        if not unpack_file(filename):
-            failed_files.append(filename)
+
+def fetch_files(
+    manifest_file,
+    base_urls,
+    filenames=[],
+    cache_folder=None,
+    auth_file=None,
+    region=None,
+    jobs=1,
+    cache_mode="copy",
+    stream_unpack=False,
+    verify_unpacked=False,
+):
+    # Lets load the manifest file
+    try:
+        manifest = open_manifest(manifest_file)
+    except InvalidManifest as e:
+        log.error(
+            "failed to load manifest file at '%s': %s"
+            % (
+                manifest_file,
+                str(e),
+            )
+        )
+        return False
+
+    cache = LocalCache(cache_folder) if cache_folder else None
+
+    # Ask for links to all of the files that may need downloading in one
+    # request, rather than one request per file.  Those in the cache are not
+    # asked for: if the cached copy turns out to be invalid, fetch_file asks
+    # the servers for the file itself.
+    wanted = [
+        f
+        for f in manifest.file_records
+        if (f.filename in filenames or len(filenames) == 0)
+        and not f.present()
+        and not (cache and os.path.exists(cache.path(f.digest)))
+    ]
+    resolved = resolve_files(base_urls, wanted, auth_file=auth_file) if wanted else {}
+
+    def fetch(f):
+        return _fetch_file_record(
+            f,
+            base_urls,
+            filenames,
+            cache=cache,
+            auth_file=auth_file,
+            region=region,
+            cache_mode=cache_mode,
+            stream_unpack=stream_unpack,
+            verify_unpacked=verify_unpacked,
+            resolved_url=resolved.get(f.digest, {}).get("get_url"),
+        )
+
+    # Every file record goes through its own cache lookup, download,
+    # validation and unpack steps, so with more than one job several
+    # records are processed at the same time, largest first so that a big
+    # download doesn't start last.
+    try:
+        if jobs > 1:
+            records = sorted(
+                manifest.file_records, key=lambda f: f.size or 0, reverse=True
+            )
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = dict((id(f), executor.submit(fetch, f)) for f in records)
+                results = [futures[id(f)].result() for f in manifest.file_records]
+        else:
+            results = [fetch(f) for f in manifest.file_records]
+    finally:
+        if cache:
+            cache.close()
+
+    # We want to track files that fail to be fetched, validated or unpacked
+    failed_files = [
+        f.filename for f, ok in zip(manifest.file_records, results) if not ok
+    ]
 
     # If we failed to fetch or validate a file, we need to fail
     if len(failed_files) > 0:
-        log.error("The following files failed: '%s'" % "', ".join(failed_files))
+        log.error("The following files failed: '%s'" % "', '".join(failed_files))
         return False
     return True
 
@@ -1248,37 +2857,54 @@ def freespace(p):
         return r.f_frsize * r.f_bavail
 
 
-def purge(folder, gigs):
+def purge(folder, gigs, max_size=None, jobs=1):
     """If gigs is non 0, it deletes files in `folder` until `gigs` GB are free,
-    starting from older files.  If gigs is 0, a full purge will be performed.
-    No recursive deletion of files in subfolder is performed."""
+    starting from the least recently used files.  If max_size is given, it
+    also deletes files until the cache holds at most `max_size` GB.  If
+    neither is given, a full purge will be performed.  Files are deleted on
+    `jobs` threads.  No recursive deletion of files in subfolder is
+    performed."""
 
-    full_purge = bool(gigs == 0)
+    full_purge = not gigs and max_size is None
     gigs *= 1024 * 1024 * 1024
+    start = time.time()
 
-    if not full_purge and freespace(folder) >= gigs:
-        log.info("No need to cleanup")
-        return
-
-    files = []
-    for f in os.listdir(folder):
-        p = os.path.join(folder, f)
-        # it deletes files in folder without going into subfolders,
-        # assuming the cache has a flat structure
-        if not os.path.isfile(p):
-            continue
-        mtime = os.path.getmtime(p)
-        files.append((mtime, p))
-
-    # iterate files sorted by mtime
-    for _, f in sorted(files):
-        log.info("removing %s to free up space" % f)
-        try:
-            os.remove(f)
-        except OSError:
-            log.info("Impossible to remove %s" % f, exc_info=True)
-        if not full_purge and freespace(folder) >= gigs:
-            break
+    cache = LocalCache(folder)
+    try:
+        # least recently used files first
+        entries = cache.entries()
+        if full_purge:
+            evict = [digest for digest, _ in entries]
+        else:
+            # work out how much to delete up front, from the recorded sizes,
+            # rather than checking the free space after every deletion
+            to_free = 0
+            if gigs:
+                to_free = gigs - freespace(folder)
+            if max_size is not None:
+                total = sum(size for _, size in entries)
+                to_free = max(to_free, total - max_size * 1024 * 1024 * 1024)
+            if to_free <= 0:
+                log.info("No need to cleanup")
+                return
+            evict = []
+            for digest, size in entries:
+                if to_free <= 0:
+                    break
+                evict.append(digest)
+                to_free -= size
+
+        for digest in evict:
+            log.debug("removing %s to free up space" % cache.path(digest))
+        removed = set(cache.remove_many(evict, jobs=jobs))
+    finally:
+        cache.close()
+
+    reclaimed = sum(size for digest, size in entries if digest in removed)
+    log.info(
+        "Purged %d files from %s, reclaiming %.1f MB in %.2f seconds"
+        % (len(removed), folder, reclaimed / 1000000.0, time.time() - start)
+    )
 
 
 def _log_api_error(e):
@@ -1322,49 +2948,156 @@ def _authorize(req, auth_file):
         req.add_unredirected_header("Authorization", "Bearer %s" % auth_content)
 
 
+# the request header with which uploads ask for large files to be uploaded in
+# parts
+MULTIPART_HEADER = "X-Tooltool-Multipart"
+
+# parts of a multipart upload are sent on this many threads per file, and
+# each part is tried this many times, sleeping this many seconds (growing)
+# between attempts
+MULTIPART_JOBS = 4
+MULTIPART_ATTEMPTS = 5
+MULTIPART_RETRY_SLEEP = 10
+
+
 def _send_batch(base_url, auth_file, batch, region):
     url = urljoin(base_url, "upload")
     if region is not None:
         url += "?region=" + region
     data = json.dumps(batch).encode("utf-8")
-    req = Request(url, data, {"Content-Type": "application/json"})
+    # ask for large files to be uploaded in parts; servers which do not
+    # support this ignore the header and hand out a single URL.  A query
+    # parameter would be part of the resource signed for Hawk, which older
+    # servers verify without the query
+    req = Request(
+        url,
+        data,
+        {"Content-Type": "application/json", MULTIPART_HEADER: "true"},
+    )
     _authorize(req, auth_file)
     try:
-        resp = _urlopen(req)
+        with closing(_urlopen(req)) as resp:
+            return json.load(resp)["result"]
     except (URLError, HTTPError) as e:
         _log_api_error(e)
         return None
-    return json.load(resp)["result"]
+
+
+def _s3_put(put_url, body, content_length):
+    # urllib2 does not support streaming, so we send the request on a pooled
+    # connection ourselves
+    url = urlparse(put_url)
+    req_path = "%s?%s" % (url.path, url.query) if url.query else url.path
+    resp = _connection_pool.request(
+        url.scheme,
+        url.netloc,
+        "PUT",
+        req_path,
+        body,
+        {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(content_length),
+        },
+    )
+    resp_body = resp.read()
+    resp.close()
+    if resp.status != 200:
+        raise RuntimeError(
+            "Non-200 return from AWS: %s %s\n%s" % (resp.status, resp.reason, resp_body)
+        )
+    return resp
 
 
 def _s3_upload(filename, file):
-    # urllib2 does not support streaming, so we fall back to good old httplib
-    url = urlparse(file["put_url"])
-    cls = HTTPSConnection if url.scheme == "https" else HTTPConnection
-    host, port = url.netloc.split(":") if ":" in url.netloc else (url.netloc, 443)
-    port = int(port)
-    conn = cls(host, port)
     try:
-        req_path = "%s?%s" % (url.path, url.query) if url.query else url.path
         with open(filename, "rb") as f:
-            content_length = file["size"]
-            conn.request(
-                "PUT",
-                req_path,
-                f,
-                {
-                    "Content-Type": "application/octet-stream",
-                    "Content-Length": str(content_length),
-                },
-            )
-            resp = conn.getresponse()
-            resp_body = resp.read()
-            conn.close()
-        if resp.status != 200:
-            raise RuntimeError(
-                "Non-200 return from AWS: %s %s\n%s"
-                % (resp.status, resp.reason, resp_body)
-            )
+            _s3_put(file["put_url"], f, file["size"])
+    except Exception:
+        file["upload_exception"] = sys.exc_info()
+        file["upload_ok"] = False
+    else:
+        file["upload_ok"] = True
+
+
+class _FileSlice(io.RawIOBase):
+    """I am a read-only view of `length` bytes of a file, starting at
+    `offset`, for use as the body of an upload request.  Seeking to 0
+    rewinds to `offset`, so that the request can be sent again."""
+
+    def __init__(self, f, offset, length):
+        self._f = f
+        self._offset = offset
+        self._length = length
+        self.seek(0)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        assert pos == 0 and whence == io.SEEK_SET
+        self._f.seek(self._offset)
+        self._remaining = self._length
+        return 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+def _s3_upload_part(filename, part_url, offset, length):
+    with open(filename, "rb") as f:
+        resp = _s3_put(part_url, _FileSlice(f, offset, length), length)
+    etag = resp.getheader("ETag")
+    if not etag:
+        raise RuntimeError("No ETag in the response from AWS")
+    return etag
+
+
+def _complete_multipart_upload(base_url, auth_file, file, parts):
+    url = urljoin(base_url, "upload/multipart/%(algorithm)s/%(digest)s" % file)
+    data = json.dumps({"upload_id": file["multipart"]["upload_id"], "parts": parts})
+    req = Request(url, data.encode("utf-8"), {"Content-Type": "application/json"})
+    _authorize(req, auth_file)
+    with closing(_urlopen(req)) as resp:
+        resp.read()
+
+
+def _s3_multipart_upload(base_url, auth_file, filename, file):
+    """I upload a file in the parts described by file["multipart"], several
+    parts at a time, retrying each part on its own, and then ask the server
+    to assemble the parts.  Like _s3_upload, I annotate `file` with the
+    result."""
+    multipart = file["multipart"]
+    part_size = multipart["part_size"]
+
+    def upload_part(part_number, part_url):
+        offset = (part_number - 1) * part_size
+        length = max(0, min(part_size, file["size"] - offset))
+        etag = retry(
+            _s3_upload_part,
+            attempts=MULTIPART_ATTEMPTS,
+            sleeptime=MULTIPART_RETRY_SLEEP,
+            jitter=0,
+            args=(filename, part_url, offset, length),
+        )
+        return {"part_number": part_number, "etag": etag}
+
+    try:
+        part_urls = multipart["part_urls"]
+        with ThreadPoolExecutor(max_workers=min(MULTIPART_JOBS, len(part_urls))) as e:
+            parts = list(e.map(upload_part, range(1, len(part_urls) + 1), part_urls))
+        _complete_multipart_upload(base_url, auth_file, file, parts)
     except Exception:
         file["upload_exception"] = sys.exc_info()
         file["upload_ok"] = False
@@ -1376,7 +3109,8 @@ def _notify_upload_complete(base_url, auth_file, file):
     req = Request(urljoin(base_url, "upload/complete/%(algorithm)s/%(digest)s" % file))
     _authorize(req, auth_file)
     try:
-        _urlopen(req)
+        with closing(_urlopen(req)) as resp:
+            resp.read()
     except HTTPError as e:
         if e.code != 409:
             _log_api_error(e)
@@ -1391,7 +3125,43 @@ def _notify_upload_complete(base_url, auth_file, file):
         log.exception("While notifying server of upload completion:")
 
 
-def upload(manifest, message, base_urls, auth_file, region):
+def _notify_uploads_complete(base_url, auth_file, files):
+    """I notify the server that all of `files` were uploaded, in a single
+    request, which the server may ask me to repeat once their upload URLs
+    have expired.  Servers without the batch endpoint are notified one file
+    at a time."""
+    data = json.dumps({"digests": [file["digest"] for file in files]})
+    while True:
+        req = Request(
+            urljoin(base_url, "upload/complete"),
+            data.encode("utf-8"),
+            {"Content-Type": "application/json"},
+        )
+        _authorize(req, auth_file)
+        try:
+            with closing(_urlopen(req)) as resp:
+                resp.read()
+            return
+        except HTTPError as e:
+            if e.code in (404, 405):
+                break
+            if e.code != 409:
+                _log_api_error(e)
+                return
+            # 409 indicates that some of the upload URLs haven't expired
+            # yet; the delay is until the last of them does
+            to_wait = int(e.headers.get("X-Retry-After", 60))
+            log.warning("Waiting %d seconds for upload URLs to expire" % to_wait)
+            time.sleep(to_wait)
+        except Exception:
+            log.exception("While notifying server of upload completion:")
+            return
+
+    for file in files:
+        _notify_upload_complete(base_url, auth_file, file)
+
+
+def upload(manifest, message, base_urls, auth_file, region, jobs=None):
     try:
         manifest = open_manifest(manifest)
     except InvalidManifest:
@@ -1425,27 +3195,35 @@ def upload(manifest, message, base_urls, auth_file, region):
         return None
     files = resp["files"]
 
-    # Upload the files, each in a thread.  This allows us to start all of the
-    # uploads before any of the URLs expire.
-    threads = {}
+    # Upload the files on a pool of threads.  By default, the pool has a
+    # thread for each file, so that all of the uploads start before any of
+    # the URLs expire.
+    uploads = []
     for filename, file in files.items():
-        if "put_url" in file:
-            log.info("%s: starting upload" % (filename,))
-            thd = threading.Thread(target=_s3_upload, args=(filename, file))
-            thd.daemon = 1
-            thd.start()
-            threads[filename] = thd
+        if "put_url" in file or "multipart" in file:
+            uploads.append(filename)
         else:
             log.info("%s: already exists on server" % (filename,))
 
-    # re-join all of those threads as they exit
     success = True
-    while threads:
-        for filename, thread in list(threads.items()):
-            if not thread.is_alive():
-                # _s3_upload has annotated file with result information
+    if uploads:
+        jobs = min(jobs or len(uploads), len(uploads))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for filename in uploads:
+                log.info("%s: starting upload" % (filename,))
+                file = files[filename]
+                if "multipart" in file:
+                    future = executor.submit(
+                        _s3_multipart_upload, base_urls[0], auth_file, filename, file
+                    )
+                else:
+                    future = executor.submit(_s3_upload, filename, file)
+                futures[future] = filename
+            for future in as_completed(futures):
+                # the upload has annotated file with result information
+                filename = futures[future]
                 file = files[filename]
-                thread.join()
                 if file["upload_ok"]:
                     log.info("%s: uploaded" % filename)
                 else:
@@ -1453,15 +3231,22 @@ def upload(manifest, message, base_urls, auth_file, region):
                         "%s: failed" % filename, exc_info=file["upload_exception"]
                     )
                     success = False
-                del threads[filename]
 
     # notify the server that the uploads are completed.  If the notification
     # fails, we don't consider that an error (the server will notice
     # eventually)
-    for filename, file in files.items():
-        if "put_url" in file and file["upload_ok"]:
-            log.info("notifying server of upload completion for %s" % (filename,))
-            _notify_upload_complete(base_urls[0], auth_file, file)
+    uploaded = [
+        filename
+        for filename, file in files.items()
+        if ("put_url" in file or "multipart" in file) and file["upload_ok"]
+    ]
+    if uploaded:
+        log.info(
+            "notifying server of upload completion for %s" % (", ".join(uploaded),)
+        )
+        _notify_uploads_complete(
+            base_urls[0], auth_file, [files[filename] for filename in uploaded]
+        )
 
     return success
 
@@ -1478,7 +3263,8 @@ def send_operation_on_file(data, base_urls, digest, auth_file):
     _authorize(req, auth_file)
 
     try:
-        _urlopen(req)
+        with closing(_urlopen(req)) as resp:
+            resp.read()
     except (URLError, HTTPError) as e:
         _log_api_error(e)
         return False
@@ -1527,7 +3313,12 @@ def process_command(options, args):
         )
     elif cmd == "purge":
         if options["cache_folder"]:
-            purge(folder=options["cache_folder"], gigs=options["size"])
+            purge(
+                folder=options["cache_folder"],
+                gigs=options["size"],
+                max_size=options.get("max_cache_size"),
+                jobs=options.get("jobs") or 1,
+            )
         else:
             log.critical("please specify the cache folder to be purged")
             return False
@@ -1539,6 +3330,10 @@ def process_command(options, args):
             cache_folder=options["cache_folder"],
             auth_file=options.get("auth_file"),
             region=options.get("region"),
+            jobs=options.get("jobs") or 1,
+            cache_mode=options.get("cache_mode"),
+            stream_unpack=options.get("stream_unpack"),
+            verify_unpacked=options.get("verify_unpacked"),
         )
     elif cmd == "upload":
         if not options.get("message"):
@@ -1550,6 +3345,7 @@ def process_command(options, args):
             options.get("base_url"),
             options.get("auth_file"),
             options.get("region"),
+            jobs=options.get("jobs"),
         )
     elif cmd == "change-visibility":
         if not options.get("digest"):
@@ -1644,6 +3440,23 @@ Supported commands are:
         help="Request unpacking this file after fetch."
         " This is helpful with tarballs.",
     )
+    parser.add_option(
+        "--stream-unpack",
+        default=False,
+        dest="stream_unpack",
+        action="store_true",
+        help="When fetching tarballs which are to be unpacked, unpack them "
+        "while they are downloaded.",
+    )
+    parser.add_option(
+        "--verify-unpacked",
+        default=False,
+        dest="verify_unpacked",
+        action="store_true",
+        help="Before skipping the unpacking of an archive which an earlier "
+        "fetch already unpacked, check every unpacked file rather than only "
+        "the top directory.",
+    )
     parser.add_option(
         "--version",
         default=None,
@@ -1671,6 +3484,15 @@ Supported commands are:
     parser.add_option(
         "-c", "--cache-folder", dest="cache_folder", help="Local cache folder"
     )
+    parser.add_option(
+        "--link-cached-files",
+        default="copy",
+        dest="cache_mode",
+        action="store_const",
+        const="link",
+        help="Hardlink files from the cache folder instead of copying them. "
+        "Cached files are read-only, so the links are too.",
+    )
     parser.add_option(
         "-s",
         "--size",
@@ -1679,11 +3501,33 @@ Supported commands are:
         type="float",
         default=0.0,
     )
+    parser.add_option(
+        "--max-cache-size",
+        help="maximum size of the cache folder after a purge (in GB)",
+        dest="max_cache_size",
+        type="float",
+        default=None,
+    )
     parser.add_option(
         "-r",
         "--region",
         help="Preferred AWS region for upload or fetch; " "example: --region=us-west-2",
     )
+    parser.add_option(
+        "-j",
+        "--jobs",
+        help="number of files to fetch or upload, or to delete when purging, at the "
+        "same time (default: 1, or every file when uploading)",
+        dest="jobs",
+        type="int",
+        default=None,
+    )
+    parser.add_option(
+        "--digest-cache",
+        help="Remember the digests of local files in the given database, so "
+        "that files which haven't changed aren't hashed again.",
+        dest="digest_cache",
+    )
     parser.add_option(
         "--message",
         help='The "commit message" for an upload; format with a bug number '
@@ -1734,10 +3578,35 @@ Supported commands are:
     if options["algorithm"] != "sha512":
         parser.error("only --algorithm sha512 is supported")
 
+    if options["jobs"] is not None and options["jobs"] < 1:
+        parser.error("--jobs must be at least 1")
+
     if len(args) < 1:
         parser.error("You must specify a command")
 
-    return 0 if process_command(options, args) else 1
+    global _digest_cache
+    if options["digest_cache"]:
+        try:
+            _digest_cache = DigestCache(os.path.expanduser(options["digest_cache"]))
+        except sqlite3.Error:
+            log.warning(
+                "failed to open digest cache %s; not using it"
+                % options["digest_cache"],
+                exc_info=True,
+            )
+
+    try:
+        result = process_command(options, args)
+    finally:
+        log.debug(
+            "HTTP connections: %d opened, %d reused"
+            % (_connection_pool.opened, _connection_pool.reused)
+        )
+        _connection_pool.close()
+        if _digest_cache is not None:
+            _digest_cache.close()
+            _digest_cache = None
+    return 0 if result else 1
 
 
 if __name__ == "__main__":  # pragma: no cover